@@ -8,6 +8,10 @@ GUI версия БЕЗ отображения изображений - толь
 import sys
 import os
 
+# Движок удаления фона из реестра background_engines.py: 'lightdark' (порог по каналам),
+# 'auto', 'pillow', 'advanced', ... - см. python3 background_engines.py
+BG_ENGINE = os.environ.get('BG_ENGINE', 'lightdark').strip().lower()
+
 # Очищаем PYTHONPATH
 os.environ.pop('PYTHONPATH', None)
 
@@ -280,24 +284,10 @@ class PrintExtractorNoDisplay:
             cropped = cropped.convert('RGBA')
             
             # Удаляем фон
-            data = cropped.getdata()
-            new_data = []
-            transparent_count = 0
-            
-            for item in data:
-                r, g, b, a = item
-                # Удаляем светлый фон
-                if r > 230 and g > 230 and b > 230:
-                    new_data.append((255, 255, 255, 0))
-                    transparent_count += 1
-                # Удаляем темный фон
-                elif r < 30 and g < 30 and b < 30:
-                    new_data.append((0, 0, 0, 0))
-                    transparent_count += 1
-                else:
-                    new_data.append(item)
-            
-            cropped.putdata(new_data)
+            # Движок из реестра (BG_ENGINE), по умолчанию - порог по каналам
+            from background_engines import get_engine
+            cropped = get_engine(BG_ENGINE).remove(cropped, hints={'light': 230, 'dark': 30})
+            transparent_count = cropped.getchannel('A').histogram()[0]
             self.processed_image = cropped
             
             width, height = cropped.size
@@ -8,6 +8,10 @@
 import sys
 import os
 
+# Движок удаления фона из реестра background_engines.py: 'lightdark' (порог по каналам),
+# 'auto', 'pillow', 'advanced', ... - см. python3 background_engines.py
+BG_ENGINE = os.environ.get('BG_ENGINE', 'lightdark').strip().lower()
+
 # Шаг 1: Проверяем tkinter (БЕЗ print - может вызывать проблемы)
 try:
     import tkinter as tk
@@ -267,18 +271,9 @@ class SimplePrintExtractor:
             cropped = cropped.convert('RGBA')
             
             # Удаляем фон
-            data = cropped.getdata()
-            new_data = []
-            for item in data:
-                r, g, b, a = item
-                if r > 230 and g > 230 and b > 230:
-                    new_data.append((255, 255, 255, 0))
-                elif r < 30 and g < 30 and b < 30:
-                    new_data.append((0, 0, 0, 0))
-                else:
-                    new_data.append(item)
-            
-            cropped.putdata(new_data)
+            # Движок из реестра (BG_ENGINE), по умолчанию - порог по каналам
+            from background_engines import get_engine
+            cropped = get_engine(BG_ENGINE).remove(cropped, hints={'light': 230, 'dark': 30})
             self.processed_image = cropped
             self.display_image(self.processed_image, self.result_canvas)
             self.save_btn.config(state=tk.NORMAL)
@@ -8,6 +8,10 @@ GUI приложение для извлечения принтов - БЕЗОП
 import sys
 import os
 
+# Движок удаления фона из реестра background_engines.py: 'lightdark' (порог по каналам),
+# 'auto', 'pillow', 'advanced', ... - см. python3 background_engines.py
+BG_ENGINE = os.environ.get('BG_ENGINE', 'lightdark').strip().lower()
+
 # Безопасная загрузка tkinter
 def safe_import_tkinter():
     """Безопасная загрузка tkinter"""
@@ -433,17 +437,9 @@ class PrintExtractorGUI:
             
             # Простое удаление фона через PIL
             cropped = cropped.convert('RGBA')
-            data = cropped.getdata()
-            
-            new_data = []
-            for item in data:
-                # Если пиксель очень светлый (фон), делаем прозрачным
-                if item[0] > 240 and item[1] > 240 and item[2] > 240:
-                    new_data.append((255, 255, 255, 0))
-                else:
-                    new_data.append(item)
-            
-            cropped.putdata(new_data)
+            # Движок из реестра (BG_ENGINE), по умолчанию - порог по каналам
+            from background_engines import get_engine
+            cropped = get_engine(BG_ENGINE).remove(cropped, hints={'light': 240, 'dark': None})
             self.processed_image = cropped
             self.display_image(self.processed_image, self.result_canvas)
             
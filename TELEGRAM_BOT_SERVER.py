@@ -13,10 +13,18 @@ import ssl
 import urllib.request
 from pathlib import Path
 import tempfile
+import mimetypes
 
 # Импорты без macOS-специфичных путей
 from PIL import Image
 
+# Каталог временных файлов - общий с веб-сервером. Анализ изображения (карта краев, палитра)
+# бот не строит: веб-приложение работает в отдельном контейнере и считает его при /upload_image
+try:
+    from TELEGRAM_WEBAPP_SERVER import TempSpool
+except ImportError:
+    TempSpool = None
+
 # Telegram Bot API
 try:
     from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
@@ -48,6 +56,41 @@ temp_dir = Path(tempfile.gettempdir()) / 'telegram_print_extractor'
 temp_dir.mkdir(exist_ok=True)
 
 
+def _live_session_files():
+    """Файлы, на которые ссылаются текущие сессии"""
+    return {session['image_path'] for session in list(user_sessions.values())}
+
+
+def _evict_session_file(path):
+    """Сверх лимита каталога: сессии с этим файлом удаляются вместе с ним"""
+    owners = [user_id for user_id, session in list(user_sessions.items()) if session['image_path'] == path]
+    for user_id in owners:
+        user_sessions.pop(user_id, None)
+    if owners:
+        spool.release(path)
+    return bool(owners)
+
+
+# Скачанные фото живут в общем каталоге с лимитом объема и возраста (без веб-сервера - по-старому)
+spool = TempSpool('bot_', in_use=_live_session_files, evict=_evict_session_file) if TempSpool else None
+
+
+def download_path(user_id, file_id, extension):
+    if spool:
+        return Path(spool.reserve(extension))
+    return temp_dir / f"{user_id}_{file_id}{extension}"
+
+
+def store_session(user_id, session):
+    """Новая сессия пользователя; файл предыдущей больше не нужен"""
+    previous = user_sessions.get(user_id)
+    user_sessions[user_id] = session
+    if spool:
+        spool.track(session['image_path'])
+        if previous and previous['image_path'] != session['image_path']:
+            spool.release(previous['image_path'])
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     logger.info("Команда /start от user_id=%s", update.effective_user.id if update.effective_user else "?")
@@ -103,16 +146,16 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         file = await context.bot.get_file(photo.file_id)
-        temp_path = temp_dir / f"{user_id}_{photo.file_id}.jpg"
+        temp_path = download_path(user_id, photo.file_id, '.jpg')
         
         await file.download_to_drive(temp_path)
         image = Image.open(temp_path)
         
-        user_sessions[user_id] = {
+        store_session(user_id, {
             'image_path': str(temp_path),
             'image': image,
             'file_id': photo.file_id
-        }
+        })
         
         keyboard = [
             [InlineKeyboardButton(
@@ -144,16 +187,19 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         file = await context.bot.get_file(document.file_id)
-        temp_path = temp_dir / f"{user_id}_{document.file_id}.{document.file_name.split('.')[-1] if document.file_name else 'jpg'}"
+        # mime_type у Document может отсутствовать - тогда расширение берем из имени файла
+        extension = (mimetypes.guess_extension(document.mime_type) if document.mime_type else None) or (
+            '.' + document.file_name.split('.')[-1] if document.file_name and '.' in document.file_name else '.jpg')
+        temp_path = download_path(user_id, document.file_id, extension)
         
         await file.download_to_drive(temp_path)
         image = Image.open(temp_path)
         
-        user_sessions[user_id] = {
+        store_session(user_id, {
             'image_path': str(temp_path),
             'image': image,
             'file_id': document.file_id
-        }
+        })
         
         keyboard = [
             [InlineKeyboardButton(
@@ -194,6 +240,9 @@ def main():
         logger.error("❌ python-telegram-bot не установлен!")
         sys.exit(1)
     
+    if spool:
+        spool.start()
+    
     logger.info("🤖 Бот запущен...")
     logger.info(f"🌐 Web App URL: {WEB_APP_URL}")
     
@@ -11,20 +11,411 @@ import json
 import base64
 import io
 import re
+import math
 import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
-from collections import Counter
+import gc
+import hashlib
+import sqlite3
+import zipfile
+import tempfile
+import uuid
+import signal
+import struct
+import threading
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
+import heapq
+import bisect
+import random
+import itertools
+from array import array
+from collections import Counter, OrderedDict
 
 # Импорты без macOS-специфичных путей
-from PIL import Image, ImageFilter, ImageChops
+from PIL import Image, ImageFilter, ImageChops, ImageMath
 
 # Локальное хранилище сессий (бот и веб-сервер в разных контейнерах Railway — общая память недоступна).
 # Импорт TELEGRAM_BOT_SERVER убран: он тянет python-telegram-bot и мог вызывать 502 при старте.
-user_sessions = {}
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 6 * 3600))
+SESSION_MEMORY_LIMIT = int(float(os.environ.get('SESSION_MEMORY_LIMIT_MB', 1024)) * 1024 * 1024)
+RESULT_TTL = float(os.environ.get('RESULT_TTL', 3600))
+RESULT_MEMORY_LIMIT = int(float(os.environ.get('RESULT_MEMORY_LIMIT_MB', 256)) * 1024 * 1024)
+
+
+class SessionStore:
+    """Словарь с TTL, общим лимитом памяти и LRU-вытеснением по приблизительному размеру.
+    
+    sizeof(entry) - сколько байт держит запись. shrink(entry) освобождает тяжелые данные
+    на месте, а restore(entry) восстанавливает их при следующем обращении (False - восстановить
+    нельзя, запись удаляется). Без shrink вытеснение удаляет запись целиком.
+    on_remove(entry) вызывается, когда запись удалена насовсем (истекла, заменена, удалена).
+    """
+    
+    def __init__(self, ttl, max_bytes, sizeof, shrink=None, restore=None, on_remove=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._shrink = shrink
+        self._restore = restore
+        self._on_remove = on_remove
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'restored': 0}
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key)[0]
+        if self._on_remove is not None:
+            self._on_remove(entry)
+        return entry
+    
+    def _expire(self, now):
+        expired = [key for key, (_, touched) in self._entries.items() if now - touched > self.ttl]
+        for key in expired:
+            self._remove(key)
+        self.stats['expired'] += len(expired)
+    
+    def _enforce_budget(self, keep):
+        """Освобождает самые давно использованные записи, пока не уложимся в лимит"""
+        sizes = {key: self._sizeof(entry) for key, (entry, _) in self._entries.items()}
+        total = sum(sizes.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep or not sizes[key]:
+                continue
+            entry = self._entries[key][0]
+            if self._shrink is not None:
+                self._shrink(entry)
+            else:
+                self._remove(key)
+            total -= sizes[key]
+            self.stats['evicted'] += 1
+    
+    def get(self, key, default=None):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            item = self._entries.get(key)
+            if item is None:
+                self.stats['misses'] += 1
+                return default
+            entry = item[0]
+            if self._restore is not None and not self._sizeof(entry):
+                if not self._restore(entry):
+                    self._remove(key)
+                    self.stats['misses'] += 1
+                    return default
+                self.stats['restored'] += 1
+            self.stats['hits'] += 1
+            self._entries[key] = (entry, now)
+            self._entries.move_to_end(key)
+            self._enforce_budget(key)
+            return entry
+    
+    def __setitem__(self, key, entry):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            if key in self._entries and self._entries[key][0] is not entry:
+                self._remove(key)
+            self._entries[key] = (entry, now)
+            self._entries.move_to_end(key)
+            self._enforce_budget(key)
+    
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+    
+    def __contains__(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            return item is not None and time.time() - item[1] <= self.ttl
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._remove(key) if key in self._entries else default
+    
+    def remove_if(self, predicate):
+        """Удаляет насовсем записи, для которых predicate(entry) истинно -> сколько удалено"""
+        with self._lock:
+            keys = [key for key, (entry, _) in self._entries.items() if predicate(entry)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+    
+    def values(self):
+        """Снимок записей (без продления TTL)"""
+        with self._lock:
+            return [entry for entry, _ in self._entries.values()]
+    
+    def snapshot(self):
+        with self._lock:
+            self._expire(time.time())
+            held = sum(self._sizeof(entry) for entry, _ in self._entries.values())
+            return {**self.stats, 'entries': len(self._entries), 'bytes': held, 'max_bytes': self.max_bytes}
+
+
+# ============================================================================
+# Каталог временных файлов (загрузки веб-приложения, скачивания бота): лимит объема,
+# лимит возраста, фоновая очистка от старых к новым и сбор сирот при старте
+# ============================================================================
+
+SPOOL_DIR = os.environ.get('SPOOL_DIR') or os.path.join(tempfile.gettempdir(), 'telegram_print_extractor')
+SPOOL_MAX_BYTES = int(float(os.environ.get('SPOOL_MAX_MB', 2048)) * 1024 * 1024)
+SPOOL_MAX_AGE = float(os.environ.get('SPOOL_MAX_AGE', SESSION_TTL))
+SPOOL_SWEEP_INTERVAL = float(os.environ.get('SPOOL_SWEEP_INTERVAL', 300))
+
+# Расширения по формату, определенному Pillow по заголовку файла
+SPOOL_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp', 'BMP': '.bmp', 'TIFF': '.tif'}
+
+
+class TempSpool:
+    """Управляемый каталог временных файлов одного процесса.
+    
+    Файлы процесса начинаются с prefix: при старте все такие файлы - сироты прошлого
+    запуска и удаляются; чужие файлы удаляются только по возрасту и лимиту объема.
+    
+    in_use() - пути файлов живых сессий: их очистка не удаляет (срок сессии считается от
+    последнего обращения, а возраст файла - от загрузки). Место сверх лимита объема под ними
+    освобождает evict(path) - удаление сессии с этим файлом (файл уходит через release).
+    """
+    
+    def __init__(self, prefix, directory=SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES, max_age=SPOOL_MAX_AGE,
+                 sweep_interval=SPOOL_SWEEP_INTERVAL, in_use=None, evict=None):
+        self.prefix = prefix
+        self.in_use = in_use
+        self.evict = evict
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {'written': 0, 'released': 0, 'swept': 0, 'swept_bytes': 0, 'evicted': 0}
+    
+    def start(self):
+        """Сбор сирот и запуск фоновой очистки"""
+        os.makedirs(self.directory, exist_ok=True)
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.startswith(self.prefix):
+                self._unlink(entry.path)
+        self.sweep()
+        if self._thread is None and self.sweep_interval > 0:
+            self._thread = threading.Thread(target=self._sweep_loop, name='spool-sweeper', daemon=True)
+            self._thread.start()
+    
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except OSError as e:
+                print(f"⚠️ Очистка временных файлов: {e}")
+    
+    def reserve(self, extension):
+        """Путь для нового файла (для загрузчиков, которые пишут сами)"""
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"{self.prefix}{uuid.uuid4().hex}{extension}")
+    
+    def write(self, data):
+        """Сохраняет байты изображения с настоящим расширением и возвращает путь"""
+        try:
+            extension = SPOOL_EXTENSIONS.get(Image.open(io.BytesIO(data)).format, '.img')
+        except Exception:
+            extension = '.img'
+        path = self.reserve(extension)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.track(path)
+        return path
+    
+    def track(self, path):
+        """Учитывает записанный файл; при превышении лимита - внеочередная очистка"""
+        with self._lock:
+            self._bytes += os.path.getsize(path)
+            self.stats['written'] += 1
+            over = self._bytes > self.max_bytes
+        if over:
+            self.sweep()
+    
+    def release(self, path):
+        """Файл больше не нужен (сессия удалена или заменена)"""
+        if path and os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory):
+            if self._unlink(path):
+                self.stats['released'] += 1
+    
+    def _unlink(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.unlink(path)
+        except OSError:
+            return False
+        with self._lock:
+            self._bytes = max(0, self._bytes - size)
+        return True
+    
+    def sweep(self):
+        """Удаляет файлы старше max_age, затем самые старые, пока объем не уложится в лимит.
+        
+        Файлы живых сессий не удаляются по возрасту, а сверх лимита - вытесняются их сессии.
+        """
+        now = time.time()
+        live = self.in_use() if self.in_use is not None else set()
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            if path in live:
+                if total <= self.max_bytes or self.evict is None or not self.evict(path):
+                    continue
+                self.stats['evicted'] += 1
+            elif self._unlink(path):
+                self.stats['swept'] += 1
+                self.stats['swept_bytes'] += size
+            total -= size
+        with self._lock:
+            self._bytes = total
+    
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+def _image_bytes(image):
+    if image is None:
+        return 0
+    width, height = image.size
+    return width * height * {'1': 1, 'L': 1, 'P': 1, 'I': 4, 'F': 4, 'I;16': 2}.get(image.mode, len(image.getbands()))
+
+
+def _session_bytes(session):
+    """Приблизительный объем декодированных данных сессии"""
+    size = _image_bytes(session.get('image'))
+    analysis = session.get('analysis')
+    if analysis:
+        size += sum(_image_bytes(analysis[key]) for key in ('rgba', 'gray', 'edges'))
+        index = analysis.get('border_index')
+        if index:
+            size += sum(len(cell) * cell.itemsize for row in index['prefix'] for cell in row)
+    if 'display' in session:
+        size += len(session['display'][0])
+    if 'vision_payload' in session:
+        size += len(session['vision_payload'][1])
+    return size
+
+
+def _shrink_session(session):
+    """Отпускаем декодированные данные; исходный файл остается на диске"""
+    for key in ('image', 'analysis', 'display', 'vision_payload'):
+        session.pop(key, None)
+
+
+def session_image(session):
+    """Изображение сессии; если его вытеснили из памяти - заново из временного файла"""
+    image = session.get('image')
+    if image is None:
+        image = session['image'] = Image.open(session['image_path'])
+    return image
+
+
+def session_analysis(session):
+    """Анализ изображения сессии (считается по требованию).
+    
+    Для больших изображений (от BG_STREAMING_MIN_PIXELS) - None: анализ держал бы в памяти
+    несколько полноразмерных растров, такие кропы считает потоковый движок.
+    """
+    analysis = session.get('analysis')
+    if analysis is None:
+        image = session_image(session)
+        if image.size[0] * image.size[1] >= BG_STREAMING_MIN_PIXELS:
+            return None
+        analysis = session['analysis'] = analyze_image(image)
+    return analysis
+
+
+def _restore_session(session):
+    """Восстановление после вытеснения (анализ пересчитается по требованию)"""
+    path = session.get('image_path')
+    if not path or not os.path.exists(path):
+        return False
+    session_image(session)
+    return True
+
+
+def _drop_session(session):
+    """Сессия удалена насовсем - ее временный файл тоже больше не нужен"""
+    spool.release(session.get('image_path'))
+
+
+user_sessions = SessionStore(SESSION_TTL, SESSION_MEMORY_LIMIT, _session_bytes, _shrink_session,
+                             _restore_session, _drop_session)
+
+
+def _live_session_files():
+    """Временные файлы, на которые ссылаются живые сессии"""
+    return {session.get('image_path') for session in user_sessions.values()}
+
+
+def _evict_session_file(path):
+    """Место в каталоге нужно под новые файлы: сессия с этим файлом удаляется (файл - в _drop_session)"""
+    return user_sessions.remove_if(lambda session: session.get('image_path') == path) > 0
+
+
+spool = TempSpool('web_', in_use=_live_session_files, evict=_evict_session_file)
+
+
 def get_user_image(user_id):
     return user_sessions.get(user_id)
 
+
+def make_etag(data):
+    """Сильный ETag по содержимому"""
+    return '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+
+
+# Форматы, которые браузер покажет без перекодирования
+BROWSER_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+
+
+def session_image_payload(session, raw_data=None):
+    """(байты, MIME, ETag) для /image/<session>.
+    
+    Исходный файл отдается как есть; PNG кодируется (один раз) только для форматов,
+    которые браузер не покажет, и для фото с EXIF-поворотом - браузер повернул бы их,
+    и координаты выделения разошлись бы с изображением на сервере.
+    """
+    if 'display' not in session:
+        image = session_image(session)
+        orientation = image.getexif().get(0x0112, 1)
+        if image.format in BROWSER_IMAGE_FORMATS and orientation == 1:
+            if raw_data is None:
+                with open(session['image_path'], 'rb') as f:
+                    raw_data = f.read()
+            data, mime = raw_data, Image.MIME[image.format]
+        else:
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            data, mime = buffer.getvalue(), 'image/png'
+        session['display'] = (data, mime, make_etag(data))
+    return session['display']
+
 # Проверяем наличие OpenAI
 HAS_OPENAI = False
 try:
@@ -35,9 +426,37 @@ except ImportError:
 
 OPENAI_API_KEY = None
 
+# numpy необязателен: с ним 3D-таблицу цветов можно применять индексированием массива (BG_COLOR_LUT)
+HAS_NUMPY = False
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# Реестр движков удаления фона (выбор по имени и 'auto') и операции с масками, общие с ВЕБ_ВЕРСИЯ
+# (серии строк, очистка от островков и дыр). background_engines.py - обязательная часть сервера
+# (копируется в образ Docker рядом с ним), зависимостей кроме Pillow у него нет
+from background_engines import (BackgroundEngine, register_engine, get_engine, calibrate,
+                                BG_DESPECKLE_ISLAND, BG_DESPECKLE_HOLE, mask_runs, paint_runs, despeckle_mask)
+
+# Движок удаления фона: 'auto' (по умолчанию - самый быстрый по калибровке при запуске),
+# 'pillow' (C-операции Pillow), 'pyramid' (грубая маска + уточнение у границ, для больших фото),
+# 'floodfill' (фон только связанный с краями кропа), 'python' (эталонный цикл) или любой другой движок реестра
+BG_ENGINE = os.environ.get('BG_ENGINE', 'auto').strip().lower()
+# Движки, которые remove_background_smart выполняет сам, без реестра
+SMART_ENGINES = ('pillow', 'pyramid', 'python', 'floodfill')
+# Калибровать ли движки при запуске (для 'auto'); без калибровки - порядок по умолчанию
+BG_CALIBRATE = os.environ.get('BG_CALIBRATE', '1').strip().lower() not in ('0', 'false', 'no')
+# Палитра фона: 'sampled' (выборка краевой полосы, кластеры квантованной гистограммы),
+# 'histogram' (интегральные гистограммы, при ручном выборе) или 'exact' (точные цвета, как Counter)
+BG_PALETTE = os.environ.get('BG_PALETTE', 'sampled').strip().lower()
+
 def load_openai_key():
-    """Загрузка API ключа OpenAI"""
+    """Загрузка API ключа OpenAI (читается один раз за процесс)"""
     global OPENAI_API_KEY
+    if OPENAI_API_KEY:
+        return True
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
     
     key_file = os.path.expanduser('~/.openai_api_key')
@@ -50,8 +469,207 @@ def load_openai_key():
     
     return OPENAI_API_KEY is not None
 
-def extract_with_ai(image_path, user_prompt):
-    """Извлечение объекта с помощью OpenAI Vision API"""
+# Клиент OpenAI один на процесс: соединения переиспользуются между запросами.
+# OPENAI_BASE_URL позволяет направить запросы на локальный сервер-заглушку для нагрузочных тестов.
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 5))
+OPENAI_READ_TIMEOUT = float(os.environ.get('OPENAI_READ_TIMEOUT', 60))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 3))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', 4))
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+_openai_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+
+
+class ComputeBusyError(Exception):
+    """Задачу нельзя принять сейчас - клиенту стоит повторить запрос позже"""
+    
+    def __init__(self, message, status=503, retry_after=2):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AIBusyError(ComputeBusyError):
+    """Все слоты запросов к ИИ заняты дольше таймаута (503 с Retry-After, как перегрузка пула)"""
+
+
+def get_openai_client():
+    """Общий клиент с таймаутами и повторами.
+    
+    Повторы с экспоненциальной задержкой на 429/5xx и сетевых ошибках делает сам SDK (max_retries).
+    """
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            import httpx
+            _openai_client = openai.OpenAI(
+                api_key=OPENAI_API_KEY,
+                base_url=OPENAI_BASE_URL,
+                timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+                max_retries=OPENAI_MAX_RETRIES,
+            )
+        return _openai_client
+
+
+def create_vision_completion(**kwargs):
+    """chat.completions.create не более чем в OPENAI_MAX_CONCURRENCY потоках одновременно"""
+    if not _openai_slots.acquire(timeout=OPENAI_CONNECT_TIMEOUT):
+        raise AIBusyError("ИИ сейчас перегружен, повторите через несколько секунд",
+                          retry_after=max(1, int(OPENAI_CONNECT_TIMEOUT)))
+    try:
+        return get_openai_client().chat.completions.create(**kwargs)
+    finally:
+        _openai_slots.release()
+
+
+# Модели нужен только bounding box - полное разрешение лишь замедляет запрос и стоит токенов
+VISION_MAX_SIDE = int(os.environ.get('VISION_MAX_SIDE', 1024))
+VISION_JPEG_QUALITY = int(os.environ.get('VISION_JPEG_QUALITY', 85))
+
+
+def build_vision_payload(image_path):
+    """Уменьшенная (до VISION_MAX_SIDE по длинной стороне) JPEG-копия для Vision API.
+    
+    Возвращает (base64, (ширина, высота) копии, (ширина, высота) оригинала).
+    """
+    image = Image.open(image_path)
+    original_size = image.size
+    # JPEG декодируется сразу в уменьшенном масштабе (DCT), без полного 12 МП буфера
+    image.draft('RGB', (VISION_MAX_SIDE, VISION_MAX_SIDE))
+    
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+        rgb_image.paste(image, mask=image.split()[3])
+        image = rgb_image
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+    
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=VISION_JPEG_QUALITY)
+    return base64.b64encode(buffer.getvalue()).decode(), image.size, original_size
+
+
+# Кэш ответов ИИ: повтор того же запроса к тому же фото не ходит в сеть.
+# Файл лежит в подкаталоге спула - очистка спула смотрит только файлы верхнего уровня.
+AI_CACHE_PATH = os.environ.get('AI_CACHE_PATH') or os.path.join(SPOOL_DIR, 'cache', 'ai_boxes.sqlite3')
+AI_CACHE_TTL = float(os.environ.get('AI_CACHE_TTL', 7 * 24 * 3600))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', 10000))
+
+# Слова, не меняющие смысл запроса: "извлеки, пожалуйста, логотип" == "логотип"
+PROMPT_STOP_WORDS = {
+    'извлеки', 'извлечь', 'вырежи', 'вырезать', 'найди', 'выдели', 'пожалуйста', 'мне', 'и', 'в', 'на', 'с', 'со',
+    'extract', 'cut', 'find', 'please', 'the', 'a', 'an', 'me', 'of', 'from', 'and',
+}
+
+
+def normalize_prompt(prompt):
+    """Нижний регистр, без пунктуации и стоп-слов, пробелы схлопнуты"""
+    words = re.findall(r'\w+', prompt.lower())
+    return ' '.join(word for word in words if word not in PROMPT_STOP_WORDS)
+
+
+def session_content_hash(session):
+    """SHA-256 содержимого загруженного файла (считается один раз на сессию)"""
+    if 'sha256' not in session:
+        digest = hashlib.sha256()
+        with open(session['image_path'], 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        session['sha256'] = digest.hexdigest()
+    return session['sha256']
+
+
+class AIBoxCache:
+    """SQLite-кэш координат от ИИ с TTL и LRU-вытеснением по времени последнего использования"""
+    
+    def __init__(self, path=AI_CACHE_PATH, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._db = None
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'errors': 0}
+    
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS boxes (
+                key TEXT PRIMARY KEY, x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER,
+                created REAL, used REAL)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS boxes_used ON boxes (used)')
+        return self._db
+    
+    @staticmethod
+    def key(content_hash, prompt):
+        return content_hash + ':' + normalize_prompt(prompt)
+    
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            try:
+                db = self._connect()
+                row = db.execute('SELECT x1, y1, x2, y2 FROM boxes WHERE key = ? AND created > ?',
+                                 (key, now - self.ttl)).fetchone()
+                if row:
+                    db.execute('UPDATE boxes SET used = ? WHERE key = ?', (now, key))
+                    db.commit()
+            except sqlite3.Error:
+                # Кэш - только ускорение: при проблемах с диском просто идем в ИИ
+                self.stats['errors'] += 1
+                row = None
+            self.stats['hits' if row else 'misses'] += 1
+        return dict(zip(('x1', 'y1', 'x2', 'y2'), row)) if row else None
+    
+    def put(self, key, coords):
+        now = time.time()
+        with self._lock:
+            try:
+                db = self._connect()
+                db.execute('INSERT OR REPLACE INTO boxes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (key, coords['x1'], coords['y1'], coords['x2'], coords['y2'], now, now))
+                self.stats['stored'] += 1
+                self._puts += 1
+                # Чистка раз в 100 записей: истекшие и самые давно использованные сверх лимита
+                if self._puts % 100 == 1:
+                    removed = db.execute('DELETE FROM boxes WHERE created <= ?', (now - self.ttl,)).rowcount
+                    removed += db.execute('''DELETE FROM boxes WHERE key IN (
+                        SELECT key FROM boxes ORDER BY used DESC LIMIT -1 OFFSET ?)''',
+                                          (self.max_entries,)).rowcount
+                    self.stats['evicted'] += removed
+                db.commit()
+            except sqlite3.Error:
+                self.stats['errors'] += 1
+    
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+ai_box_cache = AIBoxCache()
+
+
+def extract_with_ai(image_path, user_prompt, session=None):
+    """Извлечение объекта с помощью OpenAI Vision API
+    
+    session - сессия пользователя: уменьшенная копия для API строится один раз и хранится в ней,
+    а ответы кэшируются по содержимому файла и нормализованному запросу.
+    """
+    cache_key = None
+    if session is not None:
+        try:
+            cache_key = AIBoxCache.key(session_content_hash(session), user_prompt)
+            cached = ai_box_cache.get(cache_key)
+            if cached:
+                return cached, None
+        except OSError:
+            cache_key = None
+    
     if not HAS_OPENAI:
         return None, "OpenAI не установлен"
     
@@ -59,25 +677,14 @@ def extract_with_ai(image_path, user_prompt):
         return None, "OpenAI API ключ не найден"
     
     try:
-        image = Image.open(image_path)
-        
-        buffer = io.BytesIO()
-        if image.mode == 'RGBA':
-            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-            rgb_image.paste(image, mask=image.split()[3])
-            rgb_image.save(buffer, format='PNG')
-        else:
-            image.save(buffer, format='PNG')
-        
-        image_base64 = base64.b64encode(buffer.getvalue()).decode()
-        img_width, img_height = image.size
-        
         prompt_lower = user_prompt.lower()
         is_entire_image = any(word in prompt_lower for word in ['весь', 'целиком', 'entire', 'whole', 'все', 
                                                                 'весь текст', 'весь изображение', 'целое изображение',
                                                                 'со всего', 'from entire', 'from whole'])
         
         if is_entire_image:
+            # Размер читается из заголовка файла, без декодирования
+            img_width, img_height = Image.open(image_path).size
             return {
                 'x1': 0,
                 'y1': 0,
@@ -85,6 +692,14 @@ def extract_with_ai(image_path, user_prompt):
                 'y2': img_height
             }, None
         
+        if session is not None and session.get('vision_payload') and session['vision_payload'][0] == image_path:
+            _, image_base64, (vision_width, vision_height), (img_width, img_height) = session['vision_payload']
+        else:
+            image_base64, (vision_width, vision_height), (img_width, img_height) = build_vision_payload(image_path)
+            if session is not None:
+                session['vision_payload'] = (image_path, image_base64, (vision_width, vision_height),
+                                             (img_width, img_height))
+        
         system_prompt = """You are an expert image segmentation assistant. Your task is to identify the COMPLETE bounding box of the content described by the user.
 
 CRITICAL INSTRUCTIONS:
@@ -107,7 +722,7 @@ Where:
 - Coordinates must be within image bounds (0 to width/height)
 - IMPORTANT: Make the box MUCH LARGER than the content - add 15-20 pixel margin on ALL sides
 
-Remember: BETTER TO INCLUDE TOO MUCH than to crop anything! If unsure, make the box larger!""".format(img_width, img_height)
+Remember: BETTER TO INCLUDE TOO MUCH than to crop anything! If unsure, make the box larger!""".format(vision_width, vision_height)
         
         prompt_lower = user_prompt.lower()
         is_text_extraction = any(word in prompt_lower for word in ['текст', 'надпись', 'text', 'inscription', 
@@ -116,7 +731,7 @@ Remember: BETTER TO INCLUDE TOO MUCH than to crop anything! If unsure, make the
         if is_text_extraction:
             user_message = f"""Find the COMPLETE bounding box for: {user_prompt}
 
-Image dimensions: {img_width} x {img_height} pixels.
+Image dimensions: {vision_width} x {vision_height} pixels.
 
 SPECIAL INSTRUCTIONS FOR TEXT EXTRACTION:
 - Include ALL text/inscriptions - every word, every letter, from top to bottom, left to right
@@ -127,19 +742,17 @@ SPECIAL INSTRUCTIONS FOR TEXT EXTRACTION:
         else:
             user_message = f"""Find the COMPLETE bounding box for: {user_prompt}
 
-Image dimensions: {img_width} x {img_height} pixels.
+Image dimensions: {vision_width} x {vision_height} pixels.
 
 Return the bounding box coordinates as JSON: {{"x1": number, "y1": number, "x2": number, "y2": number}}"""
         
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        
-        response = client.chat.completions.create(
+        response = create_vision_completion(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": [
                     {"type": "text", "text": user_message},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
                 ]}
             ],
             max_tokens=200
@@ -152,11 +765,15 @@ Return the bounding box coordinates as JSON: {{"x1": number, "y1": number, "x2":
         if json_match:
             coords = json.loads(json_match.group())
             
-            # Нормализуем координаты
-            x1 = max(0, min(int(coords.get('x1', 0)), img_width))
-            y1 = max(0, min(int(coords.get('y1', 0)), img_height))
-            x2 = max(x1 + 1, min(int(coords.get('x2', img_width)), img_width))
-            y2 = max(y1 + 1, min(int(coords.get('y2', img_height)), img_height))
+            # Координаты модели - в пикселях уменьшенной копии; переводим в оригинал
+            scale_x = img_width / vision_width
+            scale_y = img_height / vision_height
+            
+            # Нормализуем координаты (x1/y1 округляем вниз, x2/y2 вверх - чтобы не обрезать)
+            x1 = max(0, min(int(float(coords.get('x1', 0)) * scale_x), img_width))
+            y1 = max(0, min(int(float(coords.get('y1', 0)) * scale_y), img_height))
+            x2 = max(x1 + 1, min(math.ceil(float(coords.get('x2', vision_width)) * scale_x), img_width))
+            y2 = max(y1 + 1, min(math.ceil(float(coords.get('y2', vision_height)) * scale_y), img_height))
             
             # Автоматически расширяем область на 10-15% чтобы не обрезать
             width = x2 - x1
@@ -175,15 +792,21 @@ Return the bounding box coordinates as JSON: {{"x1": number, "y1": number, "x2":
             if area < total_area * 0.1 and is_entire_image:
                 x1, y1, x2, y2 = 0, 0, img_width, img_height
             
-            return {
+            coords = {
                 'x1': x1,
                 'y1': y1,
                 'x2': x2,
                 'y2': y2
-            }, None
+            }
+            if cache_key:
+                ai_box_cache.put(cache_key, coords)
+            return coords, None
         else:
             return None, "Не удалось распарсить ответ ИИ"
             
+    except AIBusyError:
+        # Перегрузка - не ошибка ИИ: обработчик ответит 503 с Retry-After
+        raise
     except Exception as e:
         return None, f"Ошибка ИИ: {str(e)}"
 
@@ -283,171 +906,2108 @@ def detect_edges(image):
     
     return edge_pixels_list
 
-def remove_background_smart(image, ai_guidance=None, user_prompt="", original_image=None, selected_region=None):
-    """Улучшенное удаление фона"""
+TEXT_PROMPT_WORDS = ['текст', 'надпись', 'text', 'inscription', 'только текст', 'only text', 'извлеки текст']
+AGGRESSIVE_PROMPT_WORDS = ['убери фон', 'удали фон', 'remove background', 'убери задний', 'удали задний',
+                           'серый фон', 'gray background']
+
+
+def is_text_prompt(user_prompt):
+    """Просят извлечь текст - работает remove_background_for_text"""
+    prompt_lower = user_prompt.lower() if user_prompt else ""
+    return any(word in prompt_lower for word in TEXT_PROMPT_WORDS)
+
+
+def is_aggressive_prompt(user_prompt):
+    """Просят убрать фон целиком - пороги у краев кропа строже"""
+    prompt_lower = user_prompt.lower() if user_prompt else ""
+    return any(word in prompt_lower for word in AGGRESSIVE_PROMPT_WORDS)
+
+
+def remove_background_smart(image, ai_guidance=None, user_prompt="", original_image=None, selected_region=None,
+                            engine=None, analysis=None, hints=None):
+    """Улучшенное удаление фона
+    
+    engine: 'pillow' - C-операции Pillow, 'python' - эталонный попиксельный цикл (маска у них
+    одинаковая), 'pyramid' - уточнение маски только у границ (см. remove_background_smart_pyramid),
+    'floodfill' - фон только связанный с краями кропа (см. remove_background_floodfill).
+    По умолчанию берется BG_ENGINE. Большие кропы 'pillow' считает полосами в пуле процессов
+    (см. remove_background_smart_parallel), результат тот же.
+    analysis: результат analyze_image для original_image (кроп = selected_region) -
+    тогда карта краев и палитра фона не пересчитываются, а нарезаются из него.
+    hints: готовые подсказки для кропа ('edges' - карта краев, 'bg_colors' - палитра),
+    см. extraction_hints; так работают процессы-воркеры, у которых нет анализа.
+    """
     width, height = image.size
     
     if image.mode != 'RGBA':
         image = image.convert('RGBA')
     
+    if is_text_prompt(user_prompt):
+        return remove_background_for_text(image)
+    
+    if hints is None and _analysis_covers(analysis, selected_region):
+        hints = extraction_hints(analysis, selected_region)
+    hints = hints or {}
+    
+    engine = (engine or BG_ENGINE).lower()
+    if engine not in SMART_ENGINES:
+        # 'auto' и прочие движки реестра выбираются выше (run_extraction_job), здесь - алгоритм smart
+        engine = 'pillow'
+    if engine in ('pillow', 'pyramid', 'floodfill') and width >= 3 and height >= 3:
+        aggressive_mode = is_aggressive_prompt(user_prompt)
+        if engine == 'floodfill':
+            return remove_background_floodfill(image, aggressive_mode, original_image, selected_region, hints)
+        if engine == 'pyramid':
+            return remove_background_smart_pyramid(image, aggressive_mode, original_image, selected_region, hints)
+        return remove_background_smart_parallel(image, aggressive_mode, original_image, selected_region, hints)
+    
     pixels = list(image.getdata())
     
-    prompt_lower = user_prompt.lower() if user_prompt else ""
-    is_text_extraction = any(word in prompt_lower for word in ['текст', 'надпись', 'text', 'inscription', 
-                                                                'только текст', 'only text', 'извлеки текст'])
+    # Индекс основного цвета фона, если его задает палитра (иначе - по числу близких пикселей)
+    primary = None
+    if 'edges' in hints and 'bg_colors' in hints:
+        edge_pixels_list = list(hints['edges'].getdata())
+        bg_colors, primary = hints['bg_colors'], hints.get('primary')
+    elif hints.get('bg_colors') or BG_PALETTE not in ('histogram', 'exact'):
+        # Палитра по выборке (и готовая из подсказок) - та же, что у Pillow-движка:
+        # попиксельного эталона у выборки нет, а маски движков должны совпадать
+        edge_pixels_list = detect_edges(image)
+        bg_colors, primary = _pillow_palette(image.convert('RGB'), original_image, selected_region, hints)
+    else:
+        edge_pixels_list = detect_edges(image)
+        
+        edge_colors = []
+        edge_zone = 0.15
+        
+        if original_image is not None and selected_region is not None:
+            orig_width, orig_height = original_image.size
+            if original_image.mode != 'RGBA':
+                original_image = original_image.convert('RGBA')
+            orig_pixels = list(original_image.getdata())
+            x1, y1, x2, y2 = selected_region
+            
+            edge_width = int(orig_width * edge_zone)
+            edge_height = int(orig_height * edge_zone)
+            
+            for y in range(orig_height):
+                for x in range(orig_width):
+                    if (x < edge_width or x >= orig_width - edge_width or 
+                        y < edge_height or y >= orig_height - edge_height):
+                        if not (x1 <= x <= x2 and y1 <= y <= y2):
+                            edge_colors.append(orig_pixels[y * orig_width + x])
+        else:
+            edge_width = int(width * edge_zone)
+            edge_height = int(height * edge_zone)
+            
+            for y in range(height):
+                for x in range(width):
+                    if (x < edge_width or x >= width - edge_width or 
+                        y < edge_height or y >= height - edge_height):
+                        edge_colors.append(pixels[y * width + x])
+        
+        edge_colors_rgb = [(r, g, b) for r, g, b, a in edge_colors]
+        if edge_colors_rgb:
+            most_common_colors = Counter(edge_colors_rgb).most_common(3)
+            bg_colors = [color for color, count in most_common_colors]
+        else:
+            bg_colors = [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
     
-    if is_text_extraction:
-        return remove_background_for_text(image)
+    aggressive_mode = False
+    if user_prompt:
+        prompt_lower = user_prompt.lower()
+        if any(word in prompt_lower for word in ['убери фон', 'удали фон', 'remove background', 
+                                                  'убери задний', 'удали задний', 'серый фон', 'gray background']):
+            aggressive_mode = True
     
-    edge_pixels_list = detect_edges(image)
+    if primary is not None:
+        primary_bg_color = bg_colors[primary]
+    else:
+        bg_color_variations = []
+        for bg_r, bg_g, bg_b in bg_colors:
+            similar_count = 0
+            for pixel in pixels:
+                r, g, b, _ = pixel
+                dist = ((r - bg_r) ** 2 + (g - bg_g) ** 2 + (b - bg_b) ** 2) ** 0.5
+                if dist < 40:
+                    similar_count += 1
+            bg_color_variations.append((bg_r, bg_g, bg_b, similar_count))
+        
+        bg_color_variations.sort(key=lambda x: x[3], reverse=True)
+        primary_bg_color = bg_color_variations[0][:3] if bg_color_variations else bg_colors[0]
     
-    edge_colors = []
-    edge_zone = 0.15
+    alpha = bytearray(width * height)
     
-    if original_image is not None and selected_region is not None:
-        orig_width, orig_height = original_image.size
-        if original_image.mode != 'RGBA':
-            original_image = original_image.convert('RGBA')
-        orig_pixels = list(original_image.getdata())
-        x1, y1, x2, y2 = selected_region
+    for i, pixel in enumerate(pixels):
+        r, g, b, a = pixel
+        y_pos = i // width
+        x_pos = i % width
         
-        edge_width = int(orig_width * edge_zone)
-        edge_height = int(orig_height * edge_zone)
+        dist_x = min(x_pos, width - x_pos)
+        dist_y = min(y_pos, height - y_pos)
+        dist_to_edge = min(dist_x, dist_y)
         
-        for y in range(orig_height):
-            for x in range(orig_width):
-                if (x < edge_width or x >= orig_width - edge_width or 
-                    y < edge_height or y >= orig_height - edge_height):
-                    if not (x1 <= x <= x2 and y1 <= y <= y2):
-                        edge_colors.append(orig_pixels[y * orig_width + x])
-    else:
-        edge_width = int(width * edge_zone)
-        edge_height = int(height * edge_zone)
+        max_dist = min(width, height) / 2
+        normalized_dist = dist_to_edge / max_dist if max_dist > 0 else 0
         
-        for y in range(height):
-            for x in range(width):
-                if (x < edge_width or x >= width - edge_width or 
-                    y < edge_height or y >= height - edge_height):
-                    edge_colors.append(pixels[y * width + x])
-    
-    edge_colors_rgb = [(r, g, b) for r, g, b, a in edge_colors]
-    if edge_colors_rgb:
-        most_common_colors = Counter(edge_colors_rgb).most_common(3)
-        bg_colors = [color for color, count in most_common_colors]
-    else:
-        bg_colors = [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
+        min_distance = float('inf')
+        for bg_r, bg_g, bg_b in bg_colors:
+            color_distance = ((r - bg_r) ** 2 + (g - bg_g) ** 2 + (b - bg_b) ** 2) ** 0.5
+            min_distance = min(min_distance, color_distance)
+        
+        edge_strength = edge_pixels_list[i] if i < len(edge_pixels_list) else 0
+        
+        if normalized_dist < 0.2:
+            threshold = 40 if aggressive_mode else 35
+        elif normalized_dist < 0.5:
+            base_threshold = 35 if aggressive_mode else 40
+            threshold = base_threshold + (normalized_dist - 0.2) * 10
+        else:
+            threshold = 40 if aggressive_mode else 45
+        
+        if edge_strength > 30:
+            is_background = False
+        elif edge_strength > 15:
+            is_background = False
+        else:
+            is_background = min_distance < threshold
+            
+            if not is_background:
+                distance_to_primary = ((r - primary_bg_color[0]) ** 2 + 
+                                       (g - primary_bg_color[1]) ** 2 + 
+                                       (b - primary_bg_color[2]) ** 2) ** 0.5
+                if distance_to_primary < 30:
+                    is_background = True
+        
+        if is_background:
+            neighbor_colors = []
+            for dy in [-1, 0, 1]:
+                for dx in [-1, 0, 1]:
+                    if dx == 0 and dy == 0:
+                        continue
+                    nx, ny = x_pos + dx, y_pos + dy
+                    if 0 <= nx < width and 0 <= ny < height:
+                        n_idx = ny * width + nx
+                        nr, ng, nb, _ = pixels[n_idx]
+                        n_dist = float('inf')
+                        for bg_r, bg_g, bg_b in bg_colors:
+                            n_color_dist = ((nr - bg_r) ** 2 + (ng - bg_g) ** 2 + (nb - bg_b) ** 2) ** 0.5
+                            n_dist = min(n_dist, n_color_dist)
+                        neighbor_colors.append(n_dist)
+            
+            if neighbor_colors:
+                non_bg_neighbors = sum(1 for d in neighbor_colors if d > 35)
+                if non_bg_neighbors >= len(neighbor_colors) * 0.4:
+                    is_background = False
+        
+        if not is_background:
+            if edge_strength < 15 and r > 240 and g > 240 and b > 240 and abs(r - g) < 15 and abs(g - b) < 15:
+                is_background = True
+            elif edge_strength < 15 and r < 30 and g < 30 and b < 30:
+                is_background = True
+            elif edge_strength < 15 and abs(r - g) < 20 and abs(g - b) < 20 and 140 < (r + g + b) / 3 < 210:
+                is_background = True
+        
+        if not is_background:
+            alpha[i] = 255
+    
+    # Очистка маски от островков и дыр и сборка результата - общие с Pillow-движком
+    return _compose_result(image.convert('RGB'), Image.frombytes('L', (width, height), bytes(alpha)))
+
+# ============================================================================
+# Pillow-движок: та же маска, что и у remove_background_smart, но без Python-циклов
+# по пикселям. Все вычисления - ImageChops, ImageMath, point() и ImageFilter.
+# ============================================================================
+
+# ImageMath.eval переименован в unsafe_eval в Pillow 11; выражения у нас константные
+_imagemath_eval = getattr(ImageMath, 'unsafe_eval', None) or ImageMath.eval
+
+# Сколько "ничьих" в палитре разрешаем разбирать через поиск первого вхождения
+PALETTE_TIE_LIMIT = 32
+
+_NEIGHBOR_KERNEL = ImageFilter.Kernel((3, 3), [1, 1, 1, 1, 0, 1, 1, 1, 1], scale=1)
+_ZERO_LUT = [255] + [0] * 255
+
+
+def _border_band_boxes(width, height, edge_zone=0.15):
+    """Прямоугольники краевой полосы (непересекающиеся), как в цикле сбора edge_colors"""
+    edge_width = int(width * edge_zone)
+    edge_height = int(height * edge_zone)
+    boxes = [
+        (0, 0, width, edge_height),
+        (0, height - edge_height, width, height),
+        (0, edge_height, edge_width, height - edge_height),
+        (width - edge_width, edge_height, width, height - edge_height),
+    ]
+    return [b for b in boxes if b[2] > b[0] and b[3] > b[1]]
+
+
+def _intersect_box(a, b):
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    return box
+
+
+def _region_colors(image, box):
+    region = image.crop(box)
+    if region.mode != 'RGB':
+        region = region.convert('RGB')
+    return region.getcolors(region.size[0] * region.size[1])
+
+
+def _count_colors(image, boxes, excluded=None, band_counts=None):
+    """Гистограмма RGB-цветов в boxes за вычетом прямоугольника excluded.
+    
+    band_counts - заранее посчитанная гистограмма всех boxes (см. analyze_image),
+    тогда вычитается только пересечение с excluded.
+    """
+    counts = dict(band_counts) if band_counts is not None else {}
+    for box in boxes:
+        if band_counts is None:
+            for count, color in _region_colors(image, box):
+                counts[color] = counts.get(color, 0) + count
+        overlap = _intersect_box(box, excluded) if excluded else None
+        if overlap:
+            for count, color in _region_colors(image, overlap):
+                counts[color] -= count
+    return {color: count for color, count in counts.items() if count > 0}
+
+
+def _first_occurrence(rgb_image, region_mask, color):
+    """Индекс первого (в порядке строк) пикселя цвета color внутри region_mask"""
+    width = rgb_image.size[0]
+    if rgb_image.mode != 'RGB':
+        rgb_image = rgb_image.convert('RGB')
+    diff = ImageChops.difference(rgb_image, Image.new('RGB', rgb_image.size, color))
+    equal = diff.point(_ZERO_LUT * 3).split()
+    hit = ImageChops.darker(ImageChops.darker(equal[0], equal[1]), ImageChops.darker(equal[2], region_mask))
+    bbox = hit.getbbox()
+    if not bbox:
+        return float('inf')
+    row_y = bbox[1]
+    row_bbox = hit.crop((0, row_y, width, row_y + 1)).getbbox()
+    return row_y * width + row_bbox[0]
+
+
+def _rank_colors(counts, count, first_occurrences):
+    """Первые count цветов по частоте; равные частоты - по первому вхождению, как у Counter.
+    
+    first_occurrences(colors) -> {цвет: индекс первого пикселя} вызывается только при ничьих.
+    Возвращает None, если ничьих больше PALETTE_TIE_LIMIT.
+    """
+    if not counts:
+        return []
+    cutoff = heapq.nlargest(count, counts.values())[-1]
+    candidates = sorted((item for item in counts.items() if item[1] >= cutoff),
+                        key=lambda item: item[1], reverse=True)
+    tied = Counter(c for _, c in candidates)
+    if all(n == 1 for n in tied.values()):
+        return [color for color, _ in candidates[:count]]
+    if len(candidates) > PALETTE_TIE_LIMIT:
+        return None
+    
+    order = first_occurrences([color for color, n in candidates if tied[n] > 1])
+    candidates.sort(key=lambda item: (-item[1], order.get(item[0], 0)))
+    return [color for color, _ in candidates[:count]]
+
+
+def _most_common_border_colors(rgb_image, excluded=None, count=3, band_counts=None):
+    """Аналог Counter(edge_colors_rgb).most_common(count) для краевой полосы.
+    
+    Counter упорядочивает равные частоты по первому вхождению, поэтому ничьи
+    разбираются через _first_occurrence. Возвращает None, если ничьих слишком
+    много - тогда вызывающий код считает палитру эталонным способом.
+    """
+    width, height = rgb_image.size
+    boxes = _border_band_boxes(width, height)
+    counts = _count_colors(rgb_image, boxes, excluded, band_counts)
+    
+    def first_occurrences(colors):
+        region_mask = Image.new('L', (width, height), 0)
+        for box in boxes:
+            region_mask.paste(255, box)
+        if excluded:
+            clipped = _intersect_box(excluded, (0, 0, width, height))
+            if clipped:
+                region_mask.paste(0, clipped)
+        return {color: _first_occurrence(rgb_image, region_mask, color) for color in colors}
+    
+    return _rank_colors(counts, count, first_occurrences)
+
+
+def _most_common_border_colors_python(rgb_image, excluded=None, count=3):
+    """Эталонный подсчет палитры краевой полосы через Counter (для случаев с массой ничьих)"""
+    width, height = rgb_image.size
+    if rgb_image.mode != 'RGB':
+        rgb_image = rgb_image.convert('RGB')
+    pixels = rgb_image.getdata()
+    edge_colors_rgb = []
+    for x1, y1, x2, y2 in _border_band_boxes(width, height):
+        for y in range(y1, y2):
+            for x in range(x1, x2):
+                if excluded and excluded[0] <= x < excluded[2] and excluded[1] <= y < excluded[3]:
+                    continue
+                edge_colors_rgb.append((y * width + x, pixels[y * width + x]))
+    edge_colors_rgb.sort(key=lambda item: item[0])
+    return [color for color, _ in Counter(c for _, c in edge_colors_rgb).most_common(count)]
+
+
+_SQUARE_LUT = [i * i for i in range(256)]
+
+
+def _color_distance_sq(bands, color):
+    """Квадрат евклидова расстояния до color (режим I)"""
+    squares = {name: ImageChops.difference(band, Image.new('L', band.size, value)).point(_SQUARE_LUT, 'I')
+               for name, band, value in zip('rgb', bands, color)}
+    return _imagemath_eval('r + g + b', **squares)
+
+
+def _threshold_limits(length, max_dist, aggressive_mode):
+    """Предел квадрата цветового расстояния вдоль оси, упакованный вместе с расстоянием до края.
+    
+    Значение = dist * 4096 + limit, где limit - наибольшее целое n с n ** 0.5 < threshold.
+    Тогда min() по двум осям выбирает ближайший край, а & 4095 достает его предел,
+    и сравнение d2 <= limit в точности повторяет min_distance < threshold.
+    """
+    cache = {}
+    packed = []
+    for pos in range(length):
+        dist = min(pos, length - pos)
+        if dist not in cache:
+            normalized_dist = dist / max_dist if max_dist > 0 else 0
+            if normalized_dist < 0.2:
+                threshold = 40 if aggressive_mode else 35
+            elif normalized_dist < 0.5:
+                base_threshold = 35 if aggressive_mode else 40
+                threshold = base_threshold + (normalized_dist - 0.2) * 10
+            else:
+                threshold = 40 if aggressive_mode else 45
+            limit = int(threshold * threshold)
+            while limit ** 0.5 >= threshold:
+                limit -= 1
+            while (limit + 1) ** 0.5 < threshold:
+                limit += 1
+            cache[dist] = dist * 4096 + limit
+        packed.append(cache[dist])
+    return packed
+
+
+# Пределы limit из _threshold_limits лежат в [35 ** 2 - 1, 45 ** 2 - 1]:
+# сравнение d2 <= limit - это d2 < t для t из LIMIT_RANGE
+LIMIT_RANGE = (35 * 35, 45 * 45)
+
+
+def _axis_image(values, size, vertical):
+    """Растягивает строку (или столбец) значений в изображение I размера size"""
+    strip = Image.new('I', (1, len(values)) if vertical else (len(values), 1))
+    strip.putdata(values)
+    return strip.resize(size, Image.NEAREST)
+
+
+def _below(image, bound):
+    """Маска L (255/0): пиксели изображения I строго меньше bound"""
+    return _imagemath_eval('convert(d < %d, "L")' % bound, d=image).point(lambda v: 255 if v else 0)
+
+
+# 3D-таблица цветов: 32 уровня на канал. Для каждой корзины заранее известны границы
+# расстояния до цветов палитры, и проверка "цвет близок к фону" - один поиск в таблице.
+# Пиксели корзин, которые граница не решает, досчитываются точно - результат тот же
+COLOR_LUT_SHIFT = 3
+COLOR_LUT_LEVELS = 256 >> COLOR_LUT_SHIFT
+COLOR_LUT_BOUNDARY = 128
+# Таблица строится ~32 тыс. корзин - на маленьких кропах точный расчет дешевле
+COLOR_LUT_MIN_PIXELS = 512 * 512
+# Сторона плитки, в которой Pillow-путь досчитывает граничные корзины
+COLOR_LUT_TILE = 64
+# Если в граничных корзинах больше этой доли пикселей (оценка по копии, уменьшенной
+# в COLOR_LUT_SAMPLE раз), таблица не окупается
+COLOR_LUT_MAX_BOUNDARY = 0.05
+COLOR_LUT_SAMPLE = 8
+# Как применять таблицу: 'pillow' (point по индексу корзины), 'numpy' (индексирование массива)
+# или 'exact' (без таблицы). По умолчанию 'exact': на типичных кропах 1-6 МП таблица с досчетом
+# граничных корзин не быстрее точного расчета
+BG_COLOR_LUT = os.environ.get('BG_COLOR_LUT', 'exact').strip().lower()
+
+_color_lut_cache = OrderedDict()
+_COLOR_LUT_CACHE_SIZE = 8
+
+
+def _channel_bounds(value):
+    """Для каждого уровня канала: (min, max) квадрата разницы с value по значениям уровня"""
+    step = 1 << COLOR_LUT_SHIFT
+    bounds = []
+    for level in range(COLOR_LUT_LEVELS):
+        first, last = level * step, level * step + step - 1
+        far = max((first - value) ** 2, (last - value) ** 2)
+        near = 0 if first <= value <= last else min((first - value) ** 2, (last - value) ** 2)
+        bounds.append((near, far))
+    return bounds
+
+
+def _lut_level_images():
+    """Корзины таблицы как изображение 1024x32: уровни R, G, B корзины в каждом пикселе"""
+    levels = COLOR_LUT_LEVELS
+    size = (levels * levels, levels)
+    row_g = bytes(x // levels for x in range(levels * levels))
+    row_b = bytes(x % levels for x in range(levels * levels))
+    return (Image.frombytes('L', size, bytes(y for y in range(levels) for _ in range(levels * levels))),
+            Image.frombytes('L', size, row_g * levels),
+            Image.frombytes('L', size, row_b * levels))
+
+
+def _color_lut(bg_colors, tests):
+    """Таблица корзина -> код: бит i - проверка i верна для всей корзины,
+    COLOR_LUT_BOUNDARY - хотя бы одну проверку корзина не решает.
+    
+    tests - [(индексы цветов, lo, hi), ...]: "min d2 по этим цветам < t" для любого t из [lo, hi].
+    Минимум по корзине от min d2 - минимум нижних границ, сверху его ограничивает минимум верхних.
+    Сама таблица считается операциями Pillow над изображением корзин.
+    """
+    key = (tuple(bg_colors), tuple(tests))
+    if key in _color_lut_cache:
+        _color_lut_cache.move_to_end(key)
+        return _color_lut_cache[key]
+    
+    level_images = _lut_level_images()
+    pad = [0] * (256 - COLOR_LUT_LEVELS)
+    lows, highs = [], []
+    for color in bg_colors:
+        bounds = [_channel_bounds(value) for value in color]
+        lows.append(_imagemath_eval('r + g + b', **{
+            name: image.point([near for near, _ in channel] + pad, 'I')
+            for name, image, channel in zip('rgb', level_images, bounds)}))
+        highs.append(_imagemath_eval('r + g + b', **{
+            name: image.point([far for _, far in channel] + pad, 'I')
+            for name, image, channel in zip('rgb', level_images, bounds)}))
+    
+    code = Image.new('I', level_images[0].size, 0)
+    for bit, (colors, lo, hi) in enumerate(tests):
+        low, high = lows[colors[0]], highs[colors[0]]
+        for i in colors[1:]:
+            low = _imagemath_eval('min(a, b)', a=low, b=lows[i])
+            high = _imagemath_eval('min(a, b)', a=high, b=highs[i])
+        code = _imagemath_eval('c | ((h < %d) * %d) | (((h >= %d) & (l < %d)) * %d)'
+                               % (lo, 1 << bit, lo, hi, COLOR_LUT_BOUNDARY), c=code, h=high, l=low)
+    table = code.convert('L').tobytes()
+    
+    _color_lut_cache[key] = table
+    while len(_color_lut_cache) > _COLOR_LUT_CACHE_SIZE:
+        _color_lut_cache.popitem(last=False)
+    return table
+
+
+def _exact_palette_tests(rgb, bg_colors, tests):
+    bands = rgb.split()
+    distances = [_color_distance_sq(bands, color) for color in bg_colors]
+    results = []
+    for colors, lo, hi in tests:
+        result = distances[colors[0]]
+        for i in colors[1:]:
+            result = _imagemath_eval('min(a, b)', a=result, b=distances[i])
+        results.append(_below(result, lo) if lo == hi else result)
+    return results
+
+
+def _lut_codes_numpy(pixels, table):
+    levels = pixels >> COLOR_LUT_SHIFT
+    index = (levels[:, :, 0].astype(np.uint16) << 10) | (levels[:, :, 1].astype(np.uint16) << 5) | levels[:, :, 2]
+    return np.frombuffer(table, dtype=np.uint8)[index]
+
+
+def _numpy_palette_tests(rgb, bg_colors, tests, table):
+    pixels = np.asarray(rgb)
+    codes = _lut_codes_numpy(pixels, table)
+    
+    boundary = codes >= COLOR_LUT_BOUNDARY
+    exact = pixels[boundary].astype(np.int32)
+    distances = [((exact - np.array(color, dtype=np.int32)) ** 2).sum(axis=1) for color in bg_colors]
+    
+    results = []
+    for bit, (colors, lo, hi) in enumerate(tests):
+        inside = [bool(code & (1 << bit)) for code in range(256)]
+        if lo == hi:
+            result = np.array([255 if flag else 0 for flag in inside], dtype=np.uint8)[codes]
+            if len(exact):
+                result[boundary] = np.where(np.min([distances[i] for i in colors], axis=0) < lo, 255, 0)
+            results.append(Image.fromarray(result, 'L'))
+        else:
+            result = np.array([0 if flag else hi for flag in inside], dtype=np.int32)[codes]
+            if len(exact):
+                result[boundary] = np.min([distances[i] for i in colors], axis=0)
+            results.append(Image.fromarray(result, 'I'))
+    return results
+
+
+def _lut_codes_pillow(rgb, table):
+    level_luts = [[(value >> COLOR_LUT_SHIFT) << shift for value in range(256)] for shift in (10, 5, 0)]
+    r, g, b = [band.point(lut, 'I') for band, lut in zip(rgb.split(), level_luts)]
+    return _imagemath_eval('r + g + b', r=r, g=g, b=b).point(list(table) * 2, 'L')
+
+
+def _pillow_palette_tests(rgb, bg_colors, tests, table):
+    width, height = rgb.size
+    codes = _lut_codes_pillow(rgb, table)
+    
+    results = []
+    for bit, (_, lo, hi) in enumerate(tests):
+        inside = [bool(code & (1 << bit)) for code in range(256)]
+        if lo == hi:
+            results.append(codes.point([255 if flag else 0 for flag in inside]))
+        else:
+            results.append(codes.point([0 if flag else hi for flag in inside], 'I'))
+    
+    # Граничные корзины: точный расчет только в плитках, где они есть
+    boundary = codes.point([255 if code & COLOR_LUT_BOUNDARY else 0 for code in range(256)])
+    for top in range(0, height, COLOR_LUT_TILE):
+        for left in range(0, width, COLOR_LUT_TILE):
+            tile_box = (left, top, min(left + COLOR_LUT_TILE, width), min(top + COLOR_LUT_TILE, height))
+            bbox = boundary.crop(tile_box).getbbox()
+            if bbox is None:
+                continue
+            box = (left + bbox[0], top + bbox[1], left + bbox[2], top + bbox[3])
+            mask = boundary.crop(box)
+            for result, exact in zip(results, _exact_palette_tests(rgb.crop(box), bg_colors, tests)):
+                result.paste(exact, box[:2], mask)
+    return results
+
+
+def _boundary_share(rgb, table):
+    """Доля пикселей в граничных корзинах - по уменьшенной копии"""
+    sample = rgb.reduce(COLOR_LUT_SAMPLE) if min(rgb.size) >= COLOR_LUT_SAMPLE else rgb
+    histogram = _lut_codes_pillow(sample, table).histogram()
+    return sum(histogram[COLOR_LUT_BOUNDARY:]) / max(1, sample.size[0] * sample.size[1])
+
+
+def _close_counts(rgb, bg_colors):
+    """Число пикселей, близких (dist < 40) к каждому цвету фона"""
+    tests = [((i,), 1600, 1600) for i in range(len(bg_colors))]
+    return [mask.histogram()[255] for mask in _palette_tests(rgb, bg_colors, tests)]
+
+
+def _palette_tests(rgb, bg_colors, tests):
+    """Проверки близости к палитре: tests - [(индексы цветов в bg_colors, lo, hi), ...].
+    
+    Проверка с lo == hi дает маску L (255 - min d2 по ее цветам < lo), с lo < hi - изображение I
+    квадратов расстояний, точное там, где это важно: любое сравнение d2 < t с lo <= t <= hi
+    дает то же, что и точное расстояние. На больших кропах - через 3D-таблицу цветов
+    (BG_COLOR_LUT), если граничных корзин немного.
+    """
+    bg_colors = [tuple(color) for color in bg_colors]
+    tests = [(tuple(colors), lo, hi) for colors, lo, hi in tests]
+    width, height = rgb.size
+    backend = BG_COLOR_LUT
+    if backend == 'numpy' and not HAS_NUMPY:
+        backend = 'pillow'
+    if backend not in ('numpy', 'pillow') or width * height < COLOR_LUT_MIN_PIXELS or len(tests) > 7:
+        return _exact_palette_tests(rgb, bg_colors, tests)
+    
+    table = _color_lut(bg_colors, tests)
+    if _boundary_share(rgb, table) > COLOR_LUT_MAX_BOUNDARY:
+        # Цвета кропа толпятся у порогов - точный расчет дешевле досчета
+        return _exact_palette_tests(rgb, bg_colors, tests)
+    if backend == 'numpy':
+        return _numpy_palette_tests(rgb, bg_colors, tests, table)
+    return _pillow_palette_tests(rgb, bg_colors, tests, table)
+
+
+def _band_mask(band, test):
+    return band.point(lambda v: 255 if test(v) else 0)
+
+
+def _neutral_colors_mask(rgb):
+    """Белые, черные и серые пиксели, которые попиксельная версия дочищает как фон"""
+    r, g, b = rgb.split()
+    rg_diff = ImageChops.difference(r, g)
+    gb_diff = ImageChops.difference(g, b)
+    
+    white = _band_mask(r, lambda v: v > 240)
+    for mask in (_band_mask(g, lambda v: v > 240), _band_mask(b, lambda v: v > 240),
+                 _band_mask(rg_diff, lambda v: v < 15), _band_mask(gb_diff, lambda v: v < 15)):
+        white = ImageChops.darker(white, mask)
+    
+    black = _band_mask(r, lambda v: v < 30)
+    for mask in (_band_mask(g, lambda v: v < 30), _band_mask(b, lambda v: v < 30)):
+        black = ImageChops.darker(black, mask)
+    
+    # 140 < (r + g + b) / 3 < 210 через матрицу конвертации: r + g + b - 420 > 0 и 630 - (r + g + b) > 0
+    gray = _band_mask(rgb.convert('L', matrix=(1, 1, 1, -420)), lambda v: v > 0)
+    for mask in (_band_mask(rgb.convert('L', matrix=(-1, -1, -1, 630)), lambda v: v > 0),
+                 _band_mask(rg_diff, lambda v: v < 20), _band_mask(gb_diff, lambda v: v < 20)):
+        gray = ImageChops.darker(gray, mask)
+    
+    return ImageChops.lighter(ImageChops.lighter(white, black), gray)
+
+
+def _edge_strength_map(gray):
+    """То же, что detect_edges, но изображением L и без цикла по пикселям"""
+    width, height = gray.size
+    edges = Image.new('L', (width, height), 0)
+    if width < 3 or height < 3:
+        return edges
+    center = gray.crop((1, 1, width - 1, height - 1))
+    vertical = ImageChops.lighter(
+        ImageChops.difference(center, gray.crop((1, 0, width - 1, height - 2))),
+        ImageChops.difference(center, gray.crop((1, 2, width - 1, height))))
+    horizontal = ImageChops.lighter(
+        ImageChops.difference(center, gray.crop((0, 1, width - 2, height - 1))),
+        ImageChops.difference(center, gray.crop((2, 1, width, height - 1))))
+    strength = ImageChops.lighter(vertical, horizontal).point(lambda v: min(255, v * 2))
+    edges.paste(strength, (1, 1))
+    return edges
+
+
+def _crop_edge_map(edges, box):
+    """Карта краев кропа из карты краев всего изображения.
+    
+    Внутренние пиксели кропа видят тех же 4 соседей, что и в полном изображении,
+    а по рамке кропа detect_edges дает 0 - зануляем ее.
+    """
+    cropped = edges.crop(box)
+    width, height = cropped.size
+    result = Image.new('L', (width, height), 0)
+    if width > 2 and height > 2:
+        result.paste(cropped.crop((1, 1, width - 1, height - 1)), (1, 1))
+    return result
+
+
+def _strong_edges_mask(edges):
+    """255 там, где edge_strength > 15"""
+    return edges.point(lambda v: 255 if v > 15 else 0)
+
+
+# Интегральные гистограммы краевой полосы: палитра "вне выделения" за O(корзин + периметр),
+# независимо от размера изображения
+BORDER_HIST_SHIFT = 3    # 5 бит на канал -> корзины 8x8x8 уровней
+BORDER_HIST_BINS = 64    # самые частые корзины полосы, для которых ведутся префиксные суммы
+BORDER_HIST_GRID = 64    # ячеек сетки по длинной стороне
+
+
+def _bin_region_colors(image, box, shift, stats):
+    """Добавляет цвета box в stats: {корзина: [count, sum_r, sum_g, sum_b]}"""
+    for count, (r, g, b) in _region_colors(image, box):
+        key = (r >> shift, g >> shift, b >> shift)
+        entry = stats.get(key)
+        if entry is None:
+            stats[key] = [count, r * count, g * count, b * count]
+        else:
+            entry[0] += count
+            entry[1] += r * count
+            entry[2] += g * count
+            entry[3] += b * count
+
+
+def build_border_index(image):
+    """Строит префиксные суммы квантованных гистограмм краевой полосы по сетке ячеек.
+    
+    Для каждой из BORDER_HIST_BINS корзин хранится 4 числа (count и суммы r, g, b),
+    prefix[cy][cx] - сумма по ячейкам левее и выше (cx, cy).
+    """
+    width, height = image.size
+    boxes = _border_band_boxes(width, height)
+    cell = max(16, -(-max(width, height) // BORDER_HIST_GRID))
+    grid_x = -(-width // cell)
+    grid_y = -(-height // cell)
+    
+    cells = {}
+    total = {}
+    for cy in range(grid_y):
+        for cx in range(grid_x):
+            cell_box = (cx * cell, cy * cell, min(width, (cx + 1) * cell), min(height, (cy + 1) * cell))
+            stats = {}
+            for box in boxes:
+                part = _intersect_box(cell_box, box)
+                if part:
+                    _bin_region_colors(image, part, BORDER_HIST_SHIFT, stats)
+            if stats:
+                cells[(cx, cy)] = stats
+                for key, entry in stats.items():
+                    acc = total.setdefault(key, [0, 0, 0, 0])
+                    for i in range(4):
+                        acc[i] += entry[i]
+    
+    bins = heapq.nlargest(BORDER_HIST_BINS, total, key=lambda key: total[key][0])
+    slots = {key: k for k, key in enumerate(bins)}
+    vector_size = len(bins) * 4
+    
+    empty = array('q', bytes(8 * vector_size))
+    prefix = [[empty] * (grid_x + 1)]
+    for cy in range(grid_y):
+        row = [empty]
+        running = array('q', empty)
+        for cx in range(grid_x):
+            stats = cells.get((cx, cy))
+            if stats:
+                for key, entry in stats.items():
+                    k = slots.get(key)
+                    if k is not None:
+                        for i in range(4):
+                            running[k * 4 + i] += entry[i]
+            above = prefix[cy][cx + 1]
+            row.append(array('q', (a + b for a, b in zip(above, running))))
+        prefix.append(row)
+    
+    return {
+        'size': (width, height),
+        'cell': cell,
+        'bins': bins,
+        'slots': slots,
+        'prefix': prefix,
+    }
+
+
+def _index_rect_sums(index, box):
+    """Суммы по корзинам для пикселей полосы внутри box, через префиксные суммы и края box"""
+    cell = index['cell']
+    width, height = index['size']
+    prefix = index['prefix']
+    x0, y0, x1, y1 = box
+    
+    # Ячейки, целиком лежащие внутри box
+    cx0, cy0 = -(-x0 // cell), -(-y0 // cell)
+    cx1 = len(prefix[0]) - 1 if x1 >= width else x1 // cell
+    cy1 = len(prefix) - 1 if y1 >= height else y1 // cell
+    sums = array('q', bytes(8 * len(index['bins']) * 4))
+    if cx0 < cx1 and cy0 < cy1:
+        for i, (a, b, c, d) in enumerate(zip(prefix[cy1][cx1], prefix[cy0][cx1], prefix[cy1][cx0], prefix[cy0][cx0])):
+            sums[i] = a - b - c + d
+        ix0, iy0 = cx0 * cell, cy0 * cell
+        ix1, iy1 = min(width, cx1 * cell), min(height, cy1 * cell)
+        slivers = [(x0, y0, x1, iy0), (x0, iy1, x1, y1), (x0, iy0, ix0, iy1), (ix1, iy0, x1, iy1)]
+    else:
+        slivers = [box]
+    return sums, slivers
+
+
+def border_index_palette(image, index, excluded=None, count=3):
+    """Самые частые корзины краевой полосы за вычетом excluded; цвет корзины - средний"""
+    width, height = index['size']
+    slots = index['slots']
+    prefix = index['prefix']
+    sums = array('q', prefix[-1][-1])
+    
+    clipped = _intersect_box(excluded, (0, 0, width, height)) if excluded else None
+    if clipped:
+        inner, slivers = _index_rect_sums(index, clipped)
+        for i, value in enumerate(inner):
+            sums[i] -= value
+        boxes = _border_band_boxes(width, height)
+        stats = {}
+        for sliver in slivers:
+            for box in boxes:
+                part = _intersect_box(sliver, box)
+                if part:
+                    _bin_region_colors(image, part, BORDER_HIST_SHIFT, stats)
+        for key, entry in stats.items():
+            k = slots.get(key)
+            if k is not None:
+                for i in range(4):
+                    sums[k * 4 + i] -= entry[i]
+    
+    ranked = sorted((k for k in range(len(index['bins'])) if sums[k * 4] > 0),
+                    key=lambda k: sums[k * 4], reverse=True)
+    colors = []
+    for k in ranked[:count]:
+        n = sums[k * 4]
+        colors.append(tuple(int(round(sums[k * 4 + i] / n)) for i in range(1, 4)))
+    return colors
+
+
+# Палитра по выборке: стоимость ограничена размером выборки, а не изображением. Кластеры
+# ищутся на квантованной гистограмме выборки, их центры уточняются, порядок - по населенности
+# (первый цвет - основной, отдельный подсчет близких пикселей по кропу не нужен)
+BG_PALETTE_SAMPLE = int(os.environ.get('BG_PALETTE_SAMPLE', 4096))
+PALETTE_CLUSTER_RADIUS = 40     # корзина дальше этого от всех центров - не фон (шум, принт в полосе)
+PALETTE_MIN_SHARE = 0.05        # кластер меньше этой доли выборки в палитру не попадает
+PALETTE_REFINE_STEPS = 3
+
+
+def _subtract_box(box, excluded):
+    """box без excluded - до четырех непересекающихся прямоугольников"""
+    overlap = _intersect_box(box, excluded) if excluded else None
+    if not overlap:
+        return [box]
+    x1, y1, x2, y2 = box
+    ox1, oy1, ox2, oy2 = overlap
+    parts = [(x1, y1, x2, oy1), (x1, oy2, x2, y2), (x1, oy1, ox1, oy2), (ox2, oy1, x2, oy2)]
+    return [part for part in parts if part[2] > part[0] and part[3] > part[1]]
+
+
+def _sample_pixels(image, boxes, size, seed=0):
+    """Равномерная выборка без повторов size пикселей из непересекающихся boxes.
+    
+    Распределение то же, что у reservoir sampling по потоку пикселей полосы, но число
+    пикселей известно заранее, поэтому позиции выбираются сразу - O(size), а не O(полосы).
+    Генератор с фиксированным seed: одна и та же область дает одну и ту же палитру.
+    """
+    areas = [(x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes]
+    ends = list(itertools.accumulate(areas))
+    total = ends[-1] if ends else 0
+    if total <= 0:
+        return []
+    positions = sorted(random.Random(seed).sample(range(total), min(size, total)))
+    if image.mode in ('RGB', 'RGBA'):
+        access = image.load()
+        read = lambda x, y: access[x, y][:3]
+    else:
+        # Без конвертации всего изображения: по одному пикселю
+        read = lambda x, y: image.crop((x, y, x + 1, y + 1)).convert('RGB').getpixel((0, 0))
+    pixels = []
+    for position in positions:
+        k = bisect.bisect_right(ends, position)
+        x1, y1, x2, _ = boxes[k]
+        offset = position - (ends[k] - areas[k])
+        pixels.append(read(x1 + offset % (x2 - x1), y1 + offset // (x2 - x1)))
+    return pixels
+
+
+def _cluster_palette(pixels, count=3):
+    """Палитра выборки: корзины квантованной гистограммы (getcolors) -> центры кластеров.
+    
+    Затравки - средние цвета самых населенных корзин, не ближе PALETTE_CLUSTER_RADIUS
+    друг к другу; затем несколько шагов k-средних по корзинам (дальние корзины не
+    учитываются). Кластеры упорядочены по населенности.
+    """
+    if not pixels:
+        return []
+    sample = Image.new('RGB', (len(pixels), 1))
+    sample.putdata(pixels)
+    stats = {}
+    for n, (r, g, b) in sample.getcolors(len(pixels)):
+        entry = stats.setdefault((r >> BORDER_HIST_SHIFT, g >> BORDER_HIST_SHIFT, b >> BORDER_HIST_SHIFT), [0, 0, 0, 0])
+        entry[0] += n
+        entry[1] += r * n
+        entry[2] += g * n
+        entry[3] += b * n
+    bins = sorted(([n, r / n, g / n, b / n] for n, r, g, b in stats.values()), key=lambda item: -item[0])
+    radius_sq = PALETTE_CLUSTER_RADIUS * PALETTE_CLUSTER_RADIUS
+    
+    def distance_sq(a, b):
+        return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+    
+    centers = []
+    for _, *color in bins:
+        if len(centers) == count:
+            break
+        if all(distance_sq(color, center) >= radius_sq for center in centers):
+            centers.append(color)
+    
+    populations = [0] * len(centers)
+    for _ in range(PALETTE_REFINE_STEPS):
+        sums = [[0, 0.0, 0.0, 0.0] for _ in centers]
+        for n, *color in bins:
+            nearest = min(range(len(centers)), key=lambda k: distance_sq(color, centers[k]))
+            if distance_sq(color, centers[nearest]) < radius_sq:
+                acc = sums[nearest]
+                acc[0] += n
+                for i in range(3):
+                    acc[i + 1] += color[i] * n
+        populations = [acc[0] for acc in sums]
+        centers = [[acc[i] / acc[0] for i in (1, 2, 3)] if acc[0] else center
+                   for acc, center in zip(sums, centers)]
+    
+    ranked = sorted(zip(populations, centers), key=lambda item: -item[0])
+    return [tuple(int(round(v)) for v in center) for n, center in ranked
+            if n >= PALETTE_MIN_SHARE * len(pixels)]
+
+
+def sampled_palette(image, source=None, excluded=None, count=3):
+    """Палитра фона по выборке краевой полосы прямоугольника source (без excluded)"""
+    if source is None:
+        source = (0, 0) + image.size
+    sx, sy = source[0], source[1]
+    boxes = []
+    for x1, y1, x2, y2 in _border_band_boxes(source[2] - sx, source[3] - sy):
+        boxes.extend(_subtract_box((x1 + sx, y1 + sy, x2 + sx, y2 + sy), excluded))
+    return _cluster_palette(_sample_pixels(image, boxes, BG_PALETTE_SAMPLE), count)
+
+
+def analyze_image(image):
+    """Анализ загруженного изображения: считается один раз и переиспользуется всеми /extract.
+    
+    Хранит RGBA-растр, яркость, карту краев всего изображения и, для палитр 'exact'
+    и 'histogram', гистограмму цветов краевой полосы или ее интегральный индекс.
+    """
+    rgba = image if image.mode == 'RGBA' else image.convert('RGBA')
+    gray = rgba.convert('L')
+    width, height = rgba.size
+    analysis = {
+        'rgba': rgba,
+        'gray': gray,
+        'edges': _edge_strength_map(gray),
+    }
+    # Гистограммы краевой полосы нужны только палитрам 'exact' и 'histogram'
+    if BG_PALETTE == 'exact':
+        analysis['border_counts'] = _count_colors(rgba, _border_band_boxes(width, height))
+    elif BG_PALETTE == 'histogram':
+        analysis['border_index'] = build_border_index(rgba)
+    return analysis
+
+
+def _analysis_covers(analysis, region):
+    """Можно ли нарезать анализ под region (кроп целиком внутри изображения)"""
+    if analysis is None or region is None:
+        return False
+    x1, y1, x2, y2 = region
+    width, height = analysis['rgba'].size
+    return 0 <= x1 < x2 <= width and 0 <= y1 < y2 <= height
+
+
+def analysis_palette(analysis, selected_region):
+    """Палитра фона вне выделения по заранее посчитанной гистограмме краевой полосы.
+    
+    BG_PALETTE='sampled' - кластеры выборки краевой полосы (см. sampled_palette),
+    'histogram' - квантованные интегральные гистограммы (стоимость не зависит
+    от размера изображения), 'exact' - точные цвета как у Counter.most_common(3).
+    """
+    x1, y1, x2, y2 = selected_region
+    excluded = (x1, y1, x2 + 1, y2 + 1)
+    if BG_PALETTE not in ('histogram', 'exact'):
+        return sampled_palette(analysis['rgba'], excluded=excluded) or [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
+    if BG_PALETTE == 'histogram':
+        bg_colors = border_index_palette(analysis['rgba'], analysis['border_index'], excluded)
+        return bg_colors or [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
+    bg_colors = _most_common_border_colors(analysis['rgba'], excluded, band_counts=analysis['border_counts'])
+    if bg_colors is None:
+        bg_colors = _most_common_border_colors_python(analysis['rgba'], excluded)
+    return bg_colors or [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
+
+
+def _palette_primary():
+    """Индекс основного цвета в палитре, если палитра сама упорядочена по населенности"""
+    return 0 if BG_PALETTE not in ('histogram', 'exact') else None
+
+
+def extraction_hints(analysis, selected_region):
+    """Подсказки движку для кропа selected_region: карта краев и палитра фона из анализа"""
+    return {
+        'edges': _crop_edge_map(analysis['edges'], selected_region),
+        'bg_colors': analysis_palette(analysis, selected_region),
+        'primary': _palette_primary(),
+    }
+
+
+# ============================================================================
+# Локальный детектор принта: самая крупная связная область с плотными краями
+# и нефоновым цветом. Миллисекунды вместо запроса к ИИ для "извлеки принт"
+# ============================================================================
+
+AUTO_DETECT_GRID = 128          # длинная сторона сетки ячеек
+AUTO_DETECT_EDGE_DENSITY = 20   # доля (из 255) сильных краев в ячейке сверх фоновой текстуры - "принт"
+AUTO_DETECT_COLOR_DISTANCE = 48 # отличие от ближайшего цвета фона по максимальному каналу
+
+# /extract_ai берет область детектора без ИИ: для общих запросов ("извлеки принт") -
+# с уверенностью от AUTO_DETECT_GENERIC_CONFIDENCE, для любых - от AUTO_DETECT_CONFIDENCE
+AUTO_DETECT_CONFIDENCE = float(os.environ.get('AUTO_DETECT_CONFIDENCE', 0.85))
+AUTO_DETECT_GENERIC_CONFIDENCE = float(os.environ.get('AUTO_DETECT_GENERIC_CONFIDENCE', 0.4))
+GENERIC_PRINT_WORDS = {
+    'принт', 'принта', 'принты', 'рисунок', 'рисунка', 'картинку', 'картинка', 'изображение', 'графику',
+    'дизайн', 'логотип', 'print', 'design', 'graphic', 'picture', 'logo',
+}
+
+
+def _ring_values(image):
+    """Значения пикселей на рамке шириной в один пиксель"""
+    width, height = image.size
+    values = []
+    for box in ((0, 0, width, 1), (0, height - 1, width, height), (0, 1, 1, height - 1), (width - 1, 1, width, height - 1)):
+        if box[2] > box[0] and box[3] > box[1]:
+            values.extend(image.crop(box).getdata())
+    return values
+
+
+def _auto_detect_background(small_rgb):
+    """До 3 самых частых цветов (с шагом 16) на рамке шириной в ячейку"""
+    quantized = small_rgb.point(lambda v: (v & 0xF0) | 0x08)
+    return [color for color, _ in Counter(_ring_values(quantized)).most_common(3)]
+
+
+def _label_components(cells, grid_w, grid_h):
+    """8-связные компоненты ненулевых ячеек небольшой сетки.
+    
+    Возвращает (метки по ячейкам, [(площадь, x_min, y_min, x_max, y_max), ...]), метка k -> components[k - 1].
+    """
+    labels = [0] * (grid_w * grid_h)
+    components = []
+    for start in range(grid_w * grid_h):
+        if not cells[start] or labels[start]:
+            continue
+        label = len(components) + 1
+        labels[start] = label
+        stack = [start]
+        area = 0
+        x_min, y_min, x_max, y_max = grid_w, grid_h, -1, -1
+        while stack:
+            index = stack.pop()
+            area += 1
+            y, x = divmod(index, grid_w)
+            x_min, x_max = min(x_min, x), max(x_max, x)
+            y_min, y_max = min(y_min, y), max(y_max, y)
+            for ny in (y - 1, y, y + 1):
+                if 0 <= ny < grid_h:
+                    for nx in (x - 1, x, x + 1):
+                        if 0 <= nx < grid_w:
+                            neighbor = ny * grid_w + nx
+                            if cells[neighbor] and not labels[neighbor]:
+                                labels[neighbor] = label
+                                stack.append(neighbor)
+        components.append((area, x_min, y_min, x_max, y_max))
+    return labels, components
+
+
+def auto_detect_region(image, analysis=None):
+    """Bounding box доминирующего принта и уверенность 0..1: ({'x1','y1','x2','y2'}, confidence).
+    
+    Ячейка сетки считается частью принта, если в ней много сильных краев или ее цвет
+    далек от цветов фона на рамке изображения. Берется самая крупная 8-связная область;
+    уверенность выше, когда она доминирует над остальными, плотная и не упирается в края.
+    Если ничего не найдено - (None, 0.0).
+    """
+    if analysis is None:
+        analysis = analyze_image(image)
+    width, height = analysis['rgba'].size
+    cell = max(1, -(-max(width, height) // AUTO_DETECT_GRID))
+    grid_w, grid_h = -(-width // cell), -(-height // cell)
+    if grid_w < 3 or grid_h < 3:
+        return None, 0.0
+    
+    strong = _strong_edges_mask(analysis['edges'])
+    edge_density = strong.resize((grid_w, grid_h), Image.BOX)
+    small_rgb = analysis['rgba'].convert('RGB').resize((grid_w, grid_h), Image.BOX)
+    
+    # Расстояние до ближайшего цвета фона: минимум по цветам, максимум по каналам
+    distance = Image.new('L', (grid_w, grid_h), 255)
+    for color in _auto_detect_background(small_rgb):
+        diff = ImageChops.difference(small_rgb, Image.new('RGB', (grid_w, grid_h), color))
+        r, g, b = diff.split()
+        distance = ImageChops.darker(distance, ImageChops.lighter(ImageChops.lighter(r, g), b))
+    
+    # Текстура ткани или шум дают края и на фоне - порог выше типичной плотности на рамке
+    ring = sorted(_ring_values(edge_density))
+    edge_threshold = ring[len(ring) * 9 // 10] + AUTO_DETECT_EDGE_DENSITY
+    dense = edge_density.point(lambda v: 255 if v >= edge_threshold else 0)
+    colored = distance.point(lambda v: 255 if v >= AUTO_DETECT_COLOR_DISTANCE else 0)
+    foreground = ImageChops.lighter(dense, colored)
+    if not foreground.getbbox():
+        return None, 0.0
+    
+    _, components = _label_components(foreground.tobytes(), grid_w, grid_h)
+    total = sum(component[0] for component in components)
+    area, x_min, y_min, x_max, y_max = max(components)
+    box_cells = (x_max - x_min + 1) * (y_max - y_min + 1)
+    coverage = box_cells / (grid_w * grid_h)
+    
+    dominance = area / total
+    fill = area / box_cells
+    confidence = dominance * min(1.0, 0.4 + fill)
+    if coverage < 0.01 or coverage > 0.9:
+        # Пятнышко или "все изображение" - скорее шум или фон с текстурой
+        confidence *= 0.3
+    if x_min == 0 or y_min == 0 or x_max == grid_w - 1 or y_max == grid_h - 1:
+        confidence *= 0.7
+    
+    # Ячейка запаса со всех сторон - край принта мог попасть в соседнюю ячейку
+    return {
+        'x1': max(0, (x_min - 1) * cell),
+        'y1': max(0, (y_min - 1) * cell),
+        'x2': min(width, (x_max + 2) * cell),
+        'y2': min(height, (y_max + 2) * cell),
+    }, round(confidence, 3)
+
+
+# ============================================================================
+# Несколько принтов на одном фото: маска фона считается один раз по всему
+# изображению, связные области маски - отдельные объекты
+# ============================================================================
+
+MULTI_OBJECT_GRID = 512
+# Объекты меньше этой доли изображения - пыль и шум, а не принты
+MULTI_OBJECT_MIN_AREA = float(os.environ.get('MULTI_OBJECT_MIN_AREA', 0.002))
+
+
+def extract_objects(image, min_area=MULTI_OBJECT_MIN_AREA, engine=None):
+    """Все принты изображения: [((x1, y1, x2, y2), RGBA-кроп), ...] в порядке чтения.
+    
+    Связность считается на сетке (до MULTI_OBJECT_GRID по длинной стороне): на полном
+    разрешении это заняло бы минуты. Маска объекта - его ячейки, расширенные на одну,
+    пересеченные с альфой полного разрешения, так что соседние принты не попадают в кроп.
+    
+    Изображение от BG_STREAMING_MIN_PIXELS проходит потоковым движком во временный PNG
+    (engine не учитывается) и закрывается до декодирования результата: в памяти
+    остается один полноразмерный растр за раз.
+    """
+    if image.size[0] * image.size[1] >= BG_STREAMING_MIN_PIXELS:
+        with tempfile.TemporaryFile() as buffer:
+            remove_background_streaming(image, buffer)
+            image.close()
+            buffer.seek(0)
+            result = Image.open(buffer)
+            result.load()
+    else:
+        rgba = image if image.mode == 'RGBA' else image.convert('RGBA')
+        result = remove_background_smart(rgba, engine=engine)
+    alpha = result.getchannel('A')
+    width, height = result.size
+    
+    cell = max(1, -(-max(width, height) // MULTI_OBJECT_GRID))
+    grid_w, grid_h = -(-width // cell), -(-height // cell)
+    occupied = alpha.point(lambda v: 255 if v >= 128 else 0).resize((grid_w, grid_h), Image.BOX)
+    labels, components = _label_components(occupied.tobytes(), grid_w, grid_h)
+    
+    objects = []
+    min_cells = min_area * grid_w * grid_h
+    for label, (area, x_min, y_min, x_max, y_max) in enumerate(components, 1):
+        if area < min_cells:
+            continue
+        gx1, gy1 = max(0, x_min - 1), max(0, y_min - 1)
+        gx2, gy2 = min(grid_w, x_max + 2), min(grid_h, y_max + 2)
+        cells = bytes(255 if labels[y * grid_w + x] == label else 0
+                      for y in range(gy1, gy2) for x in range(gx1, gx2))
+        box = (gx1 * cell, gy1 * cell, min(width, gx2 * cell), min(height, gy2 * cell))
+        mask = (Image.frombytes('L', (gx2 - gx1, gy2 - gy1), cells)
+                .filter(ImageFilter.MaxFilter(3))
+                .resize(((gx2 - gx1) * cell, (gy2 - gy1) * cell), Image.NEAREST)
+                .crop((0, 0, box[2] - box[0], box[3] - box[1])))
+        
+        piece = result.crop(box)
+        piece_alpha = ImageChops.darker(piece.getchannel('A'), mask)
+        bbox = piece_alpha.getbbox()
+        if not bbox:
+            continue
+        piece.putalpha(piece_alpha)
+        objects.append(((box[0] + bbox[0], box[1] + bbox[1], box[0] + bbox[2], box[1] + bbox[3]),
+                        piece.crop(bbox)))
+    
+    objects.sort(key=lambda item: (item[0][1], item[0][0]))
+    return objects
+
+
+def detect_region_for_prompt(session, prompt):
+    """Область от локального детектора, если ей можно доверять для этого запроса, иначе None"""
+    words = normalize_prompt(prompt).split()
+    generic = all(word in GENERIC_PRINT_WORDS for word in words)
+    analysis = session_analysis(session)
+    if analysis is not None:
+        coords, confidence = auto_detect_region(session_image(session), analysis)
+    else:
+        # Большое изображение: детектор все равно работает по сетке - хватает уменьшенной копии
+        image = session_image(session)
+        factor = -(-max(image.size) // (AUTO_DETECT_GRID * 16))
+        coords, confidence = auto_detect_region(image.reduce(factor))
+        if coords:
+            coords = {key: min(value * factor, image.size[key[0] == 'y']) for key, value in coords.items()}
+    if coords and confidence >= (AUTO_DETECT_GENERIC_CONFIDENCE if generic else AUTO_DETECT_CONFIDENCE):
+        return coords, confidence
+    return None, confidence
+
+
+def _neighbor_reject_mask(non_bg):
+    """255 там, где среди 8 соседей не меньше 40% "не фоновых" (non_bg - маска 0/1)"""
+    width, height = non_bg.size
+    padded = Image.new('L', (width + 2, height + 2), 0)
+    padded.paste(non_bg, (1, 1))
+    neighbors = padded.filter(_NEIGHBOR_KERNEL).crop((1, 1, width + 1, height + 1))
+    # Внутри 8 соседей -> нужно >= 4, на краю 5 или 3 соседа -> нужно >= 2
+    required = Image.new('L', (width, height), 2)
+    required.paste(4, (1, 1, width - 1, height - 1))
+    shortfall = ImageChops.subtract(required, neighbors)
+    return shortfall.point(_ZERO_LUT)
+
+
+def _pillow_palette(rgb, original_image=None, selected_region=None, hints=None):
+    """Палитра фона по краевой полосе (оригинала без выделения или самого кропа).
+    
+    Возвращает (цвета, индекс основного цвета или None - тогда его выбирает _background_mask).
+    """
+    hints = hints or {}
+    if hints.get('bg_colors'):
+        return hints['bg_colors'], hints.get('primary')
+    if original_image is not None and selected_region is not None:
+        x1, y1, x2, y2 = selected_region
+        palette_source, excluded = original_image, (x1, y1, x2 + 1, y2 + 1)
+    else:
+        palette_source, excluded = rgb, None
+    
+    if BG_PALETTE not in ('histogram', 'exact'):
+        bg_colors = sampled_palette(palette_source, excluded=excluded)
+    else:
+        if palette_source is original_image:
+            palette_source = original_image if original_image.mode == 'RGBA' else original_image.convert('RGBA')
+            palette_source = palette_source.convert('RGB')
+        bg_colors = _most_common_border_colors(palette_source, excluded)
+        if bg_colors is None:
+            bg_colors = _most_common_border_colors_python(palette_source, excluded)
+    return bg_colors or [(255, 255, 255), (240, 240, 240), (200, 200, 200)], _palette_primary()
+
+
+def _limit_map(x_limits, y_limits):
+    """Порог для каждого пикселя из упакованных порогов по осям (см. _threshold_limits)"""
+    size = (len(x_limits), len(y_limits))
+    return _imagemath_eval('min(x, y) & 4095',
+                           x=_axis_image(x_limits, size, False), y=_axis_image(y_limits, size, True))
+
+
+def _background_mask(rgb, bg_colors, limit, strong_edges=None, primary=None):
+    """Классификация пикселей: (маска фона L 255/0, индекс основного цвета фона).
+    
+    primary - индекс основного цвета в bg_colors; если не задан, выбирается цвет с
+    наибольшим числом близких пикселей (dist < 40) в самом rgb.
+    """
+    # Расстояние до палитры сравнивается с порогами limit (d2 < 35 ** 2 ... 45 ** 2) и 1226,
+    # до основного цвета - с 900 и, пока он не выбран, с 1600 (см. _palette_tests)
+    palette = tuple(range(len(bg_colors)))
+    if primary is None:
+        tests = ([(palette, LIMIT_RANGE[0], LIMIT_RANGE[1])] + [((i,), 1600, 1600) for i in palette]
+                 + [((i,), 900, 900) for i in palette])
+    else:
+        tests = [(palette, LIMIT_RANGE[0], LIMIT_RANGE[1]), ((primary,), 900, 900)]
+    results = _palette_tests(rgb, bg_colors, tests)
+    min_dist_sq = results[0]
+    
+    if primary is None:
+        # Основной цвет фона - тот, у которого больше всего близких пикселей (при равенстве - первый)
+        counts = [mask.histogram()[255] for mask in results[1:1 + len(palette)]]
+        primary = counts.index(max(counts))
+        primary_close = results[1 + len(palette) + primary]
+    else:
+        primary_close = results[1]
+    
+    close = _imagemath_eval('convert(d <= lim, "L")', d=min_dist_sq, lim=limit).point(lambda v: 255 if v else 0)
+    close = ImageChops.lighter(close, primary_close)
+    
+    # Кандидат в фон отбрасывается, если >= 40% соседей далеки от всех цветов фона (dist > 35)
+    non_bg = ImageChops.invert(_below(min_dist_sq, 1226)).point(lambda v: 1 if v else 0)
+    close = ImageChops.subtract(close, _neighbor_reject_mask(non_bg))
+    
+    background = ImageChops.lighter(close, _neutral_colors_mask(rgb))
+    if strong_edges is not None:
+        background = ImageChops.subtract(background, strong_edges)
+    return background, primary
+
+
+def _compose_result(rgb, alpha, open_top=0, open_bottom=0):
+    """RGBA-результат по маске: фон - прозрачный белый, края маски слегка смягчены.
+    
+    Маска сначала очищается от мелких островков и дыр (despeckle_mask из background_engines.py;
+    open_top/open_bottom - для полос, см. там). Непрозрачность - минимум из маски и ее размытия, поэтому хватает
+    одного наложения: прежнее второе наложение на прозрачный белый давало то же самое.
+    """
+    width, height = rgb.size
+    alpha = despeckle_mask(alpha, BG_DESPECKLE_ISLAND, BG_DESPECKLE_HOLE, open_top, open_bottom)
+    alpha = ImageChops.darker(alpha, alpha.filter(ImageFilter.GaussianBlur(radius=0.3)))
+    result = Image.composite(rgb, Image.new('RGB', (width, height), (255, 255, 255)), alpha).convert('RGBA')
+    result.putalpha(alpha)
+    return result
+
+
+def remove_background_smart_pillow(image, aggressive_mode=False, original_image=None, selected_region=None,
+                                   hints=None):
+    """Удаление фона на C-операциях Pillow - маска совпадает с попиксельной версией"""
+    width, height = image.size
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    rgb = image.convert('RGB')
+    
+    hints = hints or {}
+    bg_colors, primary = _pillow_palette(rgb, original_image, selected_region, hints)
+    
+    # Порог зависит от расстояния до ближайшего края кропа
+    max_dist = min(width, height) / 2
+    limit = _limit_map(_threshold_limits(width, max_dist, aggressive_mode),
+                       _threshold_limits(height, max_dist, aggressive_mode))
+    
+    edges = hints.get('edges')
+    if edges is None:
+        edges = _edge_strength_map(image.convert('L'))
+    background, _ = _background_mask(rgb, bg_colors, limit, _strong_edges_mask(edges), primary)
+    
+    return _compose_result(rgb, ImageChops.invert(background))
+
+
+# Заливка от краев: фоном считается только то, что связано с рамкой кропа цепочкой
+# пикселей близкого к фону цвета без сильных краев. Принт цвета футболки внутри контура
+# остается на месте, а внутренние области в заливку вообще не попадают
+
+# Допуск цветового расстояния до палитры фона для заливки (в агрессивном режиме +5)
+BG_FLOODFILL_TOLERANCE = int(os.environ.get('BG_FLOODFILL_TOLERANCE', 40))
+
+
+def _flood_runs(rows, width):
+    """Построчная заливка по сериям от рамки: [(строка, индекс серии), ...] связанных с краем.
+    
+    Соседство 4-связное: серии соседних строк связаны, если их отрезки пересекаются.
+    Каждая серия посещается один раз, поиск соседей - бисекцией по концам серий.
+    """
+    height = len(rows)
+    ends = [[end for _, end in row] for row in rows]
+    visited = [bytearray(len(row)) for row in rows]
+    
+    stack = []
+    for y, row in enumerate(rows):
+        if not row:
+            continue
+        if y == 0 or y == height - 1:
+            stack.extend((y, index) for index in range(len(row)))
+        else:
+            if row[0][0] == 0:
+                stack.append((y, 0))
+            if row[-1][1] == width:
+                stack.append((y, len(row) - 1))
+    
+    filled = []
+    while stack:
+        y, index = stack.pop()
+        if visited[y][index]:
+            continue
+        visited[y][index] = 1
+        filled.append((y, index))
+        start, end = rows[y][index]
+        for ny in (y - 1, y + 1):
+            if 0 <= ny < height:
+                neighbors = rows[ny]
+                seen = visited[ny]
+                # Первая серия, кончающаяся правее start; дальше - пока начинаются левее end
+                j = bisect.bisect_right(ends[ny], start)
+                while j < len(neighbors) and neighbors[j][0] < end:
+                    if not seen[j]:
+                        stack.append((ny, j))
+                    j += 1
+    return filled
+
+
+def remove_background_floodfill(image, aggressive_mode=False, original_image=None, selected_region=None,
+                                hints=None):
+    """Удаление фона заливкой от краев кропа (BG_ENGINE=floodfill).
+    
+    Проходимы пиксели ближе BG_FLOODFILL_TOLERANCE к палитре фона и не на сильном крае;
+    фон - проходимые серии, связанные с рамкой. Цвет проверяется операциями Pillow сразу
+    для всего кропа, а заливка идет по сериям строк, а не по пикселям.
+    """
+    width, height = image.size
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    rgb = image.convert('RGB')
+    
+    hints = hints or {}
+    bg_colors, _ = _pillow_palette(rgb, original_image, selected_region, hints)
+    edges = hints.get('edges')
+    if edges is None:
+        edges = _edge_strength_map(image.convert('L'))
+    
+    tolerance = BG_FLOODFILL_TOLERANCE + (5 if aggressive_mode else 0)
+    bound = tolerance * tolerance
+    close, = _palette_tests(rgb, bg_colors, [(tuple(range(len(bg_colors))), bound, bound)])
+    passable = ImageChops.subtract(close, _strong_edges_mask(edges))
+    
+    rows = mask_runs(passable)
+    background = paint_runs((width, height), rows, _flood_runs(rows, width))
+    return _compose_result(rgb, ImageChops.invert(background))
+
+
+# Очистка маски от островков и дыр (despeckle_mask, площади BG_DESPECKLE_ISLAND/HOLE) идет
+# в _compose_result; полосам потокового и параллельного движков нужен для нее запас строк
+
+def _despeckle_margin():
+    """Сколько строк ореола добавляет полосам очистка маски: компонента площади меньше N
+    занимает меньше N строк, плюс BG_STREAMING_HALO строк, неточных у края полосы"""
+    islands, holes = max(0, BG_DESPECKLE_ISLAND), max(0, BG_DESPECKLE_HOLE)
+    if not islands and not holes:
+        return 0
+    return BG_STREAMING_HALO + islands + holes
+
+
+# Пирамида: грубая маска на уменьшенной копии, полное разрешение - только у границ маски
+# и сильных краев. Работа растет с длиной границы, а не с площадью
+BG_PYRAMID_FACTOR = int(os.environ.get('BG_PYRAMID_FACTOR', 4))
+# Ширина полосы пересчета вокруг границы грубой маски, в пикселях уменьшенной копии:
+# шире - ближе к полной маске, уже - быстрее
+BG_PYRAMID_BAND = int(os.environ.get('BG_PYRAMID_BAND', 2))
+BG_PYRAMID_TILE = 128
+# Допустимая доля пикселей, расходящихся с полной маской. Расхождение оценивается по каждой
+# BG_PYRAMID_CHECK-й плитке, которую пирамида не пересчитывает (она считается в полном
+# разрешении и сравнивается с грубой); если оценка больше допуска - кроп считается целиком.
+# Отрицательное значение - без проверки
+BG_PYRAMID_TOLERANCE = float(os.environ.get('BG_PYRAMID_TOLERANCE', 0.001))
+BG_PYRAMID_CHECK = 8
+# Кропы меньше этого считаются сразу целиком
+BG_PYRAMID_MIN_PIXELS = 1000000
+
+
+def remove_background_smart_pyramid(image, aggressive_mode=False, original_image=None, selected_region=None,
+                                    hints=None, factor=None, band=None):
+    """Удаление фона "от грубого к точному": та же классификация, что в remove_background_smart_pillow,
+    но в полном разрешении пересчитываются только плитки у границы грубой маски и у сильных краев.
+    
+    Остальные пиксели берут значение грубой маски. Расхождение с полной маской - единичные
+    пиксели внутри однородных областей, которые не дают сильных краев; оно оценивается по
+    выборке плиток, и при оценке больше BG_PYRAMID_TOLERANCE результат считается целиком.
+    """
+    factor = factor or BG_PYRAMID_FACTOR
+    band = BG_PYRAMID_BAND if band is None else band
+    width, height = image.size
+    if width * height < BG_PYRAMID_MIN_PIXELS or min(width, height) < factor * 4:
+        return remove_background_smart_pillow(image, aggressive_mode, original_image, selected_region, hints)
+    
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    rgb = image.convert('RGB')
+    hints = hints or {}
+    bg_colors, primary = _pillow_palette(rgb, original_image, selected_region, hints)
+    edges = hints.get('edges')
+    if edges is None:
+        edges = _edge_strength_map(image.convert('L'))
+    strong_edges = _strong_edges_mask(edges)
+    
+    max_dist = min(width, height) / 2
+    x_limits = _threshold_limits(width, max_dist, aggressive_mode)
+    y_limits = _threshold_limits(height, max_dist, aggressive_mode)
+    
+    # Грубый уровень: порог - по центру каждой ячейки, основной цвет фона (если палитра
+    # его не задает) выбирается здесь же
+    coarse_w, coarse_h = -(-width // factor), -(-height // factor)
+    coarse_rgb = rgb.resize((coarse_w, coarse_h), Image.BOX)
+    coarse_limit = _limit_map([x_limits[min(width - 1, i * factor + factor // 2)] for i in range(coarse_w)],
+                              [y_limits[min(height - 1, i * factor + factor // 2)] for i in range(coarse_h)])
+    coarse_bg, primary = _background_mask(coarse_rgb, bg_colors, coarse_limit, primary=primary)
+    
+    # Неуверенные ячейки: у границы грубой маски (+band) и там, где есть сильные края
+    size = 2 * band + 1
+    uncertain = ImageChops.difference(coarse_bg.filter(ImageFilter.MaxFilter(size)),
+                                      coarse_bg.filter(ImageFilter.MinFilter(size)))
+    uncertain = ImageChops.lighter(uncertain, strong_edges.resize((coarse_w, coarse_h), Image.BOX))
+    
+    background = coarse_bg.resize((coarse_w * factor, coarse_h * factor), Image.NEAREST).crop((0, 0, width, height))
+    
+    tile = BG_PYRAMID_TILE
+    cells = tile // factor
+    tiles_x, tiles_y = -(-width // tile), -(-height // tile)
+    flags = uncertain.point(lambda v: 255 if v else 0).resize(
+        (tiles_x * cells, tiles_y * cells), Image.NEAREST).resize((tiles_x, tiles_y), Image.BOX).tobytes()
+    
+    def full_mask():
+        limit = _limit_map(x_limits, y_limits)
+        mask, _ = _background_mask(rgb, bg_colors, limit, strong_edges, primary)
+        return _compose_result(rgb, ImageChops.invert(mask))
+    
+    # Ореол в 2 пикселя: соседям (3x3) и краям хватает одного, второй - запас
+    halo = 2
+    
+    def refine(x1, y1, x2, y2):
+        """Маска фона прямоугольника в полном разрешении"""
+        hx1, hy1 = max(0, x1 - halo), max(0, y1 - halo)
+        hx2, hy2 = min(width, x2 + halo), min(height, y2 + halo)
+        limit = _limit_map(x_limits[hx1:hx2], y_limits[hy1:hy2])
+        tile_bg, _ = _background_mask(rgb.crop((hx1, hy1, hx2, hy2)), bg_colors, limit,
+                                      strong_edges.crop((hx1, hy1, hx2, hy2)), primary)
+        return tile_bg.crop((x1 - hx1, y1 - hy1, x2 - hx1, y2 - hy1))
+    
+    if sum(1 for flag in flags if flag) * 2 > len(flags):
+        # Граница почти везде (шум, текстура) - целиком дешевле, чем по плиткам
+        return full_mask()
+    
+    certain = [i for i, flag in enumerate(flags) if not flag]
+    if BG_PYRAMID_TOLERANCE >= 0 and certain:
+        # Оценка расхождения по выборке уверенных плиток; проверенные плитки остаются точными
+        checked = mismatched = 0
+        for i in certain[::BG_PYRAMID_CHECK]:
+            x1, y1 = i % tiles_x * tile, i // tiles_x * tile
+            x2, y2 = min(width, x1 + tile), min(height, y1 + tile)
+            tile_bg = refine(x1, y1, x2, y2)
+            histogram = ImageChops.difference(tile_bg, background.crop((x1, y1, x2, y2))).histogram()
+            mismatched += (x2 - x1) * (y2 - y1) - histogram[0]
+            checked += (x2 - x1) * (y2 - y1)
+            background.paste(tile_bg, (x1, y1))
+        if mismatched * len(certain) > BG_PYRAMID_TOLERANCE * checked * len(flags):
+            return full_mask()
+    
+    # Соседние неуверенные плитки строки считаются одним прямоугольником
+    for ty in range(tiles_y):
+        tx = 0
+        while tx < tiles_x:
+            if not flags[ty * tiles_x + tx]:
+                tx += 1
+                continue
+            run_end = tx
+            while run_end < tiles_x and flags[ty * tiles_x + run_end]:
+                run_end += 1
+            x1, y1 = tx * tile, ty * tile
+            background.paste(refine(x1, y1, min(width, run_end * tile), min(height, y1 + tile)), (x1, y1))
+            tx = run_end
+    
+    return _compose_result(rgb, ImageChops.invert(background))
+
+
+# Потоковый движок для больших макетов: кроп проходит горизонтальными полосами с ореолом,
+# результат сразу дописывается в PNG. Рабочая память - O(полоса), а не O(изображение).
+# Ореол очистки маски (_despeckle_margin) - около 50 строк с каждой стороны, поэтому полоса
+# не короче 256 строк, иначе классификация ореола стоит дороже самой полосы
+BG_STREAMING_STRIP = int(os.environ.get('BG_STREAMING_STRIP', 256))
+# Кропы и изображения от этого размера (мегапикселей) сервер обрабатывает потоково
+BG_STREAMING_MIN_PIXELS = int(float(os.environ.get('BG_STREAMING_MIN_MP', 16)) * 1000000)
+# Ореол полосы: краям и соседям нужна одна строка, размытию границы маски - еще три
+BG_STREAMING_HALO = 4
+
+
+class PNGStreamWriter:
+    """Минимальный PNG-кодировщик RGBA (8 бит): строки дописываются полосами по мере готовности.
+    
+    Фильтр строк - Up (разность с предыдущей строкой, ImageChops.subtract_modulo),
+    весь IDAT - один zlib-поток, сбрасываемый кусками.
+    """
+    
+    def __init__(self, output, width, height, level=6):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self._own = isinstance(output, (str, bytes, os.PathLike))
+        self._file = open(output, 'wb') if self._own else output
+        self._zlib = zlib.compressobj(level)
+        self._previous = Image.new('RGBA', (width, 1), (0, 0, 0, 0))
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+    
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack('>I', len(data)) + kind + data +
+                         struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+    
+    def write(self, strip):
+        """Дописывает полосу RGBA шириной self.width"""
+        width, height = strip.size
+        if strip.mode != 'RGBA':
+            strip = strip.convert('RGBA')
+        above = Image.new('RGBA', (width, height))
+        above.paste(self._previous, (0, 0))
+        if height > 1:
+            above.paste(strip.crop((0, 0, width, height - 1)), (0, 1))
+        raw = ImageChops.subtract_modulo(strip, above).tobytes()
+        stride = width * 4
+        data = b''.join(b'\x02' + raw[i:i + stride] for i in range(0, len(raw), stride))
+        self._previous = strip.crop((0, height - 1, width, height))
+        self.rows += height
+        compressed = self._zlib.compress(data)
+        if compressed:
+            self._chunk(b'IDAT', compressed)
+    
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError("PNG: записано %d строк из %d" % (self.rows, self.height))
+        self._chunk(b'IDAT', self._zlib.flush())
+        self._chunk(b'IEND', b'')
+        if self._own:
+            self._file.close()
+
+
+def _stream_boxes(box, strip_height):
+    """Горизонтальные полосы прямоугольника box высотой не больше strip_height"""
+    x1, y1, x2, y2 = box
+    for top in range(y1, y2, strip_height):
+        yield (x1, top, x2, min(y2, top + strip_height))
+
+
+def _release_strip():
+    """ImageMath оставляет промежуточные изображения в циклах ссылок - без сборки
+    мусора они копились бы до срабатывания gc, и память росла бы с числом полос"""
+    gc.collect()
+
+
+def _stream_rgba(image, box):
+    """Кусок исходника в RGBA - той же цепочкой конвертаций, что у remove_background_smart_pillow"""
+    part = image.crop(box)
+    return part if part.mode == 'RGBA' else part.convert('RGBA')
+
+
+def _streaming_palette(image, source, excluded, strip_height):
+    """Палитра фона по краевой полосе прямоугольника source (за вычетом excluded), полосами"""
+    sx, sy = source[0], source[1]
+    bands = [(x1 + sx, y1 + sy, x2 + sx, y2 + sy)
+             for x1, y1, x2, y2 in _border_band_boxes(source[2] - sx, source[3] - sy)]
+    counts = {}
+    for band in bands:
+        for piece in _stream_boxes(band, strip_height):
+            rgb = _stream_rgba(image, piece).convert('RGB')
+            for count, color in rgb.getcolors(rgb.size[0] * rgb.size[1]):
+                counts[color] = counts.get(color, 0) + count
+            overlap = _intersect_box(piece, excluded) if excluded else None
+            if overlap:
+                rgb = _stream_rgba(image, overlap).convert('RGB')
+                for count, color in rgb.getcolors(rgb.size[0] * rgb.size[1]):
+                    counts[color] -= count
+    counts = {color: count for color, count in counts.items() if count > 0}
+    
+    def first_occurrences(colors):
+        # Проход полосами сверху вниз: первая полоса, где цвет встретился, дает его индекс
+        found = {}
+        width = source[2] - sx
+        for piece in _stream_boxes(source, strip_height):
+            pending = [color for color in colors if color not in found]
+            if not pending:
+                break
+            size = (width, piece[3] - piece[1])
+            region_mask = Image.new('L', size, 0)
+            for box in (_intersect_box(band, piece) for band in bands):
+                if box:
+                    region_mask.paste(255, (box[0] - sx, box[1] - piece[1], box[2] - sx, box[3] - piece[1]))
+            clipped = _intersect_box(excluded, piece) if excluded else None
+            if clipped:
+                region_mask.paste(0, (clipped[0] - sx, clipped[1] - piece[1], clipped[2] - sx, clipped[3] - piece[1]))
+            rgb = _stream_rgba(image, piece).convert('RGB')
+            for color in pending:
+                index = _first_occurrence(rgb, region_mask, color)
+                if index != float('inf'):
+                    found[color] = (piece[1] - sy) * width + index
+        return found
+    
+    bg_colors = _rank_colors(counts, 3, first_occurrences)
+    if bg_colors is None:
+        # Масса ничьих (шум): порядок первого вхождения не восстанавливаем, берем по значению цвета
+        bg_colors = [color for color, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:3]]
+    return bg_colors or [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
+
+
+def remove_background_streaming(image, output, aggressive_mode=False, region=None, hints=None, strip_height=None):
+    """Удаление фона полосами с записью PNG по мере готовности -> (ширина, высота) результата.
+    
+    Классификация та же, что в remove_background_smart_pillow: палитра (по выборке или, для
+    BG_PALETTE='exact'/'histogram', проходом по полосам) и основной цвет фона, затем каждая полоса классифицируется с ореолом
+    BG_STREAMING_HALO строк (края, соседи и размытие маски видят те же пиксели, что и при
+    обработке целиком) плюс _despeckle_margin() строк для очистки маски. image может быть открыт лениво: Pillow декодирует его один раз в
+    компактный растр, а несжатые TIFF/BMP/PPM отображает в память прямо из файла.
+    
+    region - кроп (x1, y1, x2, y2) внутри image; палитра тогда берется с краев image вне
+    кропа, как у original_image/selected_region. output - путь или файловый объект.
+    """
+    strip_height = max(1, strip_height or BG_STREAMING_STRIP)
+    region = tuple(region) if region else (0, 0) + image.size
+    x1, y1, x2, y2 = region
+    width, height = x2 - x1, y2 - y1
+    hints = hints or {}
+    
+    bg_colors = hints.get('bg_colors')
+    primary = hints.get('primary')
+    if not bg_colors:
+        if region != (0, 0) + image.size:
+            source, excluded = (0, 0) + image.size, (x1, y1, x2 + 1, y2 + 1)
+        else:
+            source, excluded = region, None
+        if BG_PALETTE not in ('histogram', 'exact'):
+            bg_colors = sampled_palette(image, source, excluded) or [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
+        else:
+            bg_colors = _streaming_palette(image, source, excluded, strip_height)
+        primary = _palette_primary()
+    
+    if primary is None:
+        # Основной цвет фона - по числу близких пикселей во всем кропе (как в _background_mask)
+        close_counts = [0] * len(bg_colors)
+        for piece in _stream_boxes(region, strip_height):
+            for i, count in enumerate(_close_counts(_stream_rgba(image, piece).convert('RGB'), bg_colors)):
+                close_counts[i] += count
+            _release_strip()
+        primary = close_counts.index(max(close_counts))
+    
+    max_dist = min(width, height) / 2
+    x_limits = _threshold_limits(width, max_dist, aggressive_mode)
+    y_limits = _threshold_limits(height, max_dist, aggressive_mode)
+    edges = hints.get('edges')
+    halo = BG_STREAMING_HALO + _despeckle_margin()
+    
+    writer = PNGStreamWriter(output, width, height)
+    for top in range(0, height, strip_height):
+        bottom = min(height, top + strip_height)
+        halo_top, halo_bottom = max(0, top - halo), min(height, bottom + halo)
+        rgba = _stream_rgba(image, (x1, y1 + halo_top, x2, y1 + halo_bottom))
+        rgb = rgba.convert('RGB')
+        if edges is not None:
+            strip_edges = edges.crop((0, halo_top, width, halo_bottom))
+        else:
+            # По рамке полосы карта краев нулевая, но рамка внутри кропа - это ореол, он отрезается
+            strip_edges = _edge_strength_map(rgba.convert('L'))
+        limit = _limit_map(x_limits, y_limits[halo_top:halo_bottom])
+        background, _ = _background_mask(rgb, bg_colors, limit, _strong_edges_mask(strip_edges), primary)
+        result = _compose_result(rgb, ImageChops.invert(background),
+                                 BG_STREAMING_HALO if halo_top else 0,
+                                 BG_STREAMING_HALO if halo_bottom < height else 0)
+        writer.write(result.crop((0, top - halo_top, width, bottom - halo_top)))
+        _release_strip()
+    writer.close()
+    return width, height
+
+
+# Параллельные полосы: один большой кроп делится между процессами пула. Растр передается
+# через multiprocessing.shared_memory - в pickle уходят только имена блоков и номера строк.
+# Пул полос принадлежит процессу, который принимает запросы: большие кропы сервер не отдает
+# воркерам ComputeBackend, а считает сам на этом пуле (см. uses_tile_pool), в воркерах деления нет
+BG_TILE_WORKERS = int(os.environ.get('BG_TILE_WORKERS', os.cpu_count() or 1))
+# Кропы меньше этого (мегапикселей) считаются в одном процессе - пересылка дороже выигрыша
+BG_TILE_MIN_PIXELS = int(float(os.environ.get('BG_TILE_MIN_MP', 4)) * 1000000)
+# Полос вдвое больше, чем процессов: неравномерные полосы не ждут самую медленную
+BG_TILE_SPLIT = 2
+
+_tile_pool = None
+_tile_pool_lock = threading.Lock()
+
+
+def _get_tile_pool(reset=False):
+    """Пул процессов для полос (создается при первом большом кропе в этом процессе)"""
+    global _tile_pool
+    with _tile_pool_lock:
+        if reset and _tile_pool is not None:
+            _tile_pool.shutdown(wait=False, cancel_futures=True)
+            _tile_pool = None
+        if _tile_pool is None and not reset:
+            _tile_pool = ProcessPoolExecutor(max_workers=BG_TILE_WORKERS)
+        return _tile_pool
+
+
+def _shared_rows(name, width, top, bottom):
+    """RGBA-строки [top, bottom) из блока разделяемой памяти (копия - блок сразу закрывается)"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        view = shm.buf[top * width * 4:bottom * width * 4]
+        try:
+            return Image.frombytes('RGBA', (width, bottom - top), view)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+def _tile_close_counts(name, width, top, bottom, bg_colors):
+    """Задача полосы, проход 1: число пикселей, близких (dist < 40) к каждому цвету фона"""
+    return _close_counts(_shared_rows(name, width, top, bottom).convert('RGB'), bg_colors)
+
+
+def _tile_classify(name, out_name, width, top, bottom, halo_top, halo_bottom, bg_colors, primary,
+                   x_limits, y_limits, open_top=0, open_bottom=0):
+    """Задача полосы, проход 2: классификация с ореолом, строки [top, bottom) результата - в out_name"""
+    rgba = _shared_rows(name, width, halo_top, halo_bottom)
+    rgb = rgba.convert('RGB')
+    # Карта краев кропа внутри полосы та же, что у всего кропа: рамка полосы - ореол или рамка кропа
+    edges = _strong_edges_mask(_edge_strength_map(rgba.convert('L')))
+    background, _ = _background_mask(rgb, bg_colors, _limit_map(x_limits, y_limits), edges, primary)
+    result = _compose_result(rgb, ImageChops.invert(background), open_top, open_bottom)
+    data = result.crop((0, top - halo_top, width, bottom - halo_top)).tobytes()
+    shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        shm.buf[top * width * 4:bottom * width * 4] = data
+    finally:
+        shm.close()
+
+
+def remove_background_smart_parallel(image, aggressive_mode=False, original_image=None, selected_region=None,
+                                     hints=None, workers=None):
+    """Удаление фона полосами в пуле процессов - результат совпадает с remove_background_smart_pillow.
+    
+    Палитра считается здесь, основной цвет фона (если палитра его не задает) - суммой
+    счетчиков по полосам (проход 1),
+    затем каждая полоса классифицируется с ореолом BG_STREAMING_HALO + _despeckle_margin()
+    строк (проход 2) и
+    пишет свои строки в общий выходной блок. Кропы меньше BG_TILE_MIN_PIXELS и workers < 2 -
+    в текущем процессе.
+    """
+    workers = BG_TILE_WORKERS if workers is None else workers
+    width, height = image.size
+    strip = max(BG_STREAMING_HALO * 4, -(-height // max(1, workers * BG_TILE_SPLIT)))
+    if workers < 2 or width * height < BG_TILE_MIN_PIXELS or strip >= height:
+        return remove_background_smart_pillow(image, aggressive_mode, original_image, selected_region, hints)
+    
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    bg_colors, primary = _pillow_palette(image.convert('RGB'), original_image, selected_region, hints)
+    max_dist = min(width, height) / 2
+    x_limits = _threshold_limits(width, max_dist, aggressive_mode)
+    y_limits = _threshold_limits(height, max_dist, aggressive_mode)
+    strips = [(top, min(height, top + strip)) for top in range(0, height, strip)]
+    
+    size = width * height * 4
+    source = shared_memory.SharedMemory(create=True, size=size)
+    output = None
+    try:
+        for top, bottom in strips:
+            source.buf[top * width * 4:bottom * width * 4] = image.crop((0, top, width, bottom)).tobytes()
+        output = shared_memory.SharedMemory(create=True, size=size)
+        
+        pool = _get_tile_pool()
+        if primary is None:
+            counts = [pool.submit(_tile_close_counts, source.name, width, top, bottom, bg_colors)
+                      for top, bottom in strips]
+            totals = [sum(column) for column in zip(*(future.result() for future in counts))]
+            primary = totals.index(max(totals))
+        
+        halo = BG_STREAMING_HALO + _despeckle_margin()
+        tasks = []
+        for top, bottom in strips:
+            halo_top, halo_bottom = max(0, top - halo), min(height, bottom + halo)
+            tasks.append(pool.submit(_tile_classify, source.name, output.name, width, top, bottom,
+                                     halo_top, halo_bottom, bg_colors, primary,
+                                     x_limits, y_limits[halo_top:halo_bottom],
+                                     BG_STREAMING_HALO if halo_top else 0,
+                                     BG_STREAMING_HALO if halo_bottom < height else 0))
+        for future in tasks:
+            future.result()
+        
+        view = output.buf[:size]
+        try:
+            return Image.frombytes('RGBA', (width, height), view)
+        finally:
+            view.release()
+    except BrokenProcessPool:
+        # Процесс пула упал - пересоздадим пул при следующем кропе, этот считаем здесь
+        _get_tile_pool(reset=True)
+        return remove_background_smart_pillow(image, aggressive_mode, original_image, selected_region, hints)
+    finally:
+        for shm in (source, output):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+
+# Движки этого модуля в общем реестре: выбор по имени в BG_ENGINE и 'auto'
+
+def _smart_engine(engine):
+    def remove(image, region, hints):
+        if region:
+            return remove_background_smart(image.crop(region), user_prompt=hints.get('prompt', ''),
+                                           original_image=image, selected_region=region, engine=engine, hints=hints)
+        return remove_background_smart(image, user_prompt=hints.get('prompt', ''), engine=engine, hints=hints)
+    return remove
+
+
+def _remove_streaming(image, region, hints):
+    buffer = io.BytesIO()
+    remove_background_streaming(image, buffer, is_aggressive_prompt(hints.get('prompt')), region, hints)
+    result = Image.open(buffer)
+    result.load()
+    return result
+
+
+def _remove_text(image, region, hints):
+    return remove_background_for_text(image.crop(region) if region else image)
+
+
+register_engine(BackgroundEngine(
+    'pillow', 'smart', _smart_engine('pillow'),
+    "C-операции Pillow, большие кропы - полосами в пуле процессов",
+    supports_text=True, supports_tiling=True))
+register_engine(BackgroundEngine(
+    'python', 'smart', _smart_engine('python'), "Эталонный попиксельный цикл",
+    supports_text=True, reference=True))
+register_engine(BackgroundEngine(
+    'streaming', 'smart', _remove_streaming, "Полосами с записью PNG по мере готовности",
+    supports_tiling=True, bounded_memory=True))
+register_engine(BackgroundEngine(
+    'pyramid', 'smart', _smart_engine('pyramid'),
+    "Грубая маска + уточнение у границ (приближенно)", supports_text=True, exact=False))
+register_engine(BackgroundEngine(
+    'floodfill', 'smart', _smart_engine('floodfill'),
+    "Заливка от краев кропа: принт цвета фона внутри контура сохраняется",
+    supports_text=True, exact=False))
+register_engine(BackgroundEngine(
+    'text', 'text', _remove_text, "Извлечение текста (темное на светлом)", supports_text=True))
+
+# ============================================================================
+# Вычислительный бэкенд: удаление фона выполняется в пуле процессов, HTTP-потоки
+# только режут кроп и ждут результат. Очередь ограничена - при переполнении 503,
+# при превышении лимита на пользователя 429.
+# ============================================================================
+
+COMPUTE_WORKERS = int(os.environ.get('COMPUTE_WORKERS', os.cpu_count() or 1))
+COMPUTE_QUEUE_LIMIT = int(os.environ.get('COMPUTE_QUEUE_LIMIT', max(1, COMPUTE_WORKERS) * 2))
+COMPUTE_PER_USER_LIMIT = int(os.environ.get('COMPUTE_PER_USER_LIMIT', 2))
+COMPUTE_TIMEOUT = float(os.environ.get('COMPUTE_TIMEOUT', 300))
+
+
+def _init_compute_worker():
+    """Инициализация процесса-воркера: Ctrl+C обрабатывает только главный процесс,
+    движок прогревается на маленьком изображении, чтобы первая задача не платила за импорт.
+    
+    Своего пула полос у воркера нет: кропы для него сервер считает сам (uses_tile_pool),
+    а иначе каждый из COMPUTE_WORKERS процессов завел бы свои BG_TILE_WORKERS процессов
+    (около ядер^2 на все ядра), и при перезапуске пула они остались бы без родителя.
+    """
+    global BG_TILE_WORKERS
+    BG_TILE_WORKERS = 1
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warmup = Image.new('RGBA', (8, 8), (255, 255, 255, 255))
+    remove_background_smart(warmup)
+    warmup.save(io.BytesIO(), format='PNG')
+
+
+def run_extraction_job(cropped, user_prompt="", hints=None):
+    """Задача воркера: удаление фона + PNG-кодирование (zlib тоже не должен занимать HTTP-поток).
+    
+    cropped - кроп или (путь к файлу, область) для больших изображений: тогда файл открывается
+    здесь, а кроп проходит потоковым движком полосами прямо в PNG.
+    """
+    if isinstance(cropped, tuple):
+        image_path, region = cropped
+        image = Image.open(image_path)
+        if is_text_prompt(user_prompt):
+            cropped = image.crop(region)
+        else:
+            buffer = io.BytesIO()
+            size = remove_background_streaming(image, buffer, is_aggressive_prompt(user_prompt), region, hints)
+            return size, buffer.getvalue()
+    result = get_engine(BG_ENGINE).remove(cropped, hints=dict(hints or {}, prompt=user_prompt))
+    buffer = io.BytesIO()
+    result.save(buffer, format='PNG')
+    # Сам результат обратно не передаем: процессу сервера нужны только PNG и размеры
+    return result.size, buffer.getvalue()
+
+
+def uses_tile_pool(cropped, user_prompt="", hints=None):
+    """Пойдет ли задача run_extraction_job пулом полос - такие кропы сервер считает сам:
+    пул полос есть только у его процесса, а в воркере кроп занял бы одно ядро"""
+    if isinstance(cropped, tuple) or BG_TILE_WORKERS < 2 or is_text_prompt(user_prompt):
+        return False
+    width, height = cropped.size
+    if width * height < BG_TILE_MIN_PIXELS:
+        return False
+    engine = get_engine(BG_ENGINE)
+    if hasattr(engine, 'choose'):
+        engine = engine.choose(cropped, hints=dict(hints or {}, prompt=user_prompt))
+    return engine.name == 'pillow'
+
+
+def run_multi_object_job(image_path, min_area=MULTI_OBJECT_MIN_AREA):
+    """Задача воркера для нескольких принтов: [((x1, y1, x2, y2), (ширина, высота), PNG), ...].
+    
+    Изображение открывается в воркере из временного файла - не гоняем растр через pickle.
+    """
+    objects = []
+    for box, piece in extract_objects(Image.open(image_path), min_area):
+        buffer = io.BytesIO()
+        piece.save(buffer, format='PNG')
+        objects.append((box, piece.size, buffer.getvalue()))
+    return objects
+
+
+class ComputeBackend:
+    """Пул процессов с ограниченной очередью и лимитом одновременных задач на пользователя"""
     
-    aggressive_mode = False
-    if user_prompt:
-        prompt_lower = user_prompt.lower()
-        if any(word in prompt_lower for word in ['убери фон', 'удали фон', 'remove background', 
-                                                  'убери задний', 'удали задний', 'серый фон', 'gray background']):
-            aggressive_mode = True
+    def __init__(self, workers=COMPUTE_WORKERS, queue_limit=COMPUTE_QUEUE_LIMIT,
+                 per_user_limit=COMPUTE_PER_USER_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.per_user_limit = per_user_limit
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._lock = threading.Lock()
+        self._per_user = {}
+        self._executor = None
+        # Поток для задач, которые идут в этом процессе (пулом полос), - по одной за раз:
+        # каждая и так занимает все BG_TILE_WORKERS процессов
+        self._local = None
+        self.stats = {'submitted': 0, 'completed': 0, 'rejected_busy': 0, 'rejected_user': 0}
     
-    bg_color_variations = []
-    for bg_r, bg_g, bg_b in bg_colors:
-        similar_count = 0
-        for pixel in pixels:
-            r, g, b, _ = pixel
-            dist = ((r - bg_r) ** 2 + (g - bg_g) ** 2 + (b - bg_b) ** 2) ** 0.5
-            if dist < 40:
-                similar_count += 1
-        bg_color_variations.append((bg_r, bg_g, bg_b, similar_count))
+    def start(self):
+        """Запуск пула; без вызова start() (или при workers=0) задачи выполняются в текущем потоке"""
+        if self.workers > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_compute_worker)
+        if self.workers > 0 and self._local is None:
+            self._local = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tiles')
     
-    bg_color_variations.sort(key=lambda x: x[3], reverse=True)
-    primary_bg_color = bg_color_variations[0][:3] if bg_color_variations else bg_colors[0]
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._local is not None:
+            self._local.shutdown(wait=False, cancel_futures=True)
+            self._local = None
+        _get_tile_pool(reset=True)
     
-    new_pixels = []
+    def _release(self, user_id, user=True):
+        """Освобождает место в очереди; user=False - задача пакета, пользователь еще занят"""
+        with self._lock:
+            if user:
+                self._per_user[user_id] -= 1
+                if not self._per_user[user_id]:
+                    del self._per_user[user_id]
+            self.stats['completed'] += 1
+        self._slots.release()
     
-    for i, pixel in enumerate(pixels):
-        r, g, b, a = pixel
-        y_pos = i // width
-        x_pos = i % width
-        
-        dist_x = min(x_pos, width - x_pos)
-        dist_y = min(y_pos, height - y_pos)
-        dist_to_edge = min(dist_x, dist_y)
-        
-        max_dist = min(width, height) / 2
-        normalized_dist = dist_to_edge / max_dist if max_dist > 0 else 0
-        
-        min_distance = float('inf')
-        for bg_r, bg_g, bg_b in bg_colors:
-            color_distance = ((r - bg_r) ** 2 + (g - bg_g) ** 2 + (b - bg_b) ** 2) ** 0.5
-            min_distance = min(min_distance, color_distance)
-        
-        edge_strength = edge_pixels_list[i] if i < len(edge_pixels_list) else 0
-        
-        if normalized_dist < 0.2:
-            threshold = 40 if aggressive_mode else 35
-        elif normalized_dist < 0.5:
-            base_threshold = 35 if aggressive_mode else 40
-            threshold = base_threshold + (normalized_dist - 0.2) * 10
-        else:
-            threshold = 40 if aggressive_mode else 45
+    def _start(self, fn, args, local=False):
+        if self._executor is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if local:
+            return self._local.submit(fn, *args)
+        return self._executor.submit(fn, *args)
+    
+    def submit(self, user_id, fn, *args):
+        """Ставит задачу в очередь и возвращает Future; ComputeBusyError, если места нет"""
+        return self.submit_batch(user_id, fn, [args])[0]
+    
+    def submit_batch(self, user_id, fn, args_list, in_process=None):
+        """Несколько задач одного запроса (выполняются параллельно) -> список Future.
         
-        if edge_strength > 30:
-            is_background = False
-        elif edge_strength > 15:
-            is_background = False
-        else:
-            is_background = min_distance < threshold
-            
-            if not is_background:
-                distance_to_primary = ((r - primary_bg_color[0]) ** 2 + 
-                                       (g - primary_bg_color[1]) ** 2 + 
-                                       (b - primary_bg_color[2]) ** 2) ** 0.5
-                if distance_to_primary < 30:
-                    is_background = True
+        Каждая задача занимает место в очереди, но в лимит пользователя пакет засчитывается
+        как одна обработка. Места берутся на весь пакет сразу или не берутся вовсе.
+        in_process(*args) -> True: задача выполняется в этом процессе (в потоке бэкенда), а не в пуле.
+        """
+        count = len(args_list)
+        with self._lock:
+            if self._per_user.get(user_id, 0) >= self.per_user_limit:
+                self.stats['rejected_user'] += 1
+                raise ComputeBusyError("Предыдущая обработка еще идет, подождите", status=429)
+            acquired = 0
+            while acquired < count and self._slots.acquire(blocking=False):
+                acquired += 1
+            if acquired < count:
+                for _ in range(acquired):
+                    self._slots.release()
+                self.stats['rejected_busy'] += 1
+                raise ComputeBusyError("Сервер перегружен, повторите через несколько секунд", status=503)
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            self.stats['submitted'] += count
         
-        if is_background:
-            neighbor_colors = []
-            for dy in [-1, 0, 1]:
-                for dx in [-1, 0, 1]:
-                    if dx == 0 and dy == 0:
-                        continue
-                    nx, ny = x_pos + dx, y_pos + dy
-                    if 0 <= nx < width and 0 <= ny < height:
-                        n_idx = ny * width + nx
-                        nr, ng, nb, _ = pixels[n_idx]
-                        n_dist = float('inf')
-                        for bg_r, bg_g, bg_b in bg_colors:
-                            n_color_dist = ((nr - bg_r) ** 2 + (ng - bg_g) ** 2 + (nb - bg_b) ** 2) ** 0.5
-                            n_dist = min(n_dist, n_color_dist)
-                        neighbor_colors.append(n_dist)
-            
-            if neighbor_colors:
-                non_bg_neighbors = sum(1 for d in neighbor_colors if d > 35)
-                if non_bg_neighbors >= len(neighbor_colors) * 0.4:
-                    is_background = False
+        remaining = [count]
         
-        if not is_background:
-            if edge_strength < 15 and r > 240 and g > 240 and b > 240 and abs(r - g) < 15 and abs(g - b) < 15:
-                is_background = True
-            elif edge_strength < 15 and r < 30 and g < 30 and b < 30:
-                is_background = True
-            elif edge_strength < 15 and abs(r - g) < 20 and abs(g - b) < 20 and 140 < (r + g + b) / 3 < 210:
-                is_background = True
+        def finished(_):
+            with self._lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            self._release(user_id, user=last)
         
-        if is_background:
-            new_pixels.append((255, 255, 255, 0))
-        else:
-            new_pixels.append((r, g, b, 255))
-    
-    result = Image.new('RGBA', (width, height))
-    result.putdata(new_pixels)
-    
-    mask = Image.new('L', (width, height), 0)
-    mask_pixels = [255 if p[3] > 0 else 0 for p in new_pixels]
-    mask.putdata(mask_pixels)
-    
-    mask = mask.filter(ImageFilter.MaxFilter(size=1))
-    mask = mask.filter(ImageFilter.MinFilter(size=1))
-    mask = mask.filter(ImageFilter.GaussianBlur(radius=0.3))
+        futures = []
+        try:
+            for args in args_list:
+                future = self._start(fn, args, in_process is not None and in_process(*args))
+                future.add_done_callback(finished)
+                futures.append(future)
+        except BrokenProcessPool:
+            for _ in range(count - len(futures)):
+                finished(None)
+            self.restart()
+            raise ComputeBusyError("Вычислительный процесс перезапускается, повторите запрос", status=503)
+        except Exception:
+            for _ in range(count - len(futures)):
+                finished(None)
+            raise
+        return futures
     
-    result = Image.composite(result, Image.new('RGBA', (width, height), (255, 255, 255, 0)), mask)
+    def restart(self):
+        """Воркер упал (например, OOM) - пересоздаем пул"""
+        with self._lock:
+            broken, self._executor = self._executor, None
+        if broken is not None:
+            broken.shutdown(wait=False, cancel_futures=True)
+        self.start()
     
-    return result
+    def run(self, user_id, fn, *args, timeout=COMPUTE_TIMEOUT):
+        """Синхронная обертка над submit для обработчиков HTTP"""
+        future = self.submit(user_id, fn, *args)
+        try:
+            return future.result(timeout=timeout)
+        except BrokenProcessPool:
+            self.restart()
+            raise ComputeBusyError("Вычислительный процесс перезапускается, повторите запрос", status=503)
+        except FutureTimeoutError:
+            raise ComputeBusyError("Обработка заняла слишком много времени", status=504)
+
+
+compute_backend = ComputeBackend()
 
 # Полный HTML шаблон (скопирован из оригинального TELEGRAM_WEBAPP.py)
 # Для серверной версии используем встроенный шаблон
@@ -765,7 +3325,7 @@ TELEGRAM_HTML_TEMPLATE = '''<!DOCTYPE html>
                 .then(r => r.json())
                 .then(data => {
                     if (data.success) {
-                        loadImageFromData(data.data);
+                        loadImageFromUrl(data.image_url);
                         document.getElementById('uploadSection').style.display = 'none';
                     } else {
                         document.getElementById('uploadSection').style.display = 'block';
@@ -775,9 +3335,8 @@ TELEGRAM_HTML_TEMPLATE = '''<!DOCTYPE html>
         } else {
             document.getElementById('uploadSection').style.display = 'block';
         }
-        function loadImageFromData(imageData) {
+        function loadImageFromUrl(imageUrl) {
             image = new Image();
-            image.src = 'data:image/png;base64,' + imageData;
             image.onload = function() {
                 const maxWidth = window.innerWidth - 40;
                 const maxHeight = window.innerHeight * 0.5;
@@ -789,6 +3348,7 @@ TELEGRAM_HTML_TEMPLATE = '''<!DOCTYPE html>
                 document.getElementById('modeSelector').style.display = 'flex';
                 setupCanvasEvents();
             };
+            image.src = imageUrl;
         }
         function handleFileUpload(event) {
             const file = event.target.files[0];
@@ -809,7 +3369,7 @@ TELEGRAM_HTML_TEMPLATE = '''<!DOCTYPE html>
                 if (data.success) {
                     document.getElementById('uploadStatus').textContent = '✅ Изображение загружено!';
                     document.getElementById('uploadSection').style.display = 'none';
-                    loadImageFromData(data.data);
+                    loadImageFromUrl(data.image_url);
                 } else {
                     document.getElementById('uploadStatus').textContent = '❌ Ошибка: ' + (data.error || 'Не удалось загрузить');
                 }
@@ -879,46 +3439,67 @@ TELEGRAM_HTML_TEMPLATE = '''<!DOCTYPE html>
             fetch('/extract_ai', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({prompt: prompt, user_id: userId})
+                body: JSON.stringify({prompt: prompt, user_id: userId, async: true})
             })
             .then(r => r.json())
             .then(data => {
-                if (data.success && data.coords) {
+                if (data.success && data.job_id) {
                     document.getElementById('aiStatus').textContent = '✓ Область определена';
-                    setTimeout(() => extractAndProcess(data.coords), 500);
+                    pollJob(data.job_id);
                 } else {
                     document.getElementById('aiStatus').textContent = '❌ Ошибка: ' + (data.error || 'Не удалось определить');
                 }
             })
             .catch(err => document.getElementById('aiStatus').textContent = '❌ Ошибка: ' + err.message);
         }
-        function extractAndProcess(coords) {
+        function extractAndProcess(coords, prompt) {
             document.getElementById('status').textContent = '⏳ Обработка...';
-            fetch('/extract', {
+            fetch('/jobs', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({...coords, user_id: userId})
+                body: JSON.stringify({...coords, prompt: prompt || '', user_id: userId})
             })
             .then(r => r.json())
             .then(data => {
                 if (data.success) {
-                    const resultCanvas = document.getElementById('resultCanvas');
-                    const resultCtx = resultCanvas.getContext('2d');
-                    const resultImg = new Image();
-                    resultImg.src = 'data:image/png;base64,' + data.data;
-                    resultImg.onload = function() {
-                        resultCanvas.width = resultImg.width;
-                        resultCanvas.height = resultImg.height;
-                        resultCtx.drawImage(resultImg, 0, 0);
-                        document.getElementById('resultContainer').style.display = 'block';
-                        document.getElementById('status').textContent = '✓ Готово! Размер: ' + data.width + ' x ' + data.height;
-                    };
+                    pollJob(data.job_id);
                 } else {
                     tg.showAlert('Ошибка: ' + data.error);
                 }
             })
             .catch(err => tg.showAlert('Ошибка: ' + err.message));
         }
+        function pollJob(jobId) {
+            fetch('/jobs/' + jobId)
+            .then(r => r.json())
+            .then(data => {
+                if (!data.success) {
+                    tg.showAlert('Ошибка: ' + data.error);
+                } else if (data.status === 'done') {
+                    showResult(data);
+                } else if (data.status === 'error') {
+                    tg.showAlert('Ошибка: ' + data.error);
+                } else {
+                    const stage = data.status === 'queued' ? 'в очереди' : 'обработка';
+                    document.getElementById('status').textContent = '⏳ ' + stage + ', осталось ~' + Math.ceil(data.eta) + ' с';
+                    setTimeout(() => pollJob(jobId), 700);
+                }
+            })
+            .catch(err => tg.showAlert('Ошибка: ' + err.message));
+        }
+        function showResult(data) {
+            const resultCanvas = document.getElementById('resultCanvas');
+            const resultCtx = resultCanvas.getContext('2d');
+            const resultImg = new Image();
+            resultImg.onload = function() {
+                resultCanvas.width = resultImg.width;
+                resultCanvas.height = resultImg.height;
+                resultCtx.drawImage(resultImg, 0, 0);
+                document.getElementById('resultContainer').style.display = 'block';
+                document.getElementById('status').textContent = '✓ Готово! Размер: ' + data.width + ' x ' + data.height;
+            };
+            resultImg.src = data.result_url;
+        }
         function downloadResult() {
             const resultCanvas = document.getElementById('resultCanvas');
             if (!resultCanvas) {
@@ -952,8 +3533,187 @@ TELEGRAM_HTML_TEMPLATE = '''<!DOCTYPE html>
 </body>
 </html>'''
 
-# Глобальное хранилище результатов
-user_results = {}
+def _job_bytes(job):
+    return len(job['png'] or b'')
+
+
+# Глобальное хранилище результатов: последняя завершенная задача пользователя
+user_results = SessionStore(RESULT_TTL, RESULT_MEMORY_LIMIT, _job_bytes)
+
+# ============================================================================
+# Асинхронные задачи извлечения: POST /jobs сразу возвращает id, GET /jobs/<id> -
+# статус, стадия и оценка времени, GET /result/<id> - PNG результата
+# ============================================================================
+
+JOB_TTL = float(os.environ.get('JOB_TTL', 900))
+
+# Незавершенные задачи (0 байт) по объему не вытесняются
+extraction_jobs = SessionStore(JOB_TTL, RESULT_MEMORY_LIMIT, _job_bytes)
+# Скорость обработки (пикселей в секунду), сглаженная по завершенным задачам - для ETA
+_job_rate = {'pixels_per_second': 4e6}
+
+
+def prepare_region(session, region):
+    """Прижимает region к границам изображения и готовит кроп и подсказки движку.
+    
+    Для больших изображений вместо кропа - (путь к файлу, region), см. run_extraction_job.
+    """
+    # Соседний запрос мог вытеснить данные сессии - берем локальные ссылки
+    analysis = session_analysis(session)
+    
+    # Кроп за пределами изображения дал бы черные поля - прижимаем к границам
+    width, height = analysis['rgba'].size if analysis is not None else session_image(session).size
+    x1, y1, x2, y2 = region
+    x1, x2 = max(0, min(x1, width)), max(0, min(x2, width))
+    y1, y2 = max(0, min(y1, height)), max(0, min(y2, height))
+    if x2 <= x1 or y2 <= y1:
+        raise ValueError("Выбрана пустая область")
+    
+    region = (x1, y1, x2, y2)
+    if analysis is None:
+        # Растр в воркер не передаем: он сам откроет файл и пройдет кроп полосами
+        return region, (session['image_path'], region), {}
+    return region, analysis['rgba'].crop(region), extraction_hints(analysis, region)
+
+
+def _finish_job(job, future):
+    now = time.time()
+    try:
+        job['size'], job['png'] = future.result()
+        job['etag'] = make_etag(job['png'])
+        job['status'] = 'done'
+        # Для /result храним задачу целиком: PNG уже закодирован, повторно не кодируем
+        user_results[job['user_id']] = job
+        if job['started']:
+            rate = job['pixels'] / max(now - job['started'], 1e-3)
+            _job_rate['pixels_per_second'] = 0.7 * _job_rate['pixels_per_second'] + 0.3 * rate
+    except Exception as e:
+        job['status'] = 'error'
+        job['error'] = str(e)
+    job['finished'] = now
+    job['stage'] = job['status']
+    job['done'].set()
+
+
+def submit_extraction_job(session, user_id, region, prompt=""):
+    """Ставит извлечение в очередь бэкенда и сразу возвращает описание задачи"""
+    return submit_extraction_jobs(session, user_id, [region], prompt)[0]
+
+
+# Сколько областей можно прислать в одном /extract (каждая занимает место в очереди пула)
+BATCH_MAX_REGIONS = int(os.environ.get('BATCH_MAX_REGIONS', 16))
+
+
+def submit_extraction_jobs(session, user_id, regions, prompt=""):
+    """Несколько областей одного изображения: декодирование, карта краев и палитра
+    берутся из одного анализа сессии, кропы считаются параллельно в пуле"""
+    prepared = [prepare_region(session, region) for region in regions]
+    futures = compute_backend.submit_batch(user_id, run_extraction_job,
+                                           [(cropped, prompt, hints) for _, cropped, hints in prepared],
+                                           in_process=uses_tile_pool)
+    jobs = []
+    for (region, _, _), future in zip(prepared, futures):
+        job = _new_job(user_id, region, prompt, (region[2] - region[0], region[3] - region[1]))
+        job['future'] = future
+        extraction_jobs[job['id']] = job
+        # Колбэк - после регистрации: у уже готового Future он вызовется сразу
+        future.add_done_callback(lambda f, job=job: _finish_job(job, f))
+        jobs.append(job)
+    return jobs
+
+
+def _new_job(user_id, region, prompt, size):
+    now = time.time()
+    return {
+        'id': uuid.uuid4().hex,
+        'user_id': user_id,
+        'region': region,
+        'prompt': prompt,
+        'pixels': size[0] * size[1],
+        'status': 'queued',
+        'stage': 'queued',
+        'created': now,
+        'started': None,
+        'finished': None,
+        'error': None,
+        'size': None,
+        'png': None,
+        'etag': None,
+        'future': None,
+        # Устанавливается, когда _finish_job записал результат (или ошибку)
+        'done': threading.Event(),
+    }
+
+
+def completed_job(user_id, region, size, png, prompt=""):
+    """Готовый результат, посчитанный вне submit_extraction_job, - чтобы отдавать его через /result/<id>"""
+    job = _new_job(user_id, region, prompt, size)
+    job.update(status='done', stage='done', started=job['created'], finished=job['created'],
+               size=size, png=png, etag=make_etag(png))
+    job['done'].set()
+    extraction_jobs[job['id']] = job
+    return job
+
+
+def get_extraction_job(job_id):
+    return extraction_jobs.get(job_id)
+
+
+def wait_extraction_job(job, timeout=COMPUTE_TIMEOUT):
+    """Дожидается задачи (для синхронных /extract и /extract_ai) -> ((ширина, высота), PNG)"""
+    future = job['future']
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        except BrokenProcessPool:
+            compute_backend.restart()
+            raise ComputeBusyError("Вычислительный процесс перезапускается, повторите запрос", status=503)
+        except FutureTimeoutError:
+            raise ComputeBusyError("Обработка заняла слишком много времени", status=504)
+        except Exception:
+            pass
+    # Колбэк завершения мог еще не отработать в потоке пула
+    if not job['done'].wait(timeout):
+        raise ComputeBusyError("Обработка заняла слишком много времени", status=504)
+    if job['status'] == 'error':
+        raise RuntimeError(job['error'])
+    return job['size'], job['png']
+
+
+def job_status(job):
+    """Публичное описание задачи для GET /jobs/<id>"""
+    now = time.time()
+    future = job['future']
+    if job['status'] == 'queued' and future is not None and future.running():
+        job['status'] = job['stage'] = 'processing'
+        job['started'] = now
+    
+    expected = job['pixels'] / _job_rate['pixels_per_second']
+    if job['status'] == 'processing':
+        eta = max(0.0, expected - (now - job['started']))
+    elif job['status'] == 'queued':
+        ahead = sum(1 for other in extraction_jobs.values()
+                    if other['finished'] is None and other['created'] < job['created'])
+        eta = expected * (1 + ahead / max(1, compute_backend.workers))
+    else:
+        eta = 0.0
+    
+    status = {
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'eta': round(eta, 1),
+        'elapsed': round((job['finished'] or now) - job['created'], 1),
+        'region': job['region'],
+    }
+    if job['status'] == 'done':
+        status['result_url'] = f"/result/{job['id']}"
+        status['width'], status['height'] = job['size']
+    elif job['status'] == 'error':
+        status['error'] = job['error']
+    return status
+
 
 class TelegramWebAppHandler(BaseHTTPRequestHandler):
     """Обработчик запросов для Telegram Web App"""
@@ -974,53 +3734,53 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
         
         elif path == '/get_image':
             user_id = query.get('user_id', [None])[0]
-            if user_id:
-                session = get_user_image(user_id)
-                if session and 'image' in session:
-                    image = session['image']
-                    buffer = io.BytesIO()
-                    image.save(buffer, format='PNG')
-                    img_data = base64.b64encode(buffer.getvalue()).decode()
-                    
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('ngrok-skip-browser-warning', 'true')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({
-                        'success': True,
-                        'data': img_data
-                    }).encode())
-                    return
-            
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('ngrok-skip-browser-warning', 'true')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': False, 'error': 'Изображение не найдено'}).encode())
+            session = get_user_image(user_id) if user_id else None
+            if session:
+                self.send_json(200, self.image_info(user_id, session))
+            else:
+                self.send_json(404, {'success': False, 'error': 'Изображение не найдено'})
+        
+        elif path.startswith('/image/'):
+            session = get_user_image(unquote(path[len('/image/'):]))
+            if session:
+                data, mime, etag = session_image_payload(session)
+                # Пользователь может загрузить другое фото под тем же id - всегда перепроверяем по ETag
+                self.send_bytes(data, mime, etag, 'private, no-cache')
+            else:
+                self.send_error(404)
+        
+        elif path.startswith('/jobs/'):
+            self.handle_get_job(path)
+        
+        elif path == '/stats':
+            self.send_json(200, {
+                'sessions': user_sessions.snapshot(),
+                'results': user_results.snapshot(),
+                'jobs': extraction_jobs.snapshot(),
+                'spool': spool.snapshot(),
+                'ai_cache': ai_box_cache.snapshot(),
+                'compute': compute_backend.stats
+            })
+        
+        elif path.startswith('/result/'):
+            job = get_extraction_job(path[len('/result/'):])
+            if job is None:
+                self.send_json(404, {'success': False, 'error': 'Задача не найдена'})
+            elif job['status'] != 'done':
+                self.send_json(409, job_status(job))
+            else:
+                # Результат задачи не меняется - кэшируется браузером целиком
+                self.send_bytes(job['png'], 'image/png', job['etag'], 'private, max-age=3600, immutable')
         
         elif path == '/result':
             user_id = query.get('user_id', [None])[0]
-            if user_id and user_id in user_results:
-                result = user_results[user_id]
-                buffer = io.BytesIO()
-                result.save(buffer, format='PNG')
-                buffer.seek(0)
-                file_data = buffer.getvalue()
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'image/png')
-                self.send_header('Content-Disposition', 'attachment; filename="print_result.png"; filename*=UTF-8\'\'print_result.png')
-                self.send_header('Content-Length', str(len(file_data)))
-                self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-                self.send_header('Pragma', 'no-cache')
-                self.send_header('Expires', '0')
-                self.send_header('ngrok-skip-browser-warning', 'true')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Expose-Headers', 'Content-Disposition')
-                self.end_headers()
-                self.wfile.write(file_data)
+            job = user_results.get(user_id) if user_id else None
+            if job:
+                # Мобильный webview часто повторяет скачивание - отдаем готовые байты, 304 или диапазон
+                self.send_bytes(job['png'], 'image/png', job['etag'], 'private, no-cache', {
+                    'Content-Disposition': 'attachment; filename="print_result.png"; filename*=UTF-8\'\'print_result.png',
+                    'Access-Control-Expose-Headers': 'Content-Disposition'
+                })
             else:
                 self.send_error(404)
         
@@ -1038,6 +3798,10 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
             self.handle_extract()
         elif path == '/extract_ai':
             self.handle_extract_ai()
+        elif path == '/jobs':
+            self.handle_submit_job()
+        elif path == '/extract_objects':
+            self.handle_extract_objects()
         else:
             self.send_error(404)
     
@@ -1097,32 +3861,19 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
             if not image_data:
                 raise ValueError("Изображение не получено")
             
-            import tempfile
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.jpg')
-            temp_file.write(image_data)
-            temp_file.close()
-            
-            image = Image.open(temp_file.name)
-            user_sessions[user_id] = {
-                'image_path': temp_file.name,
+            image_path = spool.write(image_data)
+            image = Image.open(image_path)
+            session = {
+                'image_path': image_path,
+                'sha256': hashlib.sha256(image_data).hexdigest(),
                 'image': image,
-                'file_id': filename or 'uploaded'
+                'file_id': filename or 'uploaded',
             }
+            session_analysis(session)
+            session_image_payload(session, image_data)
+            user_sessions[user_id] = session
             
-            buffer = io.BytesIO()
-            image.save(buffer, format='PNG')
-            img_data = base64.b64encode(buffer.getvalue()).decode()
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('ngrok-skip-browser-warning', 'true')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                'success': True,
-                'data': img_data,
-                'user_id': user_id
-            }).encode())
+            self.send_json(200, self.image_info(user_id, session))
             
         except Exception as e:
             error_msg = str(e)
@@ -1136,6 +3887,177 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
                 'error': error_msg
             }).encode())
     
+    def image_info(self, user_id, session):
+        """JSON-описание загруженного изображения: ссылка и размеры, без самих пикселей"""
+        width, height = session_image(session).size
+        return {
+            'success': True,
+            'user_id': user_id,
+            'image_url': '/image/' + quote(user_id, safe=''),
+            'width': width,
+            'height': height
+        }
+    
+    def byte_range(self, size, etag):
+        """(начало, конец) из заголовка Range, None - отдать целиком, False - диапазон недостижим"""
+        header = self.headers.get('Range', '')
+        match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header)
+        if not match or match.group(1) == match.group(2) == '':
+            # Несколько диапазонов и прочие единицы не поддерживаем - по RFC можно ответить целиком
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != etag:
+            return None
+        
+        first, last = match.groups()
+        if first == '':
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return False
+        return start, end
+    
+    def send_bytes(self, data, content_type, etag, cache_control, headers=None):
+        """Бинарный ответ с ETag и Range; на совпавший If-None-Match - 304 без тела"""
+        if_none_match = self.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        
+        byte_range = self.byte_range(len(data), etag)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(data)}')
+            self.send_header('Content-Length', '0')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        
+        body = memoryview(data)
+        if byte_range:
+            start, end = byte_range
+            body = body[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('ngrok-skip-browser-warning', 'true')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_json(self, status, payload, headers=None):
+        """JSON-ответ с заголовками, общими для всех ответов Mini App"""
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('ngrok-skip-browser-warning', 'true')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(payload).encode())
+    
+    def handle_submit_job(self):
+        """POST /jobs: ставит извлечение области в очередь и сразу отвечает id задачи"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            
+            user_id = data.get('user_id')
+            if not user_id:
+                raise ValueError("user_id не указан")
+            
+            session = get_user_image(user_id)
+            if not session or 'image_path' not in session:
+                raise ValueError("Изображение не найдено")
+            
+            region = tuple(int(data.get(key, 0)) for key in ('x1', 'y1', 'x2', 'y2'))
+            job = submit_extraction_job(session, user_id, region, data.get('prompt', ''))
+            self.send_json(202, job_status(job), {'Location': f"/jobs/{job['id']}"})
+        
+        except ComputeBusyError as e:
+            self.send_json(e.status, {'success': False, 'error': str(e), 'retry_after': e.retry_after},
+                           {'Retry-After': str(e.retry_after)})
+        except Exception as e:
+            self.send_json(500, {'success': False, 'error': str(e)})
+    
+    def handle_get_job(self, path):
+        """GET /jobs/<id> - статус задачи (PNG результата - по result_url, /result/<id>)"""
+        job = get_extraction_job(path[len('/jobs/'):])
+        if job is None:
+            self.send_json(404, {'success': False, 'error': 'Задача не найдена'})
+        else:
+            self.send_json(200, job_status(job))
+    
+    def send_zip(self, files, filename):
+        """Потоковый ZIP из итератора (имя, байты): каждый файл уходит клиенту, как только готов.
+        
+        PNG уже сжаты - храним без повторного сжатия. Длина заранее неизвестна, поэтому
+        без Content-Length: ответ HTTP/1.0 заканчивается закрытием соединения.
+        """
+        self.send_response(200)
+        self.send_header('Content-type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.send_header('ngrok-skip-browser-warning', 'true')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'Content-Disposition')
+        self.end_headers()
+        with zipfile.ZipFile(self.wfile, 'w', zipfile.ZIP_STORED) as archive:
+            for name, data in files:
+                archive.writestr(name, data)
+                self.wfile.flush()
+    
+    def handle_extract_objects(self):
+        """POST /extract_objects: все принты фото за один проход - ZIP (format=zip) или ссылки на результаты"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            
+            user_id = data.get('user_id')
+            if not user_id:
+                raise ValueError("user_id не указан")
+            
+            session = get_user_image(user_id)
+            if not session or 'image_path' not in session:
+                raise ValueError("Изображение не найдено")
+            
+            min_area = float(data.get('min_area', MULTI_OBJECT_MIN_AREA))
+            objects = compute_backend.run(user_id, run_multi_object_job, session['image_path'], min_area)
+            
+            if data.get('format') == 'zip':
+                self.send_zip([(f'print_{i}.png', png) for i, (_, _, png) in enumerate(objects, 1)], 'prints.zip')
+                return
+            
+            results = []
+            for box, size, png in objects:
+                job = completed_job(user_id, box, size, png)
+                results.append({
+                    'job_id': job['id'],
+                    'result_url': f"/result/{job['id']}",
+                    'region': box,
+                    'width': size[0],
+                    'height': size[1]
+                })
+            self.send_json(200, {'success': True, 'objects': results})
+        
+        except ComputeBusyError as e:
+            self.send_json(e.status, {'success': False, 'error': str(e), 'retry_after': e.retry_after},
+                           {'Retry-After': str(e.retry_after)})
+        except Exception as e:
+            self.send_json(500, {'success': False, 'error': str(e)})
+    
     def handle_extract(self):
         """Обработка извлечения области"""
         try:
@@ -1151,40 +4073,23 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
             if not session or 'image_path' not in session:
                 raise ValueError("Изображение не найдено")
             
+            # Пакет: regions - список прямоугольников, один анализ и параллельная обработка
+            if 'regions' in data:
+                self.extract_batch(session, user_id, data)
+                return
+            
             x1 = int(data.get('x1', 0))
             y1 = int(data.get('y1', 0))
             x2 = int(data.get('x2', 0))
             y2 = int(data.get('y2', 0))
             
-            original_image = session['image']
-            cropped = original_image.crop((x1, y1, x2, y2))
-            cropped = cropped.convert('RGBA')
-            
-            result = remove_background_smart(
-                cropped,
-                user_prompt="",
-                original_image=original_image,
-                selected_region=(x1, y1, x2, y2)
-            )
-            
-            user_results[user_id] = result
-            
-            buffer = io.BytesIO()
-            result.save(buffer, format='PNG')
-            img_data = base64.b64encode(buffer.getvalue()).decode()
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('ngrok-skip-browser-warning', 'true')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                'success': True,
-                'data': img_data,
-                'width': result.size[0],
-                'height': result.size[1]
-            }).encode())
+            job = submit_extraction_job(session, user_id, (x1, y1, x2, y2), data.get('prompt', ''))
+            wait_extraction_job(job)
+            self.send_json(200, job_status(job))
             
+        except ComputeBusyError as e:
+            self.send_json(e.status, {'success': False, 'error': str(e), 'retry_after': e.retry_after},
+                           {'Retry-After': str(e.retry_after)})
         except Exception as e:
             error_msg = str(e)
             self.send_response(500)
@@ -1197,6 +4102,41 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
                 'error': error_msg
             }).encode())
     
+    def extract_batch(self, session, user_id, data):
+        """/extract с regions: JSON со статусами задач (async - сразу) или потоковый ZIP (format=zip)"""
+        regions = [tuple(int(region.get(key, 0)) for key in ('x1', 'y1', 'x2', 'y2'))
+                   for region in data['regions']]
+        if not regions:
+            raise ValueError("Список областей пуст")
+        if len(regions) > BATCH_MAX_REGIONS:
+            raise ValueError(f"Не больше {BATCH_MAX_REGIONS} областей за запрос")
+        
+        jobs = submit_extraction_jobs(session, user_id, regions, data.get('prompt', ''))
+        
+        if data.get('format') == 'zip':
+            def finished_files():
+                # В архив в порядке готовности, а не в порядке областей
+                index = {job['future']: i for i, job in enumerate(jobs, 1)}
+                for future in as_completed([job['future'] for job in jobs], timeout=COMPUTE_TIMEOUT):
+                    i = index[future]
+                    job = jobs[i - 1]
+                    try:
+                        _, png = wait_extraction_job(job)
+                        yield f'print_{i}.png', png
+                    except Exception as e:
+                        yield f'print_{i}.error.txt', str(e).encode('utf-8')
+            self.send_zip(finished_files(), 'prints.zip')
+            return
+        
+        if not data.get('async'):
+            for job in jobs:
+                try:
+                    wait_extraction_job(job)
+                except (RuntimeError, ComputeBusyError):
+                    pass
+        self.send_json(200 if not data.get('async') else 202,
+                       {'success': True, 'jobs': [job_status(job) for job in jobs]})
+    
     def handle_extract_ai(self):
         """Обработка ИИ извлечения"""
         try:
@@ -1214,7 +4154,17 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
             if not session or 'image_path' not in session:
                 raise ValueError("Изображение не найдено")
             
-            coords, error = extract_with_ai(session['image_path'], prompt)
+            prompt_lower = prompt.lower()
+            is_entire_image = any(word in prompt_lower for word in ['весь', 'целиком', 'entire', 'whole', 'все',
+                                                                    'со всего', 'from entire', 'from whole'])
+            coords, confidence = (None, 0.0) if is_entire_image else detect_region_for_prompt(session, prompt)
+            source = 'auto'
+            if coords is None:
+                # Локальный детектор не уверен - спрашиваем ИИ
+                coords, error = extract_with_ai(session['image_path'], prompt, session)
+                source = 'ai'
+            else:
+                error = None
             
             if error:
                 self.send_response(200)
@@ -1225,37 +4175,21 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
                 self.wfile.write(json.dumps({'success': False, 'error': error}).encode())
                 return
             
-            original_image = session['image']
             x1, y1, x2, y2 = coords['x1'], coords['y1'], coords['x2'], coords['y2']
-            cropped = original_image.crop((x1, y1, x2, y2))
-            cropped = cropped.convert('RGBA')
+            job = submit_extraction_job(session, user_id, (x1, y1, x2, y2), prompt)
             
-            result = remove_background_smart(
-                cropped,
-                user_prompt=prompt,
-                original_image=original_image,
-                selected_region=(x1, y1, x2, y2)
-            )
-            
-            user_results[user_id] = result
-            
-            buffer = io.BytesIO()
-            result.save(buffer, format='PNG')
-            img_data = base64.b64encode(buffer.getvalue()).decode()
+            # async: только координаты и id задачи, результат клиент заберет через /jobs
+            if data.get('async'):
+                self.send_json(202, {'success': True, 'coords': coords, 'job_id': job['id'],
+                                     'source': source, 'confidence': confidence})
+                return
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('ngrok-skip-browser-warning', 'true')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                'success': True,
-                'coords': coords,
-                'data': img_data,
-                'width': result.size[0],
-                'height': result.size[1]
-            }).encode())
+            wait_extraction_job(job)
+            self.send_json(200, {**job_status(job), 'coords': coords, 'source': source, 'confidence': confidence})
             
+        except ComputeBusyError as e:
+            self.send_json(e.status, {'success': False, 'error': str(e), 'retry_after': e.retry_after},
+                           {'Retry-After': str(e.retry_after)})
         except Exception as e:
             error_msg = str(e)
             self.send_response(500)
@@ -1272,16 +4206,27 @@ class TelegramWebAppHandler(BaseHTTPRequestHandler):
 def main():
     """Главная функция"""
     port = int(os.environ.get('PORT', 8080))
-    server = HTTPServer(('0.0.0.0', port), TelegramWebAppHandler)
+    if BG_ENGINE.startswith('auto') and BG_CALIBRATE:
+        # До запуска пула: воркеры наследуют таблицу выбора
+        for family, ranking in calibrate([get_engine(BG_ENGINE).family]).items():
+            print(f"⚙️  Калибровка движков ({family}): " +
+                  ", ".join(f"{size} -> {names[0]}" for size, names in ranking.items()))
+    compute_backend.start()
+    spool.start()
+    server = ThreadingHTTPServer(('0.0.0.0', port), TelegramWebAppHandler)
+    server.daemon_threads = True
     
     print(f"🌐 Веб-сервер запущен на порту {port}")
     print(f"📱 Web App URL: {os.environ.get('WEB_APP_URL', 'http://localhost:' + str(port))}")
+    print(f"⚙️  Воркеров: {compute_backend.workers}, очередь: {compute_backend.queue_limit}")
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\n🛑 Остановка сервера...")
         server.shutdown()
+    finally:
+        compute_backend.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Реестр движков удаления фона
+
+У всех движков общий интерфейс: engine.remove(image, region, hints) -> RGBA.
+region - (x1, y1, x2, y2) внутри image или None (все изображение), hints - словарь
+подсказок ('prompt', 'threshold', 'edges', 'bg_colors', ...), лишние ключи движки
+игнорируют. Флаги возможностей говорят, что нужно движку и что он умеет.
+
+Движки одного семейства (family) дают одинаковый результат и отличаются только
+скоростью и памятью - между ними и выбирает "auto" по замерам calibrate().
+Движки веб-сервера и ВЕБ_ВЕРСИЯ регистрируются их модулями при импорте, реестр
+подгружает их по требованию (ENGINE_PROVIDERS). Здесь же - общие для них операции
+с масками (серии строк, очистка от островков и дыр).
+"""
+
+import os
+import re
+import sys
+import time
+import importlib
+import threading
+
+from PIL import Image, ImageChops, ImageDraw, ImageMath
+
+_imagemath_eval = getattr(ImageMath, 'unsafe_eval', None) or ImageMath.eval
+
+
+class BackgroundEngine:
+    """Движок удаления фона с флагами возможностей.
+
+    func(image, region, hints) -> RGBA. needs_numpy/needs_cv2 - нужные библиотеки,
+    supports_text - понимает запросы на извлечение текста (hints['prompt']),
+    supports_tiling - сам делит большие изображения на полосы/плитки,
+    bounded_memory - рабочая память не растет с размером изображения,
+    exact - результат совпадает с остальными движками семейства,
+    reference - эталонная (медленная) реализация для сверки: "auto" берет ее, только
+    если в семействе больше ничего нет, и калибровка ее не замеряет.
+    """
+
+    def __init__(self, name, family, func, description='', needs_numpy=False, needs_cv2=False,
+                 supports_text=False, supports_tiling=False, bounded_memory=False, exact=True, reference=False):
+        self.name = name
+        self.family = family
+        self.func = func
+        self.description = description
+        self.needs_numpy = needs_numpy
+        self.needs_cv2 = needs_cv2
+        self.supports_text = supports_text
+        self.supports_tiling = supports_tiling
+        self.bounded_memory = bounded_memory
+        self.exact = exact
+        self.reference = reference
+
+    def available(self):
+        """Установлены ли нужные движку библиотеки"""
+        return (not self.needs_numpy or _has_module('numpy')) and (not self.needs_cv2 or _has_module('cv2'))
+
+    def remove(self, image, region=None, hints=None):
+        if not self.available():
+            missing = [lib for lib, needed in (('numpy', self.needs_numpy), ('opencv-python', self.needs_cv2))
+                       if needed]
+            raise RuntimeError(f"Движку '{self.name}' нужны: {', '.join(missing)}")
+        return self.func(image, tuple(region) if region else None, dict(hints or {}))
+
+    def capabilities(self):
+        return {
+            'name': self.name,
+            'family': self.family,
+            'description': self.description,
+            'available': self.available(),
+            'needs_numpy': self.needs_numpy,
+            'needs_cv2': self.needs_cv2,
+            'supports_text': self.supports_text,
+            'supports_tiling': self.supports_tiling,
+            'bounded_memory': self.bounded_memory,
+            'exact': self.exact,
+            'reference': self.reference,
+        }
+
+    def __repr__(self):
+        return f"<BackgroundEngine {self.name} ({self.family})>"
+
+
+ENGINES = {}
+
+# Движки, которые регистрирует другой модуль при импорте: имя -> (модуль, семейство)
+ENGINE_PROVIDERS = {
+    'pillow': ('TELEGRAM_WEBAPP_SERVER', 'smart'),
+    'pyramid': ('TELEGRAM_WEBAPP_SERVER', 'smart'),
+    'floodfill': ('TELEGRAM_WEBAPP_SERVER', 'smart'),
+    'python': ('TELEGRAM_WEBAPP_SERVER', 'smart'),
+    'streaming': ('TELEGRAM_WEBAPP_SERVER', 'smart'),
+    'text': ('TELEGRAM_WEBAPP_SERVER', 'text'),
+    'advanced': ('ВЕБ_ВЕРСИЯ', 'advanced'),
+    'advanced-numpy': ('ВЕБ_ВЕРСИЯ', 'advanced'),
+    'advanced-pillow': ('ВЕБ_ВЕРСИЯ', 'advanced'),
+    'advanced-python': ('ВЕБ_ВЕРСИЯ', 'advanced'),
+}
+
+# Семейство, из которого "auto" выбирает, если оно не указано ("auto:<семейство>")
+DEFAULT_FAMILY = 'smart'
+
+_modules = {}
+# Модули-поставщики, которые не импортировались: повторно их не ищем
+_failed_providers = set()
+_lock = threading.Lock()
+
+
+def _has_module(name):
+    if name not in _modules:
+        try:
+            importlib.import_module(name)
+            _modules[name] = True
+        except Exception:
+            _modules[name] = False
+    return _modules[name]
+
+
+def register_engine(engine):
+    """Добавляет движок в реестр (повторная регистрация заменяет прежний)"""
+    ENGINES[engine.name] = engine
+    return engine
+
+
+def load_providers(names=None, families=None):
+    """Импортирует модули, регистрирующие движки (все, нужные для names или для семейств families).
+    
+    Уже зарегистрированные движки не трогаем: модуль, запущенный как скрипт (__main__),
+    регистрирует их сам, и второй импорт под своим именем ему не нужен. Модуль, который
+    не импортировался, запоминается и больше не ищется.
+    """
+    modules = {module for name, (module, family) in ENGINE_PROVIDERS.items()
+               if name not in ENGINES and module not in _failed_providers
+               and (names is None or name in names) and (families is None or family in families)}
+    for module in sorted(modules):
+        try:
+            importlib.import_module(module)
+        except (ImportError, SystemExit):
+            # Модуль недоступен в этом окружении - его движков просто не будет
+            _failed_providers.add(module)
+
+
+def get_engine(name='auto'):
+    """Движок по имени; 'auto' или 'auto:<семейство>' - автоматический выбор"""
+    name = (name or 'auto').strip().lower()
+    if name == 'auto' or name.startswith('auto:'):
+        return AutoEngine(name.partition(':')[2] or DEFAULT_FAMILY)
+    if name not in ENGINES:
+        load_providers([name])
+    if name not in ENGINES:
+        raise KeyError(f"Неизвестный движок удаления фона: {name}")
+    return ENGINES[name]
+
+
+def available_engines(family=None):
+    """Доступные движки (с установленными библиотеками) в порядке регистрации"""
+    load_providers(families=None if family is None else [family])
+    return [engine for engine in ENGINES.values()
+            if engine.available() and (family is None or engine.family == family)]
+
+
+def remove_background(image, region=None, hints=None, engine='auto'):
+    """Удаление фона выбранным движком (по имени или "auto")"""
+    return get_engine(engine).remove(image, region, hints)
+
+
+def crop_region(image, region):
+    """Кроп для движков, которым не нужен контекст вокруг выделения"""
+    return image.crop(region) if region else image
+
+
+def is_text_prompt(prompt):
+    prompt_lower = (prompt or '').lower()
+    return any(word in prompt_lower for word in ['текст', 'надпись', 'text', 'inscription',
+                                                   'только текст', 'only text', 'извлеки текст'])
+
+
+# ============================================================================
+# Калибровка: при запуске движки каждого семейства прогоняются на синтетических
+# изображениях, "auto" берет самый быстрый для класса размера
+# ============================================================================
+
+# Классы размера: верхняя граница в пикселях и размер замера
+SIZE_CLASSES = (
+    ('small', 1000000, (256, 256)),
+    ('medium', 16000000, (1024, 768)),
+    ('large', None, None),
+)
+# Движок медленнее лучшего во столько раз на малом замере дальше не замеряется
+CALIBRATION_SLOWDOWN_LIMIT = 10
+
+# {семейство: {класс размера: [имена от быстрого к медленному]}}
+_calibration = {}
+
+
+def size_class(pixels):
+    for name, limit, _ in SIZE_CLASSES:
+        if limit is None or pixels < limit:
+            return name
+    return SIZE_CLASSES[-1][0]
+
+
+def calibration_image(size):
+    """Синтетический снимок: неровный светлый фон с шумом и цветной принт в центре"""
+    width, height = size
+    noise = Image.effect_noise(size, 12).point(lambda v: v // 8)
+    background = Image.merge('RGB', [ImageChops.add(Image.new('L', size, base), noise)
+                                     for base in (228, 226, 222)])
+    draw = ImageDraw.Draw(background)
+    draw.ellipse((width // 4, height // 4, width * 3 // 4, height * 3 // 4), fill=(190, 40, 50))
+    draw.rectangle((width * 3 // 8, height * 3 // 8, width * 5 // 8, height * 5 // 8), fill=(20, 30, 120))
+    draw.text((width // 3, height // 2), "PRINT", fill=(250, 250, 250))
+    return background.convert('RGBA')
+
+
+def calibrate(families=None, repeat=1):
+    """Замеры движков семейств с несколькими доступными реализациями -> таблица выбора"""
+    load_providers(families=families)
+    by_family = {}
+    for engine in ENGINES.values():
+        if (engine.available() and engine.exact and not engine.reference
+                and (families is None or engine.family in families)):
+            by_family.setdefault(engine.family, []).append(engine)
+
+    table = {}
+    for family, engines in by_family.items():
+        timings = {engine.name: [] for engine in engines}
+        candidates = list(engines)
+        for class_name, _, sample_size in SIZE_CLASSES:
+            if sample_size is None or len(candidates) < 2:
+                continue
+            sample = calibration_image(sample_size)
+            for engine in candidates:
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    engine.remove(sample)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[engine.name].append((class_name, best))
+            fastest = min(timings[engine.name][-1][1] for engine in candidates)
+            candidates = [engine for engine in candidates
+                          if timings[engine.name][-1][1] <= fastest * CALIBRATION_SLOWDOWN_LIMIT]
+
+        ranking = {}
+        for class_name, _, sample_size in SIZE_CLASSES:
+            def cost(engine):
+                measured = dict(timings[engine.name])
+                # Не замеренные на этом классе (слишком медленные или класс без замера) -
+                # по последнему замеру, отстав на порядок от замеренных
+                if class_name in measured:
+                    return (0, measured[class_name])
+                return (1, timings[engine.name][-1][1] if timings[engine.name] else float('inf'))
+            ordered = sorted(engines, key=cost)
+            if sample_size is None:
+                # Самый большой класс: прежде всего память, потом скорость
+                ordered.sort(key=lambda engine: not engine.bounded_memory)
+            ranking[class_name] = [engine.name for engine in ordered]
+        table[family] = ranking
+
+    with _lock:
+        _calibration.update(table)
+    return table
+
+
+def choose_engine(family=DEFAULT_FAMILY, pixels=0, text=False):
+    """Движок семейства для изображения pixels пикселей: по калибровке, а без нее - по
+    порядку регистрации (для самого большого класса - сначала движки с ограниченной памятью)"""
+    engines = [engine for engine in available_engines(family) if engine.exact]
+    engines = [engine for engine in engines if not engine.reference] or engines
+    if text:
+        engines = [engine for engine in engines if engine.supports_text] or engines
+    if not engines:
+        raise KeyError(f"Нет доступных движков семейства {family}")
+    class_name = size_class(pixels)
+    ranking = _calibration.get(family, {}).get(class_name)
+    if ranking:
+        order = {name: i for i, name in enumerate(ranking)}
+        return min(engines, key=lambda engine: order.get(engine.name, len(order)))
+    if class_name == SIZE_CLASSES[-1][0]:
+        engines.sort(key=lambda engine: not engine.bounded_memory)
+    return engines[0]
+
+
+class AutoEngine:
+    """"auto": движок семейства выбирается для каждого изображения по его размеру"""
+
+    def __init__(self, family=DEFAULT_FAMILY):
+        self.name = 'auto' if family == DEFAULT_FAMILY else f'auto:{family}'
+        self.family = family
+
+    def choose(self, image, region=None, hints=None):
+        if region:
+            pixels = (region[2] - region[0]) * (region[3] - region[1])
+        else:
+            pixels = image.size[0] * image.size[1]
+        return choose_engine(self.family, pixels, is_text_prompt((hints or {}).get('prompt')))
+
+    def available(self):
+        return bool(available_engines(self.family))
+
+    def remove(self, image, region=None, hints=None):
+        engine = self.choose(image, region, hints)
+        if not engine.supports_text and is_text_prompt((hints or {}).get('prompt')) and 'text' in ENGINES:
+            engine = ENGINES['text']
+        return engine.remove(image, region, hints)
+
+
+# ============================================================================
+# Маски: серии строк и очистка по связным компонентам - общие для движков веб-сервера
+# и ВЕБ_ВЕРСИЯ. Островки непрозрачных пикселей и дыры в принте меньше заданной площади
+# (шум JPEG вокруг принта) убираются; компоненты собираются union-find по сериям строк,
+# время линейно по числу серий, а не пикселей
+# ============================================================================
+
+_RUN_PATTERN = re.compile(rb'[^\x00]+')
+
+
+def mask_runs(mask):
+    """Серии ненулевых пикселей маски L по строкам: [[(x0, x1), ...], ...], x1 не включается"""
+    width, height = mask.size
+    data = mask.tobytes()
+    rows = []
+    for offset in range(0, width * height, width):
+        rows.append([(start - offset, end - offset)
+                     for start, end in (match.span() for match in _RUN_PATTERN.finditer(data, offset, offset + width))])
+    return rows
+
+
+def paint_runs(size, rows, selected):
+    """Маска L: 255 на сериях selected ([(строка, индекс серии), ...])"""
+    width, height = size
+    data = bytearray(width * height)
+    full = b'\xff' * width
+    for y, index in selected:
+        start, end = rows[y][index]
+        data[y * width + start:y * width + end] = full[:end - start]
+    return Image.frombytes('L', size, bytes(data))
+
+
+# Площадь (в пикселях), меньше которой островок принта удаляется; 0 - не удалять
+BG_DESPECKLE_ISLAND = int(os.environ.get('BG_DESPECKLE_ISLAND', 24))
+# Площадь, меньше которой дыра внутри принта (не связанная с рамкой) заливается; 0 - не заливать
+BG_DESPECKLE_HOLE = int(os.environ.get('BG_DESPECKLE_HOLE', 24))
+
+
+def _run_components(rows, diagonal):
+    """Связные компоненты серий (union-find): корень для каждой серии, серии подряд по строкам.
+
+    Серии соседних строк связаны, если их отрезки пересекаются (diagonal - 8-связность:
+    достаточно касания углом). Оба ряда серий отсортированы, поэтому соседи ищутся
+    одним проходом двух указателей.
+    """
+    parent = []
+    reach = 1 if diagonal else 0
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    previous, previous_base = [], 0
+    for row in rows:
+        base = len(parent)
+        count = len(previous)
+        j = 0
+        for i, (start, end) in enumerate(row):
+            # Новая серия - пока сама себе корень; корнем объединения остается меньший номер
+            root = base + i
+            parent.append(root)
+            # Серии сверху, кончающиеся левее start, не касаются и следующих серий строки
+            while j < count and previous[j][1] + reach <= start:
+                j += 1
+            k = j
+            while k < count and previous[k][0] < end + reach:
+                other = find(previous_base + k)
+                if other < root:
+                    parent[root] = other
+                    root = other
+                elif other > root:
+                    parent[other] = root
+                k += 1
+        previous, previous_base = row, base
+    return [find(index) for index in range(len(parent))]
+
+
+def _small_components(rows, width, max_area, diagonal, frozen_top, frozen_bottom, keep_border):
+    """Серии [(строка, индекс серии), ...] компонент площадью меньше max_area.
+
+    Компоненты, задевающие frozen_top верхних или frozen_bottom нижних строк, не трогаются;
+    keep_border - не трогать и компоненты, касающиеся рамки маски.
+    """
+    height = len(rows)
+    roots = _run_components(rows, diagonal)
+    area = [0] * len(roots)
+    index = 0
+    for y, row in enumerate(rows):
+        frozen = y < frozen_top or y >= height - frozen_bottom or (keep_border and (y == 0 or y == height - 1))
+        for start, end in row:
+            root = roots[index]
+            if frozen or (keep_border and (start == 0 or end == width)):
+                # Площадь "бесконечна" - компонента остается как есть
+                area[root] = max_area
+            else:
+                area[root] += end - start
+            index += 1
+
+    small = []
+    index = 0
+    for y, row in enumerate(rows):
+        for i in range(len(row)):
+            if area[roots[index]] < max_area:
+                small.append((y, i))
+            index += 1
+    return small
+
+
+def despeckle_mask(mask, island_area=None, hole_area=None, open_top=0, open_bottom=0):
+    """Маска L (255 - принт) без островков меньше island_area и дыр меньше hole_area.
+
+    Островки - 8-связные компоненты принта (в том числе у рамки), дыры - 4-связные
+    компоненты фона, не касающиеся рамки. По умолчанию площади - BG_DESPECKLE_ISLAND и
+    BG_DESPECKLE_HOLE.
+
+    open_top/open_bottom - для полосы, вырезанной из кропа: столько строк у ее верхнего/
+    нижнего края могут отличаться от маски всего кропа. Компоненты, задевающие их, не
+    меняются, и строки дальше open + island_area + hole_area от края полосы совпадают
+    с очисткой маски целиком.
+    """
+    island_area = BG_DESPECKLE_ISLAND if island_area is None else island_area
+    hole_area = BG_DESPECKLE_HOLE if hole_area is None else hole_area
+    width, _ = mask.size
+    if island_area > 0:
+        rows = mask_runs(mask)
+        islands = _small_components(rows, width, island_area, True, open_top, open_bottom, False)
+        if islands:
+            mask = ImageChops.subtract(mask, paint_runs(mask.size, rows, islands))
+    if hole_area > 0:
+        # Удаленный островок меняет маску еще на island_area строк от открытого края
+        frozen_top = open_top + island_area if open_top and island_area > 0 else open_top
+        frozen_bottom = open_bottom + island_area if open_bottom and island_area > 0 else open_bottom
+        rows = mask_runs(ImageChops.invert(mask))
+        holes = _small_components(rows, width, hole_area, False, frozen_top, frozen_bottom, True)
+        if holes:
+            mask = ImageChops.lighter(mask, paint_runs(mask.size, rows, holes))
+    return mask
+
+
+# ============================================================================
+# Движки настольных версий
+# ============================================================================
+
+def remove_background_light_dark(image, region=None, hints=None):
+    """Порог по каналам из GUI-версий: светлее light по всем каналам - прозрачный белый,
+    темнее dark - прозрачный черный (dark=None - темные не трогаем). Как цикл по getdata()"""
+    hints = hints or {}
+    light, dark = hints.get('light', 230), hints.get('dark', 30)
+    cropped = crop_region(image, region).convert('RGBA')
+    r, g, b, _ = cropped.split()
+    # Все три канала > light  <=>  min(r, g, b) > light
+    lightest = ImageChops.darker(ImageChops.darker(r, g), b)
+    light_mask = lightest.point(lambda v: 255 if v > light else 0)
+    result = Image.composite(Image.new('RGBA', cropped.size, (255, 255, 255, 0)), cropped, light_mask)
+    if dark is not None:
+        darkest = ImageChops.lighter(ImageChops.lighter(r, g), b)
+        dark_mask = ImageChops.subtract(darkest.point(lambda v: 255 if v < dark else 0), light_mask)
+        result = Image.composite(Image.new('RGBA', cropped.size, (0, 0, 0, 0)), result, dark_mask)
+    return result
+
+
+def remove_background_brightness(image, region=None, hints=None):
+    """Порог средней яркости из консольной версии: темнее (255 - threshold) - принт, остальное прозрачно"""
+    threshold = (hints or {}).get('threshold', 50)
+    cropped = crop_region(image, region).convert('RGBA')
+    # (r + g + b) / 3 < 255 - threshold  <=>  r + g + b < 3 * (255 - threshold), сумма - в режиме I
+    r, g, b, _ = cropped.split()
+    alpha = _imagemath_eval('convert(r + g + b < %d, "L")' % (3 * (255 - threshold)), r=r, g=g, b=b)
+    alpha = alpha.point(lambda v: 255 if v else 0)
+    cropped.putalpha(alpha)
+    return cropped
+
+
+def remove_background_opencv(image, region=None, hints=None):
+    """Базовое удаление фона OpenCV из main.py: адаптивный порог + пороги яркости, морфология"""
+    import numpy as np
+    import cv2
+
+    threshold = (hints or {}).get('threshold', 50)
+    img_array = np.array(crop_region(image, region).convert('RGBA'))
+
+    # Создаем маску для удаления фона
+    gray = cv2.cvtColor(img_array[:, :, :3], cv2.COLOR_RGB2GRAY)
+
+    # Адаптивное пороговое значение для удаления однородного фона
+    adaptive_thresh = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY_INV, 11, 2
+    )
+
+    # Предполагаем, что фон светлее принта (типично для одежды)
+    _, mask1 = cv2.threshold(gray, 200 - threshold, 255, cv2.THRESH_BINARY_INV)
+    _, mask2 = cv2.threshold(gray, 50 + threshold // 2, 255, cv2.THRESH_BINARY)
+
+    # Комбинируем маски
+    mask = cv2.bitwise_and(mask1, adaptive_thresh)
+    mask = cv2.bitwise_or(mask, mask2)
+
+    # Улучшаем маску морфологическими операциями
+    kernel = np.ones((5, 5), np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+
+    # Размываем края для плавного перехода
+    mask = cv2.GaussianBlur(mask, (7, 7), 0)
+
+    rgba = img_array.copy()
+    rgba[:, :, 3] = mask
+    return Image.fromarray(rgba, 'RGBA')
+
+
+def remove_background_grabcut(image, region=None, hints=None):
+    """GrabCut из main.py: принт предполагается в центральных 80% изображения"""
+    import numpy as np
+    import cv2
+
+    img_array = np.array(crop_region(image, region).convert('RGBA'))
+    rgb = np.ascontiguousarray(img_array[:, :, :3])
+
+    # Создаем маску для GrabCut
+    mask = np.zeros(rgb.shape[:2], np.uint8)
+    bgd_model = np.zeros((1, 65), np.float64)
+    fgd_model = np.zeros((1, 65), np.float64)
+
+    height, width = rgb.shape[:2]
+    rect = (int(width * 0.1), int(height * 0.1),
+            int(width * 0.8), int(height * 0.8))
+
+    cv2.grabCut(rgb, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
+
+    # Создаем финальную маску
+    mask2 = np.where((mask == 2) | (mask == 0), 0, 255).astype('uint8')
+
+    # Улучшаем маску
+    kernel = np.ones((5, 5), np.uint8)
+    mask2 = cv2.morphologyEx(mask2, cv2.MORPH_CLOSE, kernel)
+    mask2 = cv2.morphologyEx(mask2, cv2.MORPH_OPEN, kernel)
+    mask2 = cv2.GaussianBlur(mask2, (5, 5), 0)
+
+    rgba = img_array.copy()
+    rgba[:, :, 3] = mask2
+    return Image.fromarray(rgba, 'RGBA')
+
+
+register_engine(BackgroundEngine(
+    'lightdark', 'lightdark', remove_background_light_dark,
+    "Порог по каналам (GUI-версии): светлое и темное - прозрачно"))
+register_engine(BackgroundEngine(
+    'brightness', 'brightness', remove_background_brightness,
+    "Порог средней яркости (консольная версия), hints['threshold']"))
+register_engine(BackgroundEngine(
+    'opencv', 'opencv', remove_background_opencv,
+    "Адаптивный порог и морфология OpenCV (main.py), hints['threshold']",
+    needs_numpy=True, needs_cv2=True))
+register_engine(BackgroundEngine(
+    'grabcut', 'grabcut', remove_background_grabcut,
+    "GrabCut OpenCV по центральной области (main.py)",
+    needs_numpy=True, needs_cv2=True))
+
+
+if __name__ == '__main__':
+    # Список движков и калибровка: python3 background_engines.py
+    # Модули-поставщики регистрируют движки в "background_engines" - это и есть мы
+    sys.modules.setdefault('background_engines', sys.modules[__name__])
+    for engine in available_engines():
+        flags = [key for key, value in engine.capabilities().items() if value is True and key != 'available']
+        print(f"{engine.name:16} {engine.family:12} {', '.join(flags)}")
+    for family, ranking in calibrate().items():
+        print(family, ranking)
@@ -17,32 +17,48 @@ def lazy_import_modules():
     except ImportError as e:
         return False, None, None, None, str(e)
 
-def remove_background_pil(image_path, output_path, threshold=50):
-    """Удаление фона используя только PIL (без OpenCV)"""
+# Движок удаления фона из реестра background_engines.py ('auto', 'pillow', 'lightdark', ...);
+# не задан - как раньше: OpenCV, если установлен, иначе порог яркости
+BG_ENGINE = os.environ.get('BG_ENGINE', '').strip().lower()
+
+def remove_background_engine(image_path, output_path, engine, threshold=50):
+    """Удаление фона движком реестра по имени"""
     try:
         from PIL import Image
-        import numpy as np
+        from background_engines import get_engine
         
-        # Открываем изображение
-        img = Image.open(image_path).convert('RGBA')
-        img_array = np.array(img)
-        
-        # Простой алгоритм удаления фона на основе яркости
-        # Предполагаем, что фон светлее принта
-        gray = img_array[:, :, :3].mean(axis=2)  # Средняя яркость
-        mask = gray < (255 - threshold)  # Все темнее порога - принт
-        
-        # Создаем альфа-канал
-        alpha = np.ones((img_array.shape[0], img_array.shape[1]), dtype=np.uint8) * 255
-        alpha[mask] = 255
-        alpha[~mask] = 0
+        result = get_engine(engine).remove(Image.open(image_path), hints={'threshold': threshold})
+        result.save(output_path, "PNG")
+        return True, None
         
-        # Применяем маску
-        img_array[:, :, 3] = alpha
-        result = Image.fromarray(img_array, 'RGBA')
+    except Exception as e:
+        return False, str(e)
+
+def remove_background_pil(image_path, output_path, threshold=50):
+    """Удаление фона используя только PIL (без OpenCV): все темнее порога яркости - принт"""
+    return remove_background_engine(image_path, output_path, 'brightness', threshold)
+
+# Макеты от этого размера обрабатываются потоковым движком веб-сервера
+LARGE_IMAGE_PIXELS = 16000000
+
+def is_large_image(image_path):
+    """Большой ли файл (размер читается из заголовка, без декодирования)"""
+    try:
+        from PIL import Image
+        with Image.open(image_path) as probe:
+            width, height = probe.size
+        return width * height >= LARGE_IMAGE_PIXELS
+    except Exception:
+        return False
+
+def remove_background_streaming(image_path, output_path):
+    """Удаление фона для больших макетов: изображение проходит полосами, PNG пишется
+    по мере готовности - не нужны полноразмерные маски и списки пикселей"""
+    try:
+        from PIL import Image
+        from TELEGRAM_WEBAPP_SERVER import remove_background_streaming as stream_engine
         
-        # Сохраняем результат
-        result.save(output_path, "PNG")
+        stream_engine(Image.open(image_path), output_path)
         return True, None
         
     except Exception as e:
@@ -131,7 +147,24 @@ def main():
         
         # Удаление фона
         print("\n1. Удаление фона...")
-        if has_opencv:
+        streamed = False
+        if is_large_image(image_path):
+            print("Большое изображение - обработка полосами...")
+            streamed, error = remove_background_streaming(image_path, str(output_path))
+            if streamed:
+                print("✓ Фон удален (потоковый метод)")
+            else:
+                print(f"⚠ Ошибка потокового метода: {error}")
+        
+        if streamed:
+            pass
+        elif BG_ENGINE:
+            success, error = remove_background_engine(image_path, str(output_path), BG_ENGINE)
+            if not success:
+                print(f"❌ Ошибка: {error}")
+                continue
+            print(f"✓ Фон удален (движок {BG_ENGINE})")
+        elif has_opencv:
             # Используем более продвинутый метод
             try:
                 img = Image.open(image_path).convert('RGBA')
@@ -11,36 +11,9 @@ from PIL import Image, ImageTk, ImageEnhance, ImageFilter
 import os
 from pathlib import Path
 
-# Отложенная загрузка numpy и cv2 для избежания системных крашей на macOS
-# Эти модули будут импортированы только при реальном использовании
-_numpy_loaded = False
-_cv2_loaded = False
-np = None
-cv2 = None
-
-def lazy_import_numpy():
-    """Ленивая загрузка numpy"""
-    global np, _numpy_loaded
-    if not _numpy_loaded:
-        try:
-            import numpy as _np
-            np = _np
-            _numpy_loaded = True
-        except Exception as e:
-            raise ImportError(f"Не удалось загрузить numpy: {e}")
-    return np
-
-def lazy_import_cv2():
-    """Ленивая загрузка cv2"""
-    global cv2, _cv2_loaded
-    if not _cv2_loaded:
-        try:
-            import cv2 as _cv2
-            cv2 = _cv2
-            _cv2_loaded = True
-        except Exception as e:
-            raise ImportError(f"Не удалось загрузить opencv-python: {e}")
-    return cv2
+# Алгоритмы удаления фона - в общем реестре движков; numpy и cv2 импортируются
+# только при реальном использовании, чтобы избежать системных крашей на macOS
+from background_engines import ENGINES, get_engine
 
 # rembg полностью исключен из программы из-за проблем совместимости с macOS
 # Используются только методы OpenCV и GrabCut, которые работают стабильно
@@ -126,7 +99,12 @@ class PrintExtractor:
         # Определяем доступные методы
         # Используем только стабильные методы, которые работают на всех системах
         available_methods = ["opencv", "grabcut"]
-        # Пользователь может использовать opencv или grabcut - они работают отлично
+        # Остальные движки настольных версий из реестра (с установленными библиотеками).
+        # Движки сервера и ВЕБ_ВЕРСИЯ не подгружаем: их модули заводят сессии, каталог
+        # временных файлов и кэш ИИ, а эталонные циклы в списке не нужны
+        available_methods += [engine.name for engine in ENGINES.values()
+                              if engine.available() and not engine.reference
+                              and engine.name not in available_methods]
         
         self.bg_method_var = tk.StringVar(value=available_methods[0])
         bg_method_combo = ttk.Combobox(
@@ -281,13 +259,9 @@ class PrintExtractor:
         try:
             method = self.bg_method_var.get()
             
-            # Пробуем использовать выбранный метод
-            if method == "grabcut":
-                # Используем GrabCut для более точного удаления
-                self.remove_background_grabcut()
-            else:
-                # Базовый OpenCV метод
-                self.remove_background_opencv()
+            # Выбранный движок реестра; порог нужен opencv и brightness
+            self.processed_image = get_engine(method).remove(
+                self.original_image, hints={'threshold': self.threshold_var.get()})
             
             self.display_images()
             messagebox.showinfo("Успех", "Фон удален!")
@@ -295,91 +269,6 @@ class PrintExtractor:
         except Exception as e:
             messagebox.showerror("Ошибка", f"Ошибка при удалении фона: {str(e)}")
     
-    def remove_background_grabcut(self):
-        """Удаление фона с помощью GrabCut алгоритма"""
-        try:
-            np = lazy_import_numpy()
-            cv2 = lazy_import_cv2()
-        except ImportError as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить необходимые модули: {e}")
-            return
-        
-        img_array = np.array(self.original_image)
-        rgb = img_array[:, :, :3]
-        
-        # Создаем маску для GrabCut
-        mask = np.zeros(rgb.shape[:2], np.uint8)
-        bgd_model = np.zeros((1, 65), np.float64)
-        fgd_model = np.zeros((1, 65), np.float64)
-        
-        # Определяем прямоугольник вокруг центральной части (предполагаем, что принт в центре)
-        height, width = rgb.shape[:2]
-        rect = (int(width * 0.1), int(height * 0.1), 
-                int(width * 0.8), int(height * 0.8))
-        
-        # Применяем GrabCut
-        cv2.grabCut(rgb, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
-        
-        # Создаем финальную маску
-        mask2 = np.where((mask == 2) | (mask == 0), 0, 255).astype('uint8')
-        
-        # Улучшаем маску
-        kernel = np.ones((5, 5), np.uint8)
-        mask2 = cv2.morphologyEx(mask2, cv2.MORPH_CLOSE, kernel)
-        mask2 = cv2.morphologyEx(mask2, cv2.MORPH_OPEN, kernel)
-        mask2 = cv2.GaussianBlur(mask2, (5, 5), 0)
-        
-        # Применяем маску
-        rgba = img_array.copy()
-        rgba[:, :, 3] = mask2
-        
-        self.processed_image = Image.fromarray(rgba, 'RGBA')
-    
-    def remove_background_opencv(self):
-        """Базовое удаление фона с помощью OpenCV"""
-        try:
-            np = lazy_import_numpy()
-            cv2 = lazy_import_cv2()
-        except ImportError as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить необходимые модули: {e}")
-            return
-        
-        img_array = np.array(self.original_image)
-        threshold = self.threshold_var.get()
-        
-        # Создаем маску для удаления фона
-        gray = cv2.cvtColor(img_array[:, :, :3], cv2.COLOR_RGB2GRAY)
-        
-        # Адаптивное пороговое значение для удаления однородного фона
-        # Используем адаптивный метод для лучшей работы с разным освещением
-        adaptive_thresh = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY_INV, 11, 2
-        )
-        
-        # Дополнительная обработка для удаления фона
-        # Предполагаем, что фон светлее принта (типично для одежды)
-        _, mask1 = cv2.threshold(gray, 200 - threshold, 255, cv2.THRESH_BINARY_INV)
-        _, mask2 = cv2.threshold(gray, 50 + threshold // 2, 255, cv2.THRESH_BINARY)
-        
-        # Комбинируем маски
-        mask = cv2.bitwise_and(mask1, adaptive_thresh)
-        mask = cv2.bitwise_or(mask, mask2)
-        
-        # Улучшаем маску морфологическими операциями
-        kernel = np.ones((5, 5), np.uint8)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-        
-        # Размываем края для плавного перехода
-        mask = cv2.GaussianBlur(mask, (7, 7), 0)
-        
-        # Создаем RGBA изображение
-        rgba = img_array.copy()
-        rgba[:, :, 3] = mask
-        
-        self.processed_image = Image.fromarray(rgba, 'RGBA')
-    
     def enhance_quality(self):
         """Улучшение качества изображения"""
         if not self.processed_image:
@@ -10,6 +10,7 @@ import os
 import json
 import base64
 import io
+import importlib.util
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import webbrowser
 import threading
@@ -17,17 +18,45 @@ import urllib.parse
 from collections import Counter
 
 try:
-    from PIL import Image, ImageFilter, ImageChops
+    from PIL import Image, ImageFilter, ImageChops, ImageMath
 except ImportError:
     print("❌ Pillow не установлен. Установите: pip3 install Pillow")
     sys.exit(1)
 
-def detect_strong_edges(image):
-    """Обнаружение только сильных краев (игнорируя шум)"""
-    # Конвертируем в grayscale и применяем легкое размытие для уменьшения шума
-    gray = image.convert('L')
-    gray = gray.filter(ImageFilter.GaussianBlur(radius=0.5))  # Легкое размытие для удаления шума
-    
+# Реестр движков удаления фона (BG_ENGINE - имя движка или 'auto') и очистка маски от островков
+# шума и мелких дыр, общая с сервером. background_engines.py лежит рядом и нужен обязательно
+from background_engines import BackgroundEngine, register_engine, get_engine, despeckle_mask
+
+BG_ENGINE = os.environ.get('BG_ENGINE', 'advanced').strip().lower()
+
+# numpy необязателен: без него края и маска считаются операциями Pillow. Сам модуль
+# импортируют numpy-функции при вызове, здесь только проверяем, что он установлен
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
+# ImageMath.eval переименован в unsafe_eval в Pillow 11; выражения у нас константные
+_imagemath_eval = getattr(ImageMath, 'unsafe_eval', None) or ImageMath.eval
+
+# ВЫСОКИЙ порог для сильных краев (фильтруем шум агрессивно)
+EDGE_THRESHOLD = 70
+# Край, рядом с которым пиксель никогда не удаляется (только явные края объектов)
+PROTECTED_EDGE = 100
+# Порог цветового расстояния до фона (для защищенных краев фон не удаляется вовсе)
+BG_DISTANCE = 35
+
+# Sobel 3x3 для Pillow: ядра в режиме I не обрезают результат сверху,
+# а отрицательные значения сдвигаем на SOBEL_OFFSET
+SOBEL_X = ImageFilter.Kernel((3, 3), [-1, 0, 1, -2, 0, 2, -1, 0, 1], scale=1, offset=1020)
+SOBEL_Y = ImageFilter.Kernel((3, 3), [-1, -2, -1, 0, 0, 0, 1, 2, 1], scale=1, offset=1020)
+SOBEL_OFFSET = 1020
+
+
+def _blurred_gray(image):
+    """Grayscale с легким размытием для уменьшения шума"""
+    return image.convert('L').filter(ImageFilter.GaussianBlur(radius=0.5))
+
+
+def detect_strong_edges_python(gray):
+    """Эталон: Sobel двойным циклом по пикселям (медленно, только для сверки)"""
     width, height = gray.size
     gray_data = list(gray.getdata())
     
@@ -35,9 +64,6 @@ def detect_strong_edges(image):
     edge_map = Image.new('L', (width, height), 0)
     edge_pixels = [0] * (width * height)
     
-    # ВЫСОКИЙ порог для сильных краев (фильтруем шум агрессивно)
-    edge_threshold = 70  # Только действительно сильные края
-    
     for y in range(1, height - 1):
         for x in range(1, width - 1):
             idx = y * width + x
@@ -55,89 +81,119 @@ def detect_strong_edges(image):
             edge_strength = (gx + gy) / 8  # Нормализуем
             
             # Только СИЛЬНЫЕ края (фильтруем шум)
-            if edge_strength > edge_threshold:
+            if edge_strength > EDGE_THRESHOLD:
                 edge_pixels[idx] = min(255, int(edge_strength))
     
     edge_map.putdata(edge_pixels)
-    
-    # Легкое морфологическое закрытие для соединения близких краев (только для текста/линий)
-    edge_map = edge_map.filter(ImageFilter.MaxFilter(size=1))
-    
     return edge_map
 
-def remove_background_advanced(image):
-    """Продвинутое удаление фона с защитой тонких деталей"""
-    width, height = image.size
-    
-    # Конвертируем в RGBA если еще не
-    if image.mode != 'RGBA':
-        image = image.convert('RGBA')
-    
-    # ОБНАРУЖЕНИЕ КРАЕВ - только сильные края (игнорируя шум)
-    edge_map = detect_strong_edges(image)
-    edge_data = list(edge_map.getdata())
-    
-    # Получаем данные пикселей оригинала
-    pixels = list(image.getdata())
-    
-    # Анализируем края изображения для определения фона
-    edge_colors = []
+
+def detect_strong_edges_pillow(gray):
+    """Sobel ядрами Pillow в целочисленном режиме I - те же значения, что у эталона"""
+    width, height = gray.size
+    edge_map = Image.new('L', (width, height), 0)
+    if width < 3 or height < 3:
+        return edge_map
+    gray = gray.convert('I')
+    # Рамку в 1 пиксель эталон не считает - ядра берем только для внутренних пикселей
+    box = (1, 1, width - 1, height - 1)
+    strength = _imagemath_eval(
+        'abs(gx - offset) + abs(gy - offset)',
+        gx=gray.filter(SOBEL_X).crop(box), gy=gray.filter(SOBEL_Y).crop(box), offset=SOBEL_OFFSET)
+    # (gx + gy) / 8 > 70 и int() от неотрицательного - целочисленное деление
+    strong = _imagemath_eval('convert(min((s / 8) * (s > %d), 255), "L")' % (EDGE_THRESHOLD * 8),
+                             s=strength)
+    edge_map.paste(strong, (1, 1))
+    return edge_map
+
+
+def detect_strong_edges_numpy(gray):
+    """Sobel на массивах numpy (или cv2.Sobel, если есть OpenCV)"""
+    import numpy as np
     
-    # Верхняя и нижняя границы
+    width, height = gray.size
+    edges = np.zeros((height, width), dtype=np.uint8)
+    if width < 3 or height < 3:
+        return Image.fromarray(edges)
+    data = np.asarray(gray)
+    try:
+        # OpenCV подгружаем только здесь: сама веб-версия нативных библиотек не требует
+        import cv2
+        gx = np.abs(cv2.Sobel(data, cv2.CV_16S, 1, 0, ksize=3)[1:-1, 1:-1].astype(np.int32))
+        gy = np.abs(cv2.Sobel(data, cv2.CV_16S, 0, 1, ksize=3)[1:-1, 1:-1].astype(np.int32))
+    except ImportError:
+        data = data.astype(np.int32)
+        gx = np.abs(data[:-2, 2:] + 2 * data[1:-1, 2:] + data[2:, 2:]
+                    - data[:-2, :-2] - 2 * data[1:-1, :-2] - data[2:, :-2])
+        gy = np.abs(data[2:, :-2] + 2 * data[2:, 1:-1] + data[2:, 2:]
+                    - data[:-2, :-2] - 2 * data[:-2, 1:-1] - data[:-2, 2:])
+    strength = gx + gy
+    edges[1:-1, 1:-1] = np.where(strength > EDGE_THRESHOLD * 8, np.minimum(strength // 8, 255), 0)
+    return Image.fromarray(edges)
+
+
+def detect_strong_edges(image, backend=None):
+    """Обнаружение только сильных краев (игнорируя шум)"""
+    backend = backend or _default_backend()
+    detect = {'python': detect_strong_edges_python,
+              'pillow': detect_strong_edges_pillow,
+              'numpy': detect_strong_edges_numpy}[backend]
+    # Морфологическое закрытие MaxFilter(size=1) ничего не меняло (окно из одного пикселя)
+    # и в свежих Pillow роняет процесс - его больше нет
+    return detect(_blurred_gray(image))
+
+
+def _default_backend():
+    return 'numpy' if HAS_NUMPY else 'pillow'
+
+
+def _border_background_colors(image):
+    """Три самых частых цвета по краям изображения (фон)"""
+    width, height = image.size
+    rgb = image.convert('RGB')
+    top = list(rgb.crop((0, 0, width, 1)).getdata())
+    bottom = list(rgb.crop((0, height - 1, width, height)).getdata())
+    left = list(rgb.crop((0, 0, 1, height)).getdata())
+    right = list(rgb.crop((width - 1, 0, width, height)).getdata())
+    
+    # Порядок обхода как раньше: верх/низ по x, потом лево/право по y -
+    # от него зависит, какой цвет победит при равных счетчиках
+    edge_colors_rgb = []
     for x in range(width):
-        edge_colors.append(pixels[x])  # Верх
-        edge_colors.append(pixels[(height-1) * width + x])  # Низ
-    
-    # Левая и правая границы
+        edge_colors_rgb.append(top[x])
+        edge_colors_rgb.append(bottom[x])
     for y in range(height):
-        edge_colors.append(pixels[y * width])  # Лево
-        edge_colors.append(pixels[y * width + width - 1])  # Право
+        edge_colors_rgb.append(left[y])
+        edge_colors_rgb.append(right[y])
     
-    # Находим наиболее распространенный цвет на краях (фон)
-    edge_colors_rgb = [(r, g, b) for r, g, b, a in edge_colors]
     if edge_colors_rgb:
-        most_common_colors = Counter(edge_colors_rgb).most_common(3)
-        bg_colors = [color for color, count in most_common_colors]
-    else:
-        bg_colors = [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
-    
-    # Создаем новое изображение с прозрачностью
-    new_pixels = []
-    
-    for i, pixel in enumerate(pixels):
-        r, g, b, a = pixel
-        y_pos = i // width
-        x_pos = i % width
-        
-        # Получаем силу края для этого пикселя
-        edge_strength = edge_data[i] if i < len(edge_data) else 0
+        return [color for color, count in Counter(edge_colors_rgb).most_common(3)]
+    return [(255, 255, 255), (240, 240, 240), (200, 200, 200)]
+
+
+def _background_mask_python(image, edge_map, bg_colors):
+    """Эталон: классификация фона циклом по пикселям -> маска L (255 - фон)"""
+    edge_data = list(edge_map.getdata())
+    mask_pixels = []
+    
+    for i, pixel in enumerate(image.getdata()):
+        r, g, b = pixel[:3]
         
         # Если это ОЧЕНЬ СИЛЬНЫЙ край - защищаем пиксель (не удаляем!)
-        # Используем очень высокий порог чтобы фильтровать весь шум
-        is_edge = edge_strength > 100  # Очень высокий порог - только явные края объектов
+        if edge_data[i] > PROTECTED_EDGE:
+            mask_pixels.append(0)
+            continue
         
         # Проверяем, является ли пиксель фоном
         min_distance = float('inf')
-        
         for bg_r, bg_g, bg_b in bg_colors:
-            # Вычисляем расстояние цвета (чувствительность)
             color_distance = ((r - bg_r) ** 2 + (g - bg_g) ** 2 + (b - bg_b) ** 2) ** 0.5
             min_distance = min(min_distance, color_distance)
         
-        # АДАПТИВНЫЙ ПОРОГ
-        if is_edge:
-            # Для краев используем более строгий порог, но не слишком строгий
-            # чтобы не удалить края, которые немного похожи на фон
-            threshold = 30  # Защита деталей, но не слишком мягко
-        else:
-            # Для остальных пикселей - нормальный порог
-            threshold = 35
-        
-        is_background = min_distance < threshold
+        is_background = min_distance < BG_DISTANCE
         
         # Дополнительная проверка: очень светлые или очень темные пиксели
-        # НО! Не удаляем если это сильный край!
-        if not is_background and not is_edge:
+        if not is_background:
             # Очень светлый фон (белый, светло-серый) - более строгая проверка
             if r > 250 and g > 250 and b > 250:
                 is_background = True
@@ -147,53 +203,145 @@ def remove_background_advanced(image):
             # Однотонный серый фон - только очень явный фон
             elif abs(r - g) < 10 and abs(g - b) < 10 and abs(r - b) < 10:
                 avg_brightness = (r + g + b) / 3
-                if avg_brightness > 230:  # Очень светлый серый (почти белый)
-                    is_background = True
-                elif avg_brightness < 30:  # Очень темный серый (почти черный)
+                if avg_brightness > 230 or avg_brightness < 30:
                     is_background = True
         
-        # Если это край - НИКОГДА не удаляем, даже если похож на фон!
-        if is_edge and is_background:
-            is_background = False
-        
-        if is_background:
-            # Делаем пиксель прозрачным
-            # Для фона делаем полностью прозрачным без плавности (меньше артефактов)
-            new_pixels.append((255, 255, 255, 0))
-        else:
-            # Оставляем пиксель полностью непрозрачным
-            new_pixels.append((r, g, b, 255))
+        mask_pixels.append(255 if is_background else 0)
     
-    # Создаем новое изображение
-    result = Image.new('RGBA', (width, height))
-    result.putdata(new_pixels)
+    mask = Image.new('L', image.size, 0)
+    mask.putdata(mask_pixels)
+    return mask
+
+
+_SQUARE_LUT = [i * i for i in range(256)]
+
+
+def _band_mask(band, test):
+    return band.point(lambda v: 255 if test(v) else 0)
+
+
+def _all_bands(bands, test):
+    mask = _band_mask(bands[0], test)
+    for band in bands[1:]:
+        mask = ImageChops.darker(mask, _band_mask(band, test))
+    return mask
+
+
+def _background_mask_pillow(image, edge_map, bg_colors):
+    """Классификация фона операциями Pillow над целыми каналами"""
+    rgb = image.convert('RGB')
+    bands = rgb.split()
+    
+    # Квадрат расстояния до ближайшего цвета фона: d < 35 <=> d ** 2 < 1225
+    min_dist_sq = None
+    for color in bg_colors:
+        squares = {name: ImageChops.difference(band, Image.new('L', band.size, value)).point(_SQUARE_LUT, 'I')
+                   for name, band, value in zip('rgb', bands, color)}
+        dist_sq = _imagemath_eval('r + g + b', **squares)
+        min_dist_sq = dist_sq if min_dist_sq is None else _imagemath_eval('min(a, b)', a=min_dist_sq, b=dist_sq)
+    near = _imagemath_eval('convert(d < %d, "L")' % (BG_DISTANCE * BG_DISTANCE), d=min_dist_sq)
+    background = _band_mask(near, lambda v: v > 0)
+    
+    # Очень светлые и очень темные пиксели
+    background = ImageChops.lighter(background, _all_bands(bands, lambda v: v > 250))
+    background = ImageChops.lighter(background, _all_bands(bands, lambda v: v < 20))
+    
+    # Однотонный серый: попарные разницы < 10 и среднее > 230 или < 30,
+    # т.е. r + g + b - 690 > 0 или 90 - (r + g + b) > 0 (матрица конвертации)
+    r, g, b = bands
+    gray = _all_bands([ImageChops.difference(r, g), ImageChops.difference(g, b), ImageChops.difference(r, b)],
+                      lambda v: v < 10)
+    extreme = ImageChops.lighter(_band_mask(rgb.convert('L', matrix=(1, 1, 1, -690)), lambda v: v > 0),
+                                 _band_mask(rgb.convert('L', matrix=(-1, -1, -1, 90)), lambda v: v > 0))
+    background = ImageChops.lighter(background, ImageChops.darker(gray, extreme))
+    
+    # Сильные края не удаляем никогда
+    return ImageChops.darker(background, _band_mask(edge_map, lambda v: v <= PROTECTED_EDGE))
+
+
+def _background_mask_numpy(image, edge_map, bg_colors):
+    """Классификация фона на массивах numpy"""
+    import numpy as np
+    
+    rgb = np.asarray(image.convert('RGB'))
+    r, g, b = (rgb[:, :, channel].astype(np.int32) for channel in range(3))
+    
+    min_dist_sq = None
+    for bg_r, bg_g, bg_b in bg_colors:
+        dist_sq = (r - bg_r) ** 2 + (g - bg_g) ** 2 + (b - bg_b) ** 2
+        min_dist_sq = dist_sq if min_dist_sq is None else np.minimum(min_dist_sq, dist_sq)
+    background = min_dist_sq < BG_DISTANCE * BG_DISTANCE
+    
+    background |= (r > 250) & (g > 250) & (b > 250)
+    background |= (r < 20) & (g < 20) & (b < 20)
+    total = r + g + b
+    background |= ((np.abs(r - g) < 10) & (np.abs(g - b) < 10) & (np.abs(r - b) < 10)
+                   & ((total > 690) | (total < 90)))
+    
+    background &= np.asarray(edge_map) <= PROTECTED_EDGE
+    return Image.fromarray(background.astype(np.uint8) * 255)
+
+
+def remove_background_advanced(image, backend=None):
+    """Продвинутое удаление фона с защитой тонких деталей.
     
-    # Постобработка: очистка шума и артефактов
-    # Создаем маску
-    mask = Image.new('L', (width, height), 0)
-    mask_pixels = []
+    backend: 'numpy' (по умолчанию, если есть numpy), 'pillow' или 'python' (эталонные циклы) -
+    маска у всех одна и та же.
+    """
+    backend = backend or _default_backend()
+    width, height = image.size
     
-    for pixel in new_pixels:
-        if pixel[3] > 0:  # Если не прозрачный
-            mask_pixels.append(255)
-        else:
-            mask_pixels.append(0)
+    # Конвертируем в RGBA если еще не
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
     
-    mask.putdata(mask_pixels)
+    # ОБНАРУЖЕНИЕ КРАЕВ - только сильные края (игнорируя шум)
+    edge_map = detect_strong_edges(image, backend)
     
-    # МОРФОЛОГИЧЕСКАЯ ОЧИСТКА - удаляем мелкие изолированные пиксели (шум)
-    # Закрытие для соединения близких областей
-    mask = mask.filter(ImageFilter.MaxFilter(size=1))
-    # Открытие для удаления мелких отверстий
-    mask = mask.filter(ImageFilter.MinFilter(size=1))
+    # Анализируем края изображения для определения фона
+    bg_colors = _border_background_colors(image)
+    
+    classify = {'python': _background_mask_python,
+                'pillow': _background_mask_pillow,
+                'numpy': _background_mask_numpy}[backend]
+    background = classify(image, edge_map, bg_colors)
+    
+    # Маска непрозрачных пикселей без островков шума и мелких дыр (см. despeckle_mask)
+    mask = despeckle_mask(ImageChops.invert(background))
+    
+    # Фон - полностью прозрачный белый без плавности (меньше артефактов),
+    # остальное - исходный цвет, полностью непрозрачный
+    transparent = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+    result = image.copy()
+    result.putalpha(255)
+    result.paste(transparent, mask=ImageChops.invert(mask))
     
     # Применяем очень легкое размытие только к маске для плавных краев
     mask = mask.filter(ImageFilter.GaussianBlur(radius=0.3))
     
     # Применяем маску к результату
-    result = Image.composite(result, Image.new('RGBA', (width, height), (255, 255, 255, 0)), mask)
-    
-    return result
+    return Image.composite(result, transparent, mask)
+
+
+# Движки этого модуля в общем реестре (семейство 'advanced')
+def _advanced_engine(backend):
+    return lambda image, region, hints: remove_background_advanced(
+        image.crop(region) if region else image, backend)
+
+
+register_engine(BackgroundEngine(
+    'advanced', 'advanced', _advanced_engine(None),
+    "Защита тонких деталей по сильным краям (ВЕБ_ВЕРСИЯ): numpy, если есть, иначе Pillow"))
+register_engine(BackgroundEngine(
+    'advanced-numpy', 'advanced', _advanced_engine('numpy'),
+    "То же на массивах numpy (Sobel через OpenCV, если он есть)", needs_numpy=True))
+register_engine(BackgroundEngine(
+    'advanced-pillow', 'advanced', _advanced_engine('pillow'),
+    "То же ядрами и ImageMath Pillow, без numpy"))
+register_engine(BackgroundEngine(
+    'advanced-python', 'advanced', _advanced_engine('python'),
+    "Эталонные циклы по пикселям", reference=True))
+
 
 # Глобальные переменные для хранения данных
 global_image = None
@@ -321,7 +469,7 @@ class WebHandler(BaseHTTPRequestHandler):
             cropped = cropped.convert('RGBA')
             
             # УЛУЧШЕННОЕ УДАЛЕНИЕ ФОНА
-            cropped = remove_background_advanced(cropped)
+            cropped = get_engine(BG_ENGINE).remove(cropped)
             global_result = cropped
             
             # Конвертируем в base64 для отправки
@@ -52,6 +52,14 @@ except ImportError:
         HAS_OPENAI = False
         # Не выводим ошибку - ИИ функции будут недоступны, но программа продолжит работу
 
+# numpy необязателен - с ним удаление фона для текста векторизовано
+HAS_NUMPY = False
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
 # Глобальные переменные
 global_image = None
 global_result = None
@@ -283,11 +291,87 @@ Do not include any other text, explanations, or formatting."""
     except Exception as e:
         return None, f"Ошибка ИИ: {str(e)}"
 
+def _dilate(mask, radius):
+    """Дилатация булевой маски квадратом (2 * radius + 1) - есть ли True в окрестности"""
+    height, width = mask.shape
+    rows = np.zeros_like(mask)
+    for dx in range(-radius, radius + 1):
+        if dx >= 0:
+            rows[:, :width - dx] |= mask[:, dx:]
+        else:
+            rows[:, -dx:] |= mask[:, :width + dx]
+    result = np.zeros_like(mask)
+    for dy in range(-radius, radius + 1):
+        if dy >= 0:
+            result[:height - dy, :] |= rows[dy:, :]
+        else:
+            result[-dy:, :] |= rows[:height + dy, :]
+    return result
+
+def _min_filter(gray):
+    """Минимум яркости по окрестности 3x3 (за краем изображения соседей нет)"""
+    rows = gray.copy()
+    np.minimum(rows[:, :-1], gray[:, 1:], out=rows[:, :-1])
+    np.minimum(rows[:, 1:], gray[:, :-1], out=rows[:, 1:])
+    result = rows.copy()
+    np.minimum(result[:-1], rows[1:], out=result[:-1])
+    np.minimum(result[1:], rows[:-1], out=result[1:])
+    return result
+
+def _remove_background_for_text_numpy(image):
+    """
+    Векторизованная версия remove_background_for_text - результат совпадает побайтно.
+    Три прохода с проверкой соседей заменены минимумом яркости по окрестности
+    (есть темный сосед <=> минимум темнее порога), медиана берется из 256-бинной
+    гистограммы вместо сортировки
+    """
+    width, height = image.size
+    gray_image = image.convert('L')
+    gray = np.asarray(gray_image)
+    
+    histogram = np.array(gray_image.histogram())
+    total = gray.size
+    avg_brightness = float(np.dot(histogram, np.arange(256))) / total
+    median_brightness = int(np.searchsorted(np.cumsum(histogram), total // 2, side='right'))
+    
+    text_threshold = median_brightness * 0.5
+    if avg_brightness > 180:
+        text_threshold = min(text_threshold, 90)
+    elif avg_brightness > 150:
+        text_threshold = min(text_threshold, 110)
+    
+    # Минимумы по окрестностям 3x3 и 5x5 - одни на все три прохода
+    near1 = _min_filter(gray)
+    near2 = _min_filter(near1)
+    # Проход 1: светлее порога оставляем только края текста (темный сосед в радиусе 2 и яркость < 130)
+    keep = ~(gray > text_threshold) | ((gray < 130) & (near2 < text_threshold))
+    # Проход 2: светлее 130 - только рядом с очень темными (< 90)
+    keep &= (gray <= 130) | (near1 < 90)
+    # Проход 3: светлее 120 - только рядом с явным текстом (< 80)
+    keep &= (gray <= 120) | (near1 < 80)
+    keep_mask = Image.fromarray(keep.astype(np.uint8) * 255, 'L')
+    
+    # Закрытие 3x3 (как MaxFilter + MinFilter), за краем изображения соседей нет
+    closed = ~_dilate(~_dilate(keep, 1), 1)
+    mask = Image.fromarray(closed.astype(np.uint8) * 255, 'L')
+    mask = mask.filter(ImageFilter.GaussianBlur(radius=0.3))
+    # Удаленные пиксели и так совпадают с прозрачным фоном (255, 255, 255, 0) - смешивать
+    # нужно только оставленные, непрозрачные
+    mask = ImageChops.darker(mask, keep_mask)
+    
+    opaque = image.convert('RGB').convert('RGBA')
+    result = Image.composite(opaque, Image.new('RGBA', (width, height), (255, 255, 255, 0)), mask)
+    
+    return result
+
 def remove_background_for_text(image):
     """
     Специальный алгоритм для извлечения текста - удаляет фон листа, оставляет только текст
     """
     width, height = image.size
+    if HAS_NUMPY and width > 0 and height > 0:
+        return _remove_background_for_text_numpy(image)
+    
     pixels = list(image.getdata())
     
     # Конвертируем в grayscale для анализа яркости
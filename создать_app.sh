@@ -83,6 +83,8 @@ chmod +x "${MACOS_DIR}/${APP_NAME}"
 # Копируем Python скрипт в Resources
 echo "Копирование файлов..."
 cp "GUI_РАБОТАЮЩАЯ.py" "$RESOURCES_DIR/"
+# Реестр движков удаления фона - GUI берет движок из него
+cp "background_engines.py" "$RESOURCES_DIR/"
 
 # Создаем иконку (простая замена)
 # Можно заменить на свою иконку позже